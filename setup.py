@@ -41,5 +41,7 @@ setup(
     ],
     scripts=['bin/tempo-api',
              'bin/tempo-enqueue',
+             'bin/tempo-enqueued',
              'bin/tempo-manage',
+             'bin/tempo-scheduler',
              'bin/tempo-worker'])
@@ -16,14 +16,15 @@
 #    limitations under the License.
 import logging
 
-from tempo import db
-from tempo.openstack.common import utils as common_utils
-
 
 logger = logging.getLogger('tempo.actions')
 
+# tempo.openstack.common.utils is imported by the actions themselves since it
+# pulls in eventlet, which importing this module shouldn't.
+
 
 def snapshot(task):
+    from tempo.openstack.common import utils as common_utils
     snapshot_name = 'snapshot'
     common_utils.execute(
         'nova', 'image-create', task.instance_uuid, snapshot_name)
@@ -31,8 +32,7 @@ def snapshot(task):
 
 def _backup(task, backup_type):
     task_uuid = task.uuid
-    params = db.task_parameter_get_all_by_task_uuid(task_uuid)
-    rotation = params.get('rotation', '0')
+    rotation = task.params.get('rotation', '0')
 
     try:
         rotation = int(rotation)
@@ -41,6 +41,7 @@ def _backup(task, backup_type):
                      " '%(task_uuid)s'" % locals())
         rotation = 0
 
+    from tempo.openstack.common import utils as common_utils
     backup_name = backup_type
     common_utils.execute(
         'nova', 'backup', task.instance_uuid, backup_name, backup_type,
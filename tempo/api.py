@@ -14,14 +14,26 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+import urllib
+
 import flask
 from flask import request
 
 from tempo import actions
+from tempo import cache
 from tempo import config
 from tempo import cron
 from tempo import cronspec
 from tempo import db
+from tempo import queue
+from tempo import serializer
+from tempo import snapshot
+from tempo import wsgi
 from tempo.openstack.common import cfg
 from tempo.openstack.common import exception as common_exception
 
@@ -35,7 +47,54 @@ api_opts = [
                help='The port to run the API server on'),
     cfg.BoolOpt('daemonized',
                 default=False,
-                help='Run the API as an eventlet WSGI app')
+                help='Run the API as an eventlet WSGI app'),
+    cfg.IntOpt('workers',
+               default=0,
+               help='Processes forked to serve the API when daemonized; 0'
+                    ' forks one per CPU'),
+    cfg.IntOpt('worker_greenlets',
+               default=1000,
+               help='Requests each API worker process serves at once'),
+    cfg.IntOpt('max_limit',
+               default=1000,
+               help='The maximum number of tasks returned in one page, and'
+                    ' the number fetched per query when streaming a full'
+                    ' listing'),
+    cfg.IntOpt('max_bulk_tasks',
+               default=10000,
+               help='The maximum number of tasks a bulk request may create,'
+                    ' update or delete'),
+    cfg.BoolOpt('publish_task_changes',
+                default=True,
+                help='Tell workers which tasks changed so they stop using'
+                     ' cached copies'),
+    cfg.IntOpt('response_cache_size',
+               default=1000,
+               help='Serialized GET responses kept in memory; 0 disables'
+                    ' the cache. Only used when the API is served by a'
+                    ' single process'),
+    cfg.IntOpt('response_cache_ttl',
+               default=5,
+               help='Seconds a cached response is served for'),
+    cfg.IntOpt('response_cache_max_bytes',
+               default=1048576,
+               help='Task listings larger than this are not cached'),
+    cfg.StrOpt('json_backend',
+               default='auto',
+               help="JSON encoder for responses: 'ujson', 'simplejson',"
+                    " 'json', or 'auto' for the fastest one installed"),
+    cfg.IntOpt('fragment_cache_size',
+               default=10000,
+               help='Serialized tasks kept for reuse in listings while they'
+                    ' are unchanged; 0 disables it'),
+    cfg.IntOpt('changes_max_wait',
+               default=30,
+               help='The longest a change feed request may wait for a'
+                    ' change, in seconds'),
+    cfg.FloatOpt('changes_poll_interval',
+                 default=1.0,
+                 help='Seconds between checks for changes while a change'
+                      ' feed request waits')
 ]
 
 api_group = cfg.OptGroup(name='api', title='Tempo API options')
@@ -43,21 +102,440 @@ CFG.register_group(api_group)
 CFG.register_opts(api_opts, group=api_group)
 
 
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The column of the tasks table behind each field of a serialized task,
+# which also has the task's 'params'
+_FIELD_COLUMNS = {
+    'id': 'id',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+    'deleted_at': 'deleted_at',
+    'deleted': 'deleted',
+    'uuid': 'uuid',
+    'instance_uuid': 'instance_uuid',
+    'recurrence': 'cron_schedule',
+    'action': 'action',
+}
+_DATE_FIELDS = ('created_at', 'updated_at', 'deleted_at')
+TASK_FIELDS = sorted(_FIELD_COLUMNS) + ['params']
+
+_SERIALIZER = None
+# (columns, params, JSON) of tasks keyed by (uuid, fields); see _task_fragment
+_TASK_FRAGMENTS = None
+
+
+def _get_serializer():
+    global _SERIALIZER
+    if _SERIALIZER is None:
+        _SERIALIZER = serializer.Serializer(CFG.api.json_backend)
+    return _SERIALIZER
+
+
+def _dumps(obj):
+    return _get_serializer().dumps(obj)
+
+
+def _task_fragment(task, params, fields):
+    """
+    Returns the serialized task dict, reusing the one serialized for an
+    earlier listing when neither the task's columns nor its parameters have
+    changed since.
+    """
+    global _TASK_FRAGMENTS
+    if params is None and 'params' in fields:
+        params = db.task_parameter_get_all_by_task_uuid(task.uuid)
+    if CFG.api.fragment_cache_size <= 0:
+        return _dumps(_make_task_dict(task, params=params, fields=fields))
+    if _TASK_FRAGMENTS is None:
+        _TASK_FRAGMENTS = cache.LRUCache(maxsize=CFG.api.fragment_cache_size)
+
+    key = (task.uuid, tuple(fields))
+    columns = tuple(getattr(task, _FIELD_COLUMNS[field])
+                    for field in fields if field != 'params')
+    cached = _TASK_FRAGMENTS.get(key)
+    if cached is not None and cached[0] == columns and cached[1] == params:
+        return cached[2]
+
+    fragment = _dumps(_make_task_dict(task, params=params, fields=fields))
+    _TASK_FRAGMENTS.set(key, (columns, params, fragment))
+    return fragment
+
+
+# Serialized (etag, body) of task responses keyed by uuid, and of listings
+# keyed by query string; see _cached_response
+_TASK_RESPONSES = None
+_INDEX_RESPONSES = None
+# Bumped by every write so that responses rendered before it aren't cached
+_RESPONSE_GENERATION = 0
+
+
+def _response_cache_size():
+    # A write only invalidates the cache of the process handling it, so
+    # with several workers the others would serve stale responses
+    if wsgi.SERVING_WORKERS > 1:
+        return 0
+    return CFG.api.response_cache_size
+
+
+def _response_caches():
+    global _TASK_RESPONSES, _INDEX_RESPONSES
+    if _TASK_RESPONSES is None:
+        size = max(_response_cache_size(), 1)
+        ttl = CFG.api.response_cache_ttl
+        _TASK_RESPONSES = cache.LRUCache(maxsize=size, ttl=ttl)
+        _INDEX_RESPONSES = cache.LRUCache(maxsize=size, ttl=ttl)
+    return _TASK_RESPONSES, _INDEX_RESPONSES
+
+
+def _cache_response(responses, key, body, generation, etag=None):
+    """
+    Caches `body` unless a write happened since `generation`, with `etag`
+    or else the sha1 of the body
+    """
+    if _response_cache_size() <= 0 or generation != _RESPONSE_GENERATION:
+        return None
+    if etag is None:
+        etag = hashlib.sha1(body).hexdigest()
+    responses.set(key, (etag, body))
+    return etag
+
+
+def _invalidate_responses(task_uuids):
+    """Drops the cached responses of the given tasks and every listing"""
+    global _RESPONSE_GENERATION
+    _RESPONSE_GENERATION += 1
+    task_responses, index_responses = _response_caches()
+    for task_uuid in task_uuids:
+        task_responses.pop(task_uuid)
+    index_responses.clear()
+
+
+def _cached_response(responses, key):
+    """
+    Returns the response for a cached body, or a 304 when the client
+    already holds it, or None when nothing is cached under `key`.
+    """
+    if _response_cache_size() <= 0:
+        return None
+    cached = responses.get(key)
+    if cached is None:
+        return None
+
+    etag, body = cached
+    return _etag_response(body, etag)
+
+
+def _etag_response(body, etag):
+    if etag in request.if_none_match:
+        res = app.response_class(status=304)
+    else:
+        res = app.make_response(body)
+        res.content_encoding = 'application/json'
+    res.set_etag(etag)
+    return res
+
+
+def _listing_etag(cursor):
+    """
+    The ETag of a listing, from the request and the change feed `cursor`.
+    A listing only changes when a task is written, which moves the cursor,
+    so every worker derives the same ETag without serializing the listing.
+    """
+    return hashlib.sha1('%s %s %d' % (_get_serializer().backend,
+                                      request.url, cursor)).hexdigest()
+
+
+def _cache_stream(responses, key, chunks, generation, etag):
+    """Passes a streamed body through, caching it once it is complete"""
+    body = []
+    size = 0
+    for chunk in chunks:
+        yield chunk
+        if body is not None:
+            size += len(chunk)
+            if size > CFG.api.response_cache_max_bytes:
+                body = None
+            else:
+                body.append(chunk)
+
+    if body is not None:
+        _cache_response(responses, key, ''.join(body), generation, etag)
+
+
+@app.before_request
+def _begin_session_scope():
+    db.begin_session_scope()
+
+
+@app.teardown_request
+def _end_session_scope(exc):
+    db.end_session_scope()
+
+
+@app.route("/status")
+def status():
+    """Returns the state of the database connection pool and caches"""
+    body = {'db_pool': db.pool_stats()}
+    if _TASK_FRAGMENTS is not None:
+        body['fragment_cache'] = _TASK_FRAGMENTS.stats()
+    return _new_response(body)
+
+
 @app.route("/periodic_tasks")
 def task_index():
-    """Returns a list of all of the tasks"""
-    task_dicts = [_make_task_dict(t) for t in db.task_get_all()]
-    body = {'periodic_tasks': task_dicts}
+    """
+    Returns a list of the tasks.
+
+    With `limit`, a single page of at most that many tasks is returned,
+    along with a link to the next page. `marker` is the uuid of the last
+    task of the previous page. Without `limit` every task is streamed.
+
+    `instance_uuid`, `action` and `updated_since` ('YYYY-MM-DD HH:MM:SS')
+    only list the matching tasks. `fields` is a comma separated list of the
+    fields to return; the parameters are only looked up when it includes
+    'params'.
+
+    The response carries an ETag that changes whenever a task is written.
+    """
+    return _task_index()
+
+
+@app.route("/instances/<instance_uuid>/periodic_tasks")
+def instance_task_index(instance_uuid):
+    """Returns the tasks of an instance, taking the arguments of task_index"""
+    return _task_index(instance_uuid=instance_uuid)
+
+
+def _task_index(instance_uuid=None):
+    task_responses, index_responses = _response_caches()
+    key = request.full_path
+    res = _cached_response(index_responses, key)
+    if res is not None:
+        return res
+    generation = _RESPONSE_GENERATION
+
+    # Read before the listing, so a write racing it changes the ETag of
+    # later listings rather than going unnoticed
+    etag = _listing_etag(db.task_change_get_last_id())
+    if etag in request.if_none_match:
+        return _etag_response(None, etag)
+
+    marker = request.args.get('marker')
+    try:
+        limit = _get_limit()
+        filters = _get_filters()
+        fields = _get_fields()
+    except ValueError as e:
+        return _error_response(400, str(e), log_error=False)
+    if instance_uuid is not None:
+        filters['instance_uuid'] = instance_uuid
+
+    # The uuid is needed for parameters and markers even when not returned
+    columns = set(_FIELD_COLUMNS[field] for field in fields
+                  if field != 'params')
+    columns.add('uuid')
+
+    links = []
+    try:
+        pages = db.task_iter_batches(batch_size=limit or CFG.api.max_limit,
+                                     columns=sorted(columns), marker=marker,
+                                     filters=filters)
+        # Reading the first page up front reports a bad marker before the
+        # response starts streaming
+        first_page = next(pages, [])
+        if limit is not None:
+            if len(first_page) == limit:
+                links.append(_next_link(first_page[-1].uuid, limit))
+            pages = iter([first_page])
+        else:
+            pages = itertools.chain([first_page], pages)
+    except common_exception.NotFound as e:
+        return _error_response(400, "Invalid marker: %s" % e,
+                               log_error=False)
+
+    chunks = _stream_index(pages, links, fields)
+    if _response_cache_size() > 0:
+        chunks = _cache_stream(index_responses, key, chunks, generation,
+                               etag)
+    res = _new_streaming_response(chunks)
+    res.set_etag(etag)
+    return res
+
+
+def _get_limit():
+    limit = request.args.get('limit')
+    if limit is None:
+        return None
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("Invalid limit '%s'" % limit)
+
+    if limit <= 0:
+        raise ValueError("Invalid limit '%s'" % limit)
+
+    return min(limit, CFG.api.max_limit)
+
+
+def _get_filters():
+    filters = {}
+    for name in ['instance_uuid', 'action']:
+        if name in request.args:
+            filters[name] = request.args[name]
+
+    since = request.args.get('updated_since')
+    if since is not None:
+        try:
+            filters['updated_since'] = datetime.datetime.strptime(
+                    since.replace('T', ' '), DATE_FORMAT)
+        except ValueError:
+            raise ValueError("Invalid updated_since '%s'" % since)
+
+    return filters
+
+
+def _get_fields():
+    fields = request.args.get('fields')
+    if fields is None:
+        return TASK_FIELDS
+
+    fields = [field for field in fields.split(',') if field]
+    for field in fields:
+        if field not in TASK_FIELDS:
+            raise ValueError("Invalid field '%s'" % field)
+    return fields
+
+
+def _next_link(marker, limit):
+    """Links the page after `marker`, keeping the other query arguments"""
+    args = dict(request.args.items())
+    args.update(limit=limit, marker=marker)
+    query = urllib.urlencode(sorted(args.items()))
+    return {'rel': 'next', 'href': '%s?%s' % (request.base_url, query)}
+
+
+def _stream_index(pages, links, fields=TASK_FIELDS):
+    """
+    Serializes a task listing page by page, fetching the parameters of each
+    page in a single query when they are among `fields`.
+    """
+    yield '{"periodic_tasks": ['
+    separator = ''
+    for tasks in pages:
+        if 'params' in fields:
+            params = db.task_parameter_get_all_by_task_uuids(
+                    [task.uuid for task in tasks])
+        else:
+            params = {}
+        chunk = ', '.join(_task_fragment(task, params.get(task.uuid), fields)
+                          for task in tasks)
+        if chunk:
+            yield separator + chunk
+            separator = ', '
+    yield ']'
+    if links:
+        yield ', "periodic_tasks_links": %s' % _dumps(links)
+    yield '}'
+
+
+@app.route("/periodic_tasks/changes")
+def task_changes():
+    """
+    Returns the tasks written and deleted after the change `since`.
+
+    The response holds the current state of every task changed since then,
+    the uuids of the deleted ones, and the `cursor` to pass as `since` next
+    time. At most `limit` changes are read per request. Without `since`
+    only the current cursor is returned, so a client can take it before
+    listing every task and follow the feed from there. With `wait` the
+    request waits up to that many seconds for a change to arrive.
+
+    Responds with 410 when changes after `since` have been purged, or
+    `since` is past the last change logged, in which case the client has to
+    list every task again.
+    """
+    try:
+        limit = _get_limit() or CFG.api.max_limit
+        since = _get_int_arg('since')
+        wait = min(_get_int_arg('wait') or 0, CFG.api.changes_max_wait)
+    except ValueError as e:
+        return _error_response(400, str(e), log_error=False)
+
+    first, last = db.task_change_get_bounds()
+    if since is None:
+        return _new_response({'periodic_tasks': [], 'deleted': [],
+                              'cursor': last})
+    if since < first - 1:
+        return _error_response(410, "Changes after %d have been purged" %
+                               since, log_error=False)
+    if since > last:
+        return _error_response(410, "No change %d has been logged" % since,
+                               log_error=False)
+
+    deadline = time.time() + wait
+    changes = db.task_change_get_since(since, limit=limit)
+    while not changes and time.time() < deadline:
+        time.sleep(min(CFG.api.changes_poll_interval,
+                       max(deadline - time.time(), 0)))
+        changes = db.task_change_get_since(since, limit=limit)
+
+    # Only the last change of each task matters
+    deleted = {}
+    for change in changes:
+        deleted[change.task_uuid] = change.deleted
+
+    live_uuids = [uuid for uuid, gone in deleted.iteritems() if not gone]
+    tasks = db.task_get_all_by_uuids(live_uuids)
+    params = db.task_parameter_get_all_by_task_uuids(list(tasks))
+    body = {
+        'periodic_tasks': [_make_task_dict(tasks[uuid], params=params[uuid])
+                           for uuid in sorted(tasks)],
+        'deleted': sorted(uuid for uuid, gone in deleted.iteritems()
+                          if gone),
+        'cursor': changes[-1].id if changes else since
+    }
     return _new_response(body)
 
 
+def _get_int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("Invalid %s '%s'" % (name, value))
+
+    if value < 0:
+        raise ValueError("Invalid %s '%s'" % (name, value))
+
+    return value
+
+
 @app.route("/periodic_tasks/<id>")
 def task_show(id):
-    """Returns a specific task record by id"""
+    """
+    Returns a specific task record by id.
+
+    The response carries an ETag of its body, and is served from memory
+    until the task is written to.
+    """
+    task_responses, index_responses = _response_caches()
+    res = _cached_response(task_responses, id)
+    if res is not None:
+        return res
+    generation = _RESPONSE_GENERATION
+
     task = db.task_get(id)
     task_dict = _make_task_dict(task)
-    body = {'periodic_task': task_dict}
-    return _new_response(body)
+    body = _dumps({'periodic_task': task_dict})
+    etag = _cache_response(task_responses, id, body, generation)
+    if etag is None:
+        etag = hashlib.sha1(body).hexdigest()
+    return _etag_response(body, etag)
 
 
 @app.route("/periodic_tasks/<id>", methods=['PUT', 'POST'])
@@ -77,6 +555,8 @@ def task_create_or_update(id):
         return _error_response(412, str(e))
     except Exception as e:
         return _error_response(500, str(e))
+    finally:
+        _invalidate_responses([id])
 
     body = {'periodic_task': task_dict}
     res = _new_response(body)
@@ -84,6 +564,132 @@ def task_create_or_update(id):
     return res
 
 
+@app.route("/periodic_tasks/bulk", methods=['POST'])
+def task_bulk():
+    """
+    Creates, updates and deletes many task records in one transaction.
+
+    The body holds an 'upsert' list of task dicts, each with the task's
+    'uuid' and the same keys as a single create, and a 'delete' list of
+    task uuids. Nothing is written unless every entry is valid.
+    """
+    if request.content_type.lower() != 'application/json':
+        return _error_response(412, "Invalid content type")
+
+    try:
+        req_body = flask.json.loads(request.data)
+        upserts = req_body.get('upsert', [])
+        delete_uuids = req_body.get('delete', [])
+    except Exception as e:
+        return _error_response(412, str(e))
+
+    errors = [{'error': "'%s' must be a list" % name}
+              for name, value in [('upsert', upserts),
+                                  ('delete', delete_uuids)]
+              if not isinstance(value, list)]
+    if errors:
+        res = _new_response({'errors': errors})
+        res.status_code = 412
+        return res
+
+    if len(upserts) + len(delete_uuids) > CFG.api.max_bulk_tasks:
+        return _error_response(
+                413, "At most %d tasks may be changed in one request" %
+                CFG.api.max_bulk_tasks, log_error=False)
+
+    tasks, params, errors = _bulk_task_values(upserts, delete_uuids)
+    if errors:
+        res = _new_response({'errors': errors})
+        res.status_code = 412
+        return res
+
+    try:
+        task_refs, deleted = db.task_bulk_update(
+                tasks, params=params, delete_uuids=delete_uuids)
+    except Exception as e:
+        return _error_response(500, str(e))
+    finally:
+        _invalidate_responses([values['uuid'] for values in tasks] +
+                              delete_uuids)
+
+    cron.update_tasks()
+
+    task_params = db.task_parameter_get_all_by_task_uuids(
+            [task.uuid for task in task_refs])
+    _publish_task_changes(tasks=task_refs, deleted_uuids=deleted,
+                          task_params=task_params)
+    body = {
+        'periodic_tasks': [_make_task_dict(task, params=task_params[task.uuid])
+                           for task in task_refs],
+        'deleted': deleted,
+        'not_found': [uuid for uuid in delete_uuids if uuid not in deleted]
+    }
+    return _new_response(body)
+
+
+def _bulk_task_values(upserts, delete_uuids):
+    """
+    Validates every entry of a bulk request, returning the task values,
+    the parameters keyed by task uuid, and a list of errors.
+    """
+    tasks = []
+    params = {}
+    errors = []
+    if not all(isinstance(uuid, basestring) for uuid in delete_uuids):
+        errors.append({'error': "'delete' must be a list of task uuids"})
+        delete_uuids = [uuid for uuid in delete_uuids
+                        if isinstance(uuid, basestring)]
+    seen = set(delete_uuids)
+    if len(seen) != len(delete_uuids):
+        errors.append({'error': "Duplicate uuid in 'delete'"})
+
+    for index, body_dict in enumerate(upserts):
+        task_uuid = None
+        try:
+            if not isinstance(body_dict, dict):
+                raise ValueError("Task must be an object")
+            task_uuid = body_dict.get('uuid')
+            if not task_uuid:
+                raise common_exception.MissingArgumentError(
+                        "Missing key 'uuid' in body")
+            if not isinstance(task_uuid, basestring):
+                raise ValueError("'uuid' must be a string")
+            if task_uuid in seen:
+                raise ValueError("Task '%s' given more than once" %
+                                 task_uuid)
+            task_params = body_dict.get('params') or {}
+            if not isinstance(task_params, dict):
+                raise ValueError("'params' must be an object")
+            seen.add(task_uuid)
+            tasks.append(_task_values(task_uuid, body_dict))
+        except Exception as e:
+            errors.append({'index': index, 'uuid': task_uuid,
+                           'error': str(e)})
+            continue
+
+        if task_params:
+            task_params = dict(task_params)
+            delete = task_params.pop('__delete', False)
+            params[task_uuid] = (task_params, delete)
+
+    return tasks, params, errors
+
+
+@app.route("/instances/<instance_uuid>/periodic_tasks", methods=['DELETE'])
+def instance_task_delete(instance_uuid):
+    """Deletes every task of an instance, returning their uuids"""
+    try:
+        deleted = db.task_delete_by_instance(instance_uuid)
+    except Exception as e:
+        return _error_response(500, str(e))
+
+    if deleted:
+        _invalidate_responses(deleted)
+        cron.update_tasks()
+        _publish_task_changes(deleted_uuids=deleted)
+    return _new_response({'deleted': deleted})
+
+
 @app.route("/periodic_tasks/<id>", methods=['DELETE'])
 def task_delete(id):
     """Deletes a task record"""
@@ -94,9 +700,11 @@ def task_delete(id):
     except Exception as e:
         res = _error_response(500, str(e))
     else:
+        _invalidate_responses([id])
         res = app.make_response('')
         res.status_code = 204
-        cron.update()
+        cron.update_tasks()
+        _publish_task_changes(deleted_uuids=[id])
 
     return res
 
@@ -111,13 +719,24 @@ def _error_response(status_code, error_msg, log_error=True):
 
 def _new_response(body):
     """Creates a Flask response and sets the content type"""
-    res = app.make_response(flask.json.dumps(body))
+    res = app.make_response(_dumps(body))
     res.content_encoding = 'application/json'
     return res
 
 
-def _create_or_update_task(id, body_dict):
-    """Verifies the incoming keys are correct and creates the task record"""
+def _new_streaming_response(chunks):
+    """
+    Creates a Flask response from an iterable of serialized chunks. The
+    request context, and with it the request's session scope, stays open
+    until the last chunk is sent.
+    """
+    res = app.response_class(flask.stream_with_context(chunks))
+    res.content_encoding = 'application/json'
+    return res
+
+
+def _task_values(id, body_dict):
+    """Verifies the incoming keys are correct and builds the task values"""
     keys = ['action', 'instance_uuid', 'recurrence']
     for key in keys:
         if key not in body_dict:
@@ -127,7 +746,7 @@ def _create_or_update_task(id, body_dict):
     # Validate values
     cronspec.parse(body_dict['recurrence'])
 
-    values = {
+    return {
         'deleted': False,
         'uuid': id,
         'instance_uuid': body_dict['instance_uuid'],
@@ -135,6 +754,11 @@ def _create_or_update_task(id, body_dict):
         'action': body_dict['action']
     }
 
+
+def _create_or_update_task(id, body_dict):
+    """Verifies the incoming keys are correct and creates the task record"""
+    values = _task_values(id, body_dict)
+
     task = db.task_create_or_update(id, values)
 
     params = body_dict.get('params')
@@ -142,41 +766,103 @@ def _create_or_update_task(id, body_dict):
         delete = params.pop('__delete', False)
         db.task_parameter_update(id, params, delete=delete)
 
-    cron.update()
+    cron.update_tasks()
+    _publish_task_changes(tasks=[task])
     return _make_task_dict(task)
 
 
-def _make_task_dict(task):
+def _publish_task_changes(tasks=(), deleted_uuids=(), task_params=None):
+    """
+    Announces the new versions of changed tasks and the deleted ones so
+    workers stop using their copies. Failures are only logged.
+
+    `task_params` saves looking up the tasks' parameters when the caller
+    has already fetched them.
+    """
+    if not CFG.api.publish_task_changes or not (tasks or deleted_uuids):
+        return
+    try:
+        if task_params is None:
+            task_params = db.task_parameter_get_all_by_task_uuids(
+                    [task.uuid for task in tasks])
+        versions = dict((task.uuid, snapshot.TaskSnapshot.from_task(
+                            task, task_params[task.uuid]).version)
+                        for task in tasks)
+        queue.publish_task_changes(list(versions) + list(deleted_uuids),
+                                   versions)
+    except Exception as e:
+        app.logger.exception(e)
+
+
+def _make_task_dict(task, params=None, fields=TASK_FIELDS):
     """
     Create a dict representation of an image which we can use to
     serialize the task.
+
+    `params` saves looking up the task's parameters when the caller has
+    already fetched them. Only `fields` are included, so `task` only needs
+    the columns behind them.
+    """
+    task_dict = {}
+    for field in fields:
+        if field == 'params':
+            if params is None:
+                params = db.task_parameter_get_all_by_task_uuid(task.uuid)
+            task_dict['params'] = params
+        elif field in _DATE_FIELDS:
+            task_dict[field] = serializer.format_datetime(
+                    getattr(task, field))
+        else:
+            task_dict[field] = getattr(task, _FIELD_COLUMNS[field])
+    return task_dict
+
+
+def _archive_deleted_rows(interval):
+    """Moves old soft-deleted rows to the shadow tables every `interval`"""
+    while True:
+        time.sleep(interval)
+        try:
+            archived = db.archive_deleted_rows()
+        except Exception as e:
+            app.logger.exception(e)
+        else:
+            app.logger.info("Archived deleted rows: %(archived)s" % locals())
+
+
+def _run_archiver():
+    _archive_deleted_rows(CFG.db.archive_interval)
+
+
+def _archivers():
     """
-    def _format_date(date):
-        return date.strftime('%Y-%m-%d %H:%M:%S') if date else date
+    Archiving runs from the API, the one process every deployment runs,
+    whichever cron driver fires the tasks. Returns the function to run it
+    with, if it is enabled.
+    """
+    if CFG.db.archive_interval > 0:
+        return [_run_archiver]
+    return []
 
-    return {
-        'id': task.id,
-        'created_at': _format_date(task.created_at),
-        'updated_at': _format_date(task.updated_at),
-        'deleted_at': _format_date(task.deleted_at),
-        'deleted': task.deleted,
-        'uuid': task.uuid,
-        'instance_uuid': task.instance_uuid,
-        'recurrence': task.cron_schedule,
-        'action': task.action,
-        'params': db.task_parameter_get_all_by_task_uuid(task.uuid)
-    }
+
+def _start_archiver():
+    """Starts archiving on a thread. Returns the thread, if any."""
+    for archiver in _archivers():
+        thread = threading.Thread(target=archiver)
+        thread.daemon = True
+        thread.start()
+        return thread
 
 
 def start():
     """Starts up the flask API worker"""
     if CFG.api.daemonized:
-        # TODO(mdietz): there's a cleaner way to do this, but this works well
-        # as a way of backgrounding the server for now
         import daemon
-        from eventlet import wsgi
-        import eventlet
         with daemon.DaemonContext():
-            wsgi.server(eventlet.listen(('', CFG.api.port)), app)
+            # The supervising process keeps forking workers, so archiving
+            # gets a process of its own rather than a thread in it
+            wsgi.serve(app, CFG.api.port, workers=wsgi.worker_count(),
+                       greenlets=CFG.api.worker_greenlets,
+                       services=_archivers())
     else:
+        _start_archiver()
         app.run(port=CFG.api.port, debug=CFG.debug)
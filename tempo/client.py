@@ -31,9 +31,15 @@ resource = "/%s/{id}" % resources_name
 class TempoClient(jsclient.JSONClient):
     """A client class for accessing the Tempo service."""
 
-    @requiem.restmethod('GET', "/%s" % resources_name)
-    def task_get_all(self, req):
-        """Retrieve a list of all existing tasks."""
+    @requiem.restmethod('GET', "/%s" % resources_name, 'limit', 'marker')
+    def task_get_all(self, req, limit=None, marker=None):
+        """Retrieve a list of existing tasks.
+
+        :param limit: Maximum number of tasks to return; all tasks are
+                      returned if not given.
+
+        :param marker: ID of the last task of the previous page.
+        """
 
         # Send the request
         resp = req.send()
@@ -101,6 +107,45 @@ class TempoClient(jsclient.JSONClient):
         return self._task_create_update(
             id, action, instance_uuid, recurrence, params, clear_params)
 
+    @requiem.restmethod('POST', "/%s/bulk" % resources_name)
+    def task_bulk(self, req, upsert=None, delete=None):
+        """Create, update and delete many tasks in a single request.
+
+        :param upsert: List of task dicts to create or update, each with
+                       'uuid', 'action', 'instance_uuid' and 'recurrence'
+                       keys and optionally 'params'.
+
+        :param delete: List of IDs of the tasks to delete.
+
+        Returns a dict with the created or updated 'periodic_tasks', the
+        IDs of the 'deleted' tasks and the IDs that were 'not_found'.
+        """
+
+        # Build the bulk object we're going to send
+        obj = dict(upsert=upsert or [], delete=delete or [])
+
+        # Attach it to the request
+        self._attach_obj(req, obj)
+
+        # Send the request
+        resp = req.send()
+
+        # Return the result
+        return resp.obj
+
+    def task_create_many(self, tasks):
+        """Create many tasks.
+
+        :param tasks: List of dicts with 'action', 'instance_uuid' and
+                      'recurrence' keys and optionally 'params'.
+        """
+        upsert = [dict(task, uuid=str(uuid.uuid4())) for task in tasks]
+        return self.task_bulk(upsert=upsert)['periodic_tasks']
+
+    def task_delete_many(self, ids):
+        """Delete many tasks, returning the IDs that were deleted."""
+        return self.task_bulk(delete=ids)['deleted']
+
     @requiem.restmethod('DELETE', resource)
     def task_delete(self, req, id):
         """Delete a task."""
@@ -14,57 +14,228 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import atexit
+import contextlib
+import fcntl
 import logging
 import os
+import tempfile
+import threading
 
 from tempo import config
 from tempo import db
+from tempo import enqueued
+from tempo import snapshot
 from tempo.openstack.common import cfg
 from tempo.openstack.common import exception as common_exception
-from tempo.openstack.common import utils as common_utils
 
 logger = logging.getLogger('tempo.cron')
 
 CFG = config.CFG
 
 cron_opts = [
+    cfg.StrOpt('driver',
+               default='crontab',
+               help="How tasks are fired: 'crontab' installs one system"
+                    " crontab line per task, 'scheduler' leaves firing to"
+                    " tempo-scheduler"),
     cfg.StrOpt('schedule_override',
                default=None,
                help='Cron formatted schedule to use for all tasks.'
                     ' For debugging purposes.'),
     cfg.StrOpt('tempo_enqueue_path',
                default='/usr/local/bin',
-               help='Path to tempo-enqueue.')
+               help='Path to tempo-enqueue.'),
+    cfg.FloatOpt('install_delay',
+                 default=1.0,
+                 help='Seconds to collect task changes before installing'
+                      ' the crontab. 0 installs on every change.'),
+    cfg.BoolOpt('embed_task_snapshot',
+                default=False,
+                help='Fire tasks with a copy of the task and its parameters'
+                     ' so workers needn\'t look them up. The copy is readable'
+                     ' by local users in the crontab and in ps'),
+    cfg.StrOpt('install_lock_path',
+               default=os.path.join(tempfile.gettempdir(),
+                                    'tempo-crontab.lock'),
+               help='File locked while the crontab is rendered and'
+                    ' installed, shared by every process installing it')
 ]
 
 cron_group = cfg.OptGroup(name='cron', title='Tempo Cron options')
 CFG.register_group(cron_group)
 CFG.register_opts(cron_opts, group=cron_group)
 
-def crontab():
-    DAY_OF_MONTH = "*"
-    MONTH = "*"
 
-    lines = []
-    for task in db.task_get_all():
+DAY_OF_MONTH = "*"
+MONTH = "*"
+
+# cron truncates or rejects longer commands, so lines whose snapshot would
+# take them past this only carry the task uuid
+MAX_LINE_LENGTH = 990
+
+# Serializes installs within the process; install_lock_path serializes them
+# across processes
+_INSTALL_LOCK = threading.Lock()
+_TIMER_LOCK = threading.Lock()
+_TIMER = None
+
+
+def reset_locks():
+    """
+    Creates the install locks afresh. A process that monkey-patches
+    threading after importing this module calls it, so that a green thread
+    waiting for an install blocks only itself: the install holds its lock
+    while the crontab command runs, which yields to other green threads.
+    """
+    global _INSTALL_LOCK, _TIMER_LOCK, _TIMER
+    _INSTALL_LOCK = threading.Lock()
+    _TIMER_LOCK = threading.Lock()
+    # A forked child doesn't inherit its parent's timer thread
+    _TIMER = None
 
-        if CFG.cron.schedule_override:
-            schedule = CFG.cron.schedule_override
+
+def _crontab_line(task, params=None):
+    if CFG.cron.schedule_override:
+        schedule = CFG.cron.schedule_override
+    else:
+        minute, hour, day_of_week = task.cron_schedule.split(' ')
+        schedule = ' '.join([minute, hour, DAY_OF_MONTH, MONTH, day_of_week])
+
+    bin_path = os.path.join(CFG.cron.tempo_enqueue_path, 'tempo-enqueue')
+    line = ' '.join([schedule, bin_path, task.uuid])
+    if params is not None:
+        encoded = snapshot.encode(snapshot.TaskSnapshot.from_task(task,
+                                                                  params))
+        if len(line) + 1 + len(encoded) <= MAX_LINE_LENGTH:
+            line = ' '.join([line, encoded])
         else:
-            minute, hour, day_of_week = task.cron_schedule.split(' ')
-            schedule = ' '.join([minute, hour, DAY_OF_MONTH, MONTH, day_of_week])
+            logger.debug("Task '%s' is too large to embed in its crontab line"
+                         % task.uuid)
+    return line
+
+
+def _task_lines(tasks):
+    """Returns the crontab lines of the tasks keyed by task uuid"""
+    params = {}
+    if CFG.cron.embed_task_snapshot:
+        params = db.task_parameter_get_all_by_task_uuids(
+                [task.uuid for task in tasks])
+    return dict((task.uuid, _crontab_line(task, params.get(task.uuid)))
+                for task in tasks)
 
-        bin_path = os.path.join(CFG.cron.tempo_enqueue_path, 'tempo-enqueue')
-        lines.append(' '.join([schedule, bin_path, task.uuid]))
 
+def _load_lines():
+    # Without snapshots a line only needs the task's uuid and schedule
+    columns = ('uuid', 'cron_schedule')
+    if CFG.cron.embed_task_snapshot:
+        columns = None
+
+    lines = {}
+    for tasks in db.task_iter_batches(columns=columns):
+        lines.update(_task_lines(tasks))
+    return lines
+
+
+def _render(lines):
+    rendered = []
+    socket_path = CFG.enqueued.socket_path
+    if socket_path != enqueued.DEFAULT_SOCKET_PATH:
+        # Tells tempo-enqueue where tempo-enqueued listens
+        rendered.append('TEMPO_ENQUEUE_SOCKET=%s' % socket_path)
+    rendered.extend(lines[task_uuid] for task_uuid in sorted(lines))
     # Trailing new line is required by cron format
-    lines.append('')
-    return '\n'.join(lines)
+    rendered.append('')
+    return '\n'.join(rendered)
+
+
+def crontab():
+    """Renders a crontab for every task in the DB."""
+    return _render(_load_lines())
+
+
+@contextlib.contextmanager
+def _install_lock():
+    with open(CFG.cron.install_lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _install():
+    """
+    Renders the crontab from the DB and installs it.
+
+    Every API worker installs the whole crontab, so it is rendered afresh
+    under a lock shared by all of them: whichever install runs last reads
+    the DB after every write whose install ran before it, and no process
+    can overwrite another's changes with a stale copy.
+    """
+    global _TIMER
+    with _INSTALL_LOCK:
+        with _TIMER_LOCK:
+            # Changes from here on need another install, as they may not be
+            # read by this one
+            _TIMER = None
+
+        # Deferred since the utils module pulls in eventlet
+        from tempo.openstack.common import utils as common_utils
+        with _install_lock():
+            text = crontab()
+            try:
+                common_utils.execute('crontab', '-', process_input=text)
+            except common_exception.ProcessExecutionError as e:
+                logger.exception(e)
+
+
+def _schedule_install():
+    """Installs the crontab once no more changes arrive for install_delay."""
+    global _TIMER
+    delay = CFG.cron.install_delay
+    if delay <= 0:
+        _install()
+        return
+
+    with _TIMER_LOCK:
+        if _TIMER is not None:
+            # A pending install will pick up this change as well
+            return
+        _TIMER = threading.Timer(delay, _install)
+        _TIMER.daemon = True
+        _TIMER.start()
+
+
+def flush():
+    """Installs any pending crontab changes immediately."""
+    with _TIMER_LOCK:
+        timer = _TIMER
+    if timer is not None:
+        timer.cancel()
+        _install()
+
+
+atexit.register(flush)
+
+
+def update_tasks():
+    """
+    Schedules an install of the crontab after tasks were written. The whole
+    crontab is rendered from the DB, so it doesn't matter which ones.
+
+    Changes arriving within `install_delay` seconds of each other are
+    coalesced into a single `crontab -` run in the background.
+    """
+    if CFG.cron.driver != 'crontab':
+        return
+
+    _schedule_install()
 
 
 def update():
     """Updates the crontab based on the state of the DB."""
-    try:
-        common_utils.execute('crontab', '-', process_input=crontab())
-    except common_exception.ProcessExecutionError as e:
-        logger.exception(e)
+    if CFG.cron.driver != 'crontab':
+        return
+
+    _install()
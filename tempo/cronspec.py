@@ -33,10 +33,81 @@ from dateutil.relativedelta import relativedelta
 from pyparsing import (Word, Literal, ZeroOrMore, Optional,
                        Group, StringEnd, alphas)
 
+from tempo import cache
+
 
 DAYNAMES = "sun", "mon", "tue", "wed", "thu", "fri", "sat"
 WEEKDAYS = dict((name, dow) for name, dow in zip(DAYNAMES, range(7)))
 
+# Expanded crontab expressions keyed by (cronexpr, max_, dow_wrap)
+_EXPR_CACHE = cache.LRUCache(maxsize=4096)
+
+# Parsed cronspecs keyed by the full recurrence string
+_SPEC_CACHE = cache.LRUCache(maxsize=4096)
+
+# One compiled grammar per field width
+_PARSERS = {}
+
+
+def _get_parser(max_):
+    parser = _PARSERS.get(max_)
+    if parser is None:
+        parser = _PARSERS[max_] = cronexpr_parser(max_)
+    return parser
+
+
+def _set_to_mask(numbers):
+    mask = 0
+    for number in numbers:
+        mask |= 1 << number
+    return mask
+
+
+# Bit position of every single-bit mask wide enough for any cron field
+_BIT_INDEX = dict((1 << i, i) for i in range(64))
+
+ONE_MINUTE = timedelta(minutes=1)
+ONE_HOUR = timedelta(hours=1)
+ONE_DAY = timedelta(days=1)
+
+
+def _next_bit(mask, start):
+    """Return the lowest bit set in `mask` at or above `start`, or None."""
+    mask >>= start
+    if not mask:
+        return None
+    return start + _BIT_INDEX[mask & -mask]
+
+
+def _prev_bit(mask, start):
+    """Return the highest bit set in `mask` at or below `start`, or None."""
+    mask &= (2 << start) - 1
+    if not mask:
+        return None
+    while mask & (mask - 1):
+        mask &= mask - 1
+    return _BIT_INDEX[mask]
+
+
+def _midnight(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _day_of_week(dt):
+    # cron counts days of the week from Sunday = 0
+    return dt.isoweekday() % 7
+
+
+def _mask_to_set(mask):
+    numbers = set()
+    number = 0
+    while mask:
+        if mask & 1:
+            numbers.add(number)
+        mask >>= 1
+        number += 1
+    return numbers
+
 
 class cronexpr_parser(object):
     """Parser for crontab expressions. Any expression of the form 'groups'
@@ -170,6 +241,27 @@ class cronspec(object):
 
     @staticmethod
     def _expand_cronexpr(cronexpr, max_, dow_wrap=False):
+        """Expand `cronexpr` to a bitmask with bit N set for every time unit
+        N on which the crontab triggers.
+
+        Expanded string expressions are cached, so parsing only happens
+        the first time a given expression is seen.
+
+        """
+        if isinstance(cronexpr, basestring):
+            key = (cronexpr, max_, dow_wrap)
+            mask = _EXPR_CACHE.get(key)
+            if mask is None:
+                mask = _set_to_mask(cronspec._expand_cronexpr_to_set(
+                        cronexpr, max_, dow_wrap))
+                _EXPR_CACHE.set(key, mask)
+            return mask
+
+        return _set_to_mask(
+                cronspec._expand_cronexpr_to_set(cronexpr, max_, dow_wrap))
+
+    @staticmethod
+    def _expand_cronexpr_to_set(cronexpr, max_, dow_wrap=False):
         """Takes the given cronexpr argument in one of the forms::
 
             int         (like 7)
@@ -179,9 +271,8 @@ class cronspec(object):
 
         And convert it to an (expanded) set representing all time unit
         values on which the crontab triggers.  Only in case of the base
-        type being 'basestring', parsing occurs.  (It is fast and
-        happens only once for each cronspec instance, so there is no
-        significant performance overhead involved.)
+        type being 'basestring', parsing occurs, using a grammar that is
+        built once per field width.
 
         For the other base types, merely Python type conversions happen.
 
@@ -198,7 +289,7 @@ class cronspec(object):
         if isinstance(cronexpr, int):
             result = set([cronexpr])
         elif isinstance(cronexpr, basestring):
-            result = cronexpr_parser(max_).parse(cronexpr)
+            result = _get_parser(max_).parse(cronexpr)
         elif isinstance(cronexpr, set):
             result = cronexpr
         elif is_iterable(cronexpr):
@@ -225,9 +316,112 @@ class cronspec(object):
         self._orig_minute = minute
         self._orig_hour = hour
         self._orig_day_of_week = day_of_week
-        self.hour = self._expand_cronexpr(hour, 24)
-        self.minute = self._expand_cronexpr(minute, 60)
-        self.day_of_week = self._expand_cronexpr(day_of_week, 7, dow_wrap=True)
+        self.hour_mask = self._expand_cronexpr(hour, 24)
+        self.minute_mask = self._expand_cronexpr(minute, 60)
+        self.day_of_week_mask = self._expand_cronexpr(day_of_week, 7,
+                                                      dow_wrap=True)
+
+    @property
+    def minute(self):
+        return _mask_to_set(self.minute_mask)
+
+    @property
+    def hour(self):
+        return _mask_to_set(self.hour_mask)
+
+    @property
+    def day_of_week(self):
+        return _mask_to_set(self.day_of_week_mask)
+
+    def _is_empty(self):
+        return not (self.minute_mask and self.hour_mask and
+                    self.day_of_week_mask)
+
+    def _first_at_or_after(self, dt):
+        """Return the first fire time at or after the whole minute `dt`.
+
+        Rather than stepping minute by minute, each iteration jumps straight
+        to the next matching day, hour or minute, so this takes at most a
+        handful of iterations.
+
+        """
+        if self._is_empty():
+            return None
+
+        while True:
+            dow = _day_of_week(dt)
+            day = _next_bit(self.day_of_week_mask, dow)
+            if day is None:
+                day = _next_bit(self.day_of_week_mask, 0) + 7
+            if day != dow:
+                dt = _midnight(dt) + timedelta(days=day - dow)
+                continue
+
+            hour = _next_bit(self.hour_mask, dt.hour)
+            if hour is None:
+                dt = _midnight(dt) + ONE_DAY
+                continue
+            if hour != dt.hour:
+                dt = dt.replace(hour=hour, minute=0)
+
+            minute = _next_bit(self.minute_mask, dt.minute)
+            if minute is None:
+                dt = dt.replace(minute=0) + ONE_HOUR
+                continue
+
+            return dt.replace(minute=minute)
+
+    def _last_at_or_before(self, dt):
+        """Return the last fire time at or before the whole minute `dt`."""
+        if self._is_empty():
+            return None
+
+        while True:
+            dow = _day_of_week(dt)
+            day = _prev_bit(self.day_of_week_mask, dow)
+            if day is None:
+                day = _prev_bit(self.day_of_week_mask, 6) - 7
+            if day != dow:
+                dt = (_midnight(dt) - timedelta(days=dow - day)).replace(
+                        hour=23, minute=59)
+                continue
+
+            hour = _prev_bit(self.hour_mask, dt.hour)
+            if hour is None:
+                dt = _midnight(dt) - ONE_MINUTE
+                continue
+            if hour != dt.hour:
+                dt = dt.replace(hour=hour, minute=59)
+
+            minute = _prev_bit(self.minute_mask, dt.minute)
+            if minute is None:
+                dt = dt.replace(minute=0) - ONE_MINUTE
+                continue
+
+            return dt.replace(minute=minute)
+
+    def next_fire(self, after):
+        """Return the first fire time strictly after `after`."""
+        start = after.replace(second=0, microsecond=0) + ONE_MINUTE
+        return self._first_at_or_after(start)
+
+    def prev_fire(self, before):
+        """Return the last fire time strictly before `before`."""
+        start = before.replace(second=0, microsecond=0)
+        if start == before:
+            start -= ONE_MINUTE
+        return self._last_at_or_before(start)
+
+    def iter_fires(self, start, end):
+        """Yield every fire time `t` with start <= t < end, in order."""
+        fire = start.replace(second=0, microsecond=0)
+        if fire < start:
+            fire += ONE_MINUTE
+
+        fire = self._first_at_or_after(fire)
+        while fire is not None and fire < end:
+            yield fire
+            fire = self._first_at_or_after(fire + ONE_MINUTE)
 
     def __repr__(self):
         return "<cronspec: %s %s %s (m/h/d)>" % (self._orig_minute or "*",
@@ -241,4 +435,32 @@ class cronspec(object):
 
 
 def parse(spec):
-    return cronspec(*spec.split(' '))
+    """Parse a 'minute hour day_of_week' recurrence into a cronspec.
+
+    The returned cronspec is shared between callers and must not be
+    modified.
+    """
+    parsed = _SPEC_CACHE.get(spec)
+    if parsed is None:
+        parsed = cronspec(*spec.split(' '))
+        _SPEC_CACHE.set(spec, parsed)
+    return parsed
+
+
+def next_fires(specs, after):
+    """Return `spec.next_fire(after)` for every spec in `specs`.
+
+    Specs that expand to the same masks, however they were written, share
+    a single computation, so a batch of many tasks on a few common
+    schedules costs about as much as the distinct schedules alone.
+    """
+    computed = {}
+    fires = []
+    for spec in specs:
+        key = (spec.minute_mask, spec.hour_mask, spec.day_of_week_mask)
+        try:
+            fire = computed[key]
+        except KeyError:
+            fire = computed[key] = spec.next_fire(after)
+        fires.append(fire)
+    return fires
@@ -16,16 +16,23 @@
 #    limitations under the License.
 import datetime
 import logging
+import threading
 
+from sqlalchemy import and_
 from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import pool as sa_pool
+from sqlalchemy.engine import url as sa_url
 from sqlalchemy.orm import exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.sql.expression import literal_column
+from sqlalchemy.sql.expression import select
 
 from tempo import config
 from tempo.db import models
-from tempo.db import migration
 from tempo.openstack.common import cfg
 from tempo.openstack.common import exception as common_exception
 
@@ -39,15 +46,62 @@ db_opts = [
                     'database'),
     cfg.IntOpt('sql_idle_timeout',
                default=3600,
-               help='timeout before idle sql connections are reaped')
+               help='timeout before idle sql connections are reaped'),
+    cfg.IntOpt('sql_pool_size',
+               default=5,
+               help='Connections kept open in the pool; not used by SQLite'),
+    cfg.IntOpt('sql_max_overflow',
+               default=10,
+               help='Connections opened beyond sql_pool_size under load; not'
+                    ' used by SQLite'),
+    cfg.IntOpt('sql_pool_timeout',
+               default=30,
+               help='Seconds to wait for a connection from a full pool; not'
+                    ' used by SQLite'),
+    cfg.BoolOpt('sqlite_wal',
+                default=True,
+                help='Put SQLite databases in write-ahead log mode so reads'
+                     ' no longer wait on writes'),
+    cfg.IntOpt('archive_older_than',
+               default=30,
+               help='Days soft-deleted rows are kept in the live tables '
+                    'before being archived'),
+    cfg.IntOpt('archive_batch_size',
+               default=500,
+               help='Rows moved to the shadow tables per transaction'),
+    cfg.IntOpt('archive_interval',
+               default=3600,
+               help='Seconds between archive runs in tempo-api; 0 '
+                    'leaves archiving to tempo-manage purge')
 ]
 
 db_group = cfg.OptGroup(name='db', title='Database options')
 CFG.register_group(db_group)
 CFG.register_opts(db_opts, group=db_group)
 
+# Keeps IN clauses below SQLite's default limit of 999 bound parameters
+MAX_IN_ITEMS = 500
+
 _ENGINE = None
 
+# Connection counters of the engine's pool, see pool_stats
+_POOL_EVENTS = {'connect': 0, 'checkout': 0, 'checkin': 0}
+
+# Holds the session shared by a unit of work, see begin_session_scope
+_SCOPE = threading.local()
+
+
+def _count_pool_event(name):
+    def listener(*args):
+        _POOL_EVENTS[name] += 1
+    return listener
+
+
+def _set_sqlite_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
 
 def get_engine():
     """
@@ -58,16 +112,66 @@ def get_engine():
     """
     global _ENGINE
     if not _ENGINE:
-        _ENGINE = create_engine(CFG.db.sql_connection,
-                                pool_recycle=CFG.db.sql_idle_timeout)
+        url = sa_url.make_url(CFG.db.sql_connection)
+        kwargs = {'pool_recycle': CFG.db.sql_idle_timeout}
+        sqlite = url.drivername.startswith('sqlite')
+        if not sqlite:
+            kwargs.update(pool_size=CFG.db.sql_pool_size,
+                          max_overflow=CFG.db.sql_max_overflow,
+                          pool_timeout=CFG.db.sql_pool_timeout)
+
+        engine = create_engine(CFG.db.sql_connection, **kwargs)
+        for name in _POOL_EVENTS:
+            event.listen(engine, name, _count_pool_event(name))
+        # In-memory databases have no journal to switch
+        if sqlite and url.database and CFG.db.sqlite_wal:
+            event.listen(engine, 'connect', _set_sqlite_wal)
+        _ENGINE = engine
     return _ENGINE
 
 
+def reset_engine():
+    """
+    Forgets the engine and sessions without closing their connections, so a
+    forked process opens its own rather than sharing its parent's.
+    """
+    global _ENGINE, _MAKER, _SCOPE
+    _ENGINE = None
+    _MAKER = None
+    # Green threads get their own scopes once eventlet has patched threading
+    _SCOPE = threading.local()
+    for name in _POOL_EVENTS:
+        _POOL_EVENTS[name] = 0
+
+
+def pool_stats():
+    """
+    Returns the counts of connections opened, checked out and checked in
+    since the engine was created, along with the pool's current size,
+    checked in, checked out and overflow connections when it is a
+    QueuePool, which SQLite doesn't use.
+    """
+    pool = get_engine().pool
+    stats = dict(_POOL_EVENTS)
+    if isinstance(pool, sa_pool.QueuePool):
+        stats.update(size=pool.size(), checkedin=pool.checkedin(),
+                     checkedout=pool.checkedout(), overflow=pool.overflow())
+    return stats
+
+
 _MAKER = None
 
 
 def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session"""
+    """
+    Helper method to grab session
+
+    Within a session scope the scope's session is returned instead.
+    """
+    session = getattr(_SCOPE, 'session', None)
+    if session is not None:
+        return session
+
     global _MAKER
     if not _MAKER:
         _MAKER = sessionmaker(bind=get_engine(),
@@ -77,13 +181,136 @@ def get_session(autocommit=True, expire_on_commit=False):
     return session
 
 
-def task_get_all(session=None):
+def begin_session_scope():
+    """
+    Makes get_session return one shared session in the current thread until
+    end_session_scope, so that a unit of work like an API request uses a
+    single session rather than one per call.
+    """
+    _SCOPE.session = None
+    _SCOPE.session = get_session()
+
+
+def end_session_scope():
+    """Closes the session of the current scope"""
+    session = getattr(_SCOPE, 'session', None)
+    _SCOPE.session = None
+    if session is not None:
+        session.close()
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _filter_tasks(query, filters):
+    """
+    Narrows a query of tasks down by `filters`, a dict that may hold an
+    'instance_uuid', an 'action', or an 'updated_since' datetime matching
+    tasks created or updated since then.
+    """
+    if not filters:
+        return query
+
+    for name in ['instance_uuid', 'action']:
+        if filters.get(name) is not None:
+            query = query.filter(getattr(models.Task, name) == filters[name])
+
+    since = filters.get('updated_since')
+    if since is not None:
+        # Rather than COALESCE(updated_at, created_at), which can't use
+        # an index
+        query = query.filter(or_(models.Task.updated_at >= since,
+                                 models.Task.created_at >= since))
+    return query
+
+
+def _task_get_marker_id(marker, session):
+    """
+    Returns the id of the task whose uuid is `marker`. Deleted tasks count,
+    so a listing can go on after the last task of a page was deleted.
+    """
+    row = session.query(models.Task.id).\
+                  filter_by(uuid=marker).\
+                  order_by(models.Task.deleted, models.Task.id.desc()).\
+                  first()
+    if row is None:
+        raise common_exception.NotFound("No task found with UUID %s" %
+                                        marker)
+    return row.id
+
+
+def task_get_all(marker=None, limit=None, filters=None, session=None):
+    """
+    Returns tasks ordered by id, optionally starting after the task whose
+    uuid is `marker` and returning at most `limit` of them. See
+    `_filter_tasks` for `filters`.
+    """
     if not session:
         session = get_session()
 
-    return session.query(models.Task).\
-                   filter_by(deleted=False).\
-                   all()
+    query = session.query(models.Task).\
+                    filter_by(deleted=False).\
+                    order_by(models.Task.id)
+    query = _filter_tasks(query, filters)
+
+    if marker is not None:
+        query = query.filter(models.Task.id > _task_get_marker_id(marker,
+                                                                  session))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
+
+
+def task_iter_batches(batch_size=1000, columns=None, marker=None,
+                      filters=None, session=None):
+    """
+    Yields lists of at most `batch_size` tasks ordered by id. Each batch is
+    read with its own query that picks up after the last id of the previous
+    one, so only one batch is held in memory at a time.
+
+    Tasks are plain rows holding `columns`, every column of the tasks table
+    by default; `id` is always included. `marker` is the uuid of the task to
+    start after, and `filters` are applied as by `task_get_all`.
+    """
+    if not session:
+        session = get_session()
+
+    if columns is None:
+        columns = [column.name for column in models.Task.__table__.columns]
+    elif 'id' not in columns:
+        columns = ['id'] + list(columns)
+    entities = [getattr(models.Task, name) for name in columns]
+
+    last_id = None
+    if marker is not None:
+        last_id = _task_get_marker_id(marker, session)
+
+    while True:
+        query = session.query(*entities).\
+                        filter(models.Task.deleted == False)
+        query = _filter_tasks(query, filters)
+        if last_id is not None:
+            query = query.filter(models.Task.id > last_id)
+        rows = query.order_by(models.Task.id).limit(batch_size).all()
+
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+
+def task_iter_all(batch_size=1000, columns=None, marker=None, session=None):
+    """Yields tasks one at a time; see `task_iter_batches`"""
+    for rows in task_iter_batches(batch_size=batch_size, columns=columns,
+                                  marker=marker, session=session):
+        for row in rows:
+            yield row
 
 
 def task_get(task_uuid, session=None):
@@ -104,13 +331,15 @@ def task_create_or_update(task_uuid, values, session=None):
     if not session:
         session = get_session()
 
-    try:
-        task_ref = task_get(task_uuid, session=session)
-    except common_exception.NotFound:
-        task_ref = models.Task()
+    with session.begin(subtransactions=True):
+        try:
+            task_ref = task_get(task_uuid, session=session)
+        except common_exception.NotFound:
+            task_ref = models.Task()
 
-    task_ref.update(values)
-    task_ref.save(session=session)
+        task_ref.update(values)
+        task_ref.save(session=session)
+        _task_change_record([task_uuid], False, session)
     return task_ref
 
 
@@ -121,10 +350,149 @@ def task_delete(task_uuid, session=None):
     with session.begin():
         task_ref = task_get(task_uuid, session=session)
         task_ref.delete(session=session)
+        _task_change_record([task_uuid], True, session)
+
+        session.query(models.TaskParameter).\
+                filter_by(task_uuid=task_uuid).\
+                filter_by(deleted=False).\
+                update({'deleted': True,
+                        'deleted_at': datetime.datetime.utcnow(),
+                        'updated_at': literal_column('updated_at')},
+                       synchronize_session=False)
+
 
-        orig_params = task_parameter_get_all_by_task_uuid(task_uuid)
-        for key in orig_params:
-            task_parameter_delete(task_uuid, key, session=session)
+def task_delete_by_instance(instance_uuid, session=None):
+    """
+    Deletes every task of an instance along with their parameters, with one
+    UPDATE per table and batch of MAX_IN_ITEMS tasks.
+
+    The tasks are locked as they're read and only those are deleted, so a
+    task created meanwhile is neither deleted nor missing from the result.
+
+    :returns: the uuids of the tasks that were deleted
+    """
+    if not session:
+        session = get_session()
+
+    now = datetime.datetime.utcnow()
+    with session.begin():
+        live_tasks = session.query(models.Task.uuid).\
+                             filter_by(instance_uuid=instance_uuid).\
+                             filter_by(deleted=False).\
+                             with_lockmode('update')
+        task_uuids = [uuid for (uuid,) in live_tasks.all()]
+        if not task_uuids:
+            return []
+
+        for chunk in _chunks(task_uuids, MAX_IN_ITEMS):
+            session.query(models.TaskParameter).\
+                    filter(models.TaskParameter.task_uuid.in_(chunk)).\
+                    filter_by(deleted=False).\
+                    update({'deleted': True,
+                            'deleted_at': now,
+                            'updated_at': literal_column('updated_at')},
+                           synchronize_session=False)
+            session.query(models.Task).\
+                    filter(models.Task.uuid.in_(chunk)).\
+                    filter_by(deleted=False).\
+                    update({'deleted': True, 'deleted_at': now},
+                           synchronize_session=False)
+        _task_change_record(task_uuids, True, session)
+
+    return task_uuids
+
+
+def _task_get_live_uuids(task_uuids, session):
+    live = set()
+    for chunk in _chunks(task_uuids, MAX_IN_ITEMS):
+        rows = session.query(models.Task.uuid).\
+                       filter(models.Task.uuid.in_(chunk)).\
+                       filter_by(deleted=False).\
+                       all()
+        live.update(uuid for (uuid,) in rows)
+    return live
+
+
+def task_bulk_update(tasks, params=None, delete_uuids=None, session=None):
+    """
+    Creates or updates many tasks and deletes others in a single
+    transaction, using one batched statement per kind of change.
+
+    :param tasks: list of task value dicts, each including 'uuid'
+    :param params: dict of (params, delete) tuples keyed by task uuid, as
+                   taken by task_parameter_update
+    :param delete_uuids: uuids of the tasks to delete
+    :returns: tuple of the created or updated task refs, in the order
+              given, and the uuids of the tasks that were deleted
+    """
+    if not session:
+        session = get_session()
+
+    params = params or {}
+    delete_uuids = delete_uuids or []
+    tasks_table = models.Task.__table__
+    columns = ['instance_uuid', 'cron_schedule', 'action']
+    now = datetime.datetime.utcnow()
+
+    with session.begin():
+        existing = _task_get_live_uuids(
+                [values['uuid'] for values in tasks], session)
+
+        inserts = []
+        updates = []
+        for values in tasks:
+            if values['uuid'] in existing:
+                row = dict(('b_%s' % c, values[c]) for c in columns)
+                row['b_uuid'] = values['uuid']
+                updates.append(row)
+            else:
+                row = dict((c, values[c]) for c in columns)
+                row.update(uuid=values['uuid'], created_at=now,
+                           deleted=False)
+                inserts.append(row)
+
+        if inserts:
+            session.execute(tasks_table.insert(), inserts)
+
+        if updates:
+            stmt = tasks_table.update().\
+                    where(and_(tasks_table.c.uuid == bindparam('b_uuid'),
+                               tasks_table.c.deleted == False)).\
+                    values(dict((c, bindparam('b_%s' % c))
+                                for c in columns))
+            session.execute(stmt, updates)
+
+        deleted = _task_get_live_uuids(delete_uuids, session)
+        for chunk in _chunks(deleted, MAX_IN_ITEMS):
+            session.query(models.Task).\
+                    filter(models.Task.uuid.in_(chunk)).\
+                    filter_by(deleted=False).\
+                    update({'deleted': True, 'deleted_at': now},
+                           synchronize_session=False)
+            session.query(models.TaskParameter).\
+                    filter(models.TaskParameter.task_uuid.in_(chunk)).\
+                    filter_by(deleted=False).\
+                    update({'deleted': True,
+                            'deleted_at': now,
+                            'updated_at': literal_column('updated_at')},
+                           synchronize_session=False)
+
+        _task_parameter_update_many(params, session)
+        _task_change_record([values['uuid'] for values in tasks], False,
+                            session)
+        _task_change_record(deleted, True, session)
+
+        task_refs = {}
+        for chunk in _chunks([values['uuid'] for values in tasks],
+                             MAX_IN_ITEMS):
+            rows = session.query(models.Task).\
+                           filter(models.Task.uuid.in_(chunk)).\
+                           filter_by(deleted=False).\
+                           all()
+            task_refs.update((task_ref.uuid, task_ref) for task_ref in rows)
+
+    return ([task_refs[values['uuid']] for values in tasks],
+            [uuid for uuid in delete_uuids if uuid in deleted])
 
 
 def task_parameter_get_all_by_task_uuid(task_uuid, session=None):
@@ -143,56 +511,283 @@ def task_parameter_get_all_by_task_uuid(task_uuid, session=None):
     return params
 
 
-def task_parameter_delete(task_uuid, key, session=None):
+def task_parameter_get_all_by_task_uuids(task_uuids, session=None):
+    """Returns the parameters of several tasks, keyed by task uuid"""
     if not session:
         session = get_session()
 
-    session.query(models.TaskParameter).\
-            filter_by(task_uuid=task_uuid).\
-            filter_by(deleted=False).\
-            filter_by(key=key).\
-            update({'deleted': True,
-                    'deleted_at': datetime.datetime.utcnow(),
-                    'updated_at': literal_column('updated_at')})
+    params = dict((task_uuid, {}) for task_uuid in task_uuids)
+    if not params:
+        return params
+
+    for chunk in _chunks(params.keys(), MAX_IN_ITEMS):
+        rows = session.query(models.TaskParameter.task_uuid,
+                             models.TaskParameter.key,
+                             models.TaskParameter.value).\
+                       filter(models.TaskParameter.task_uuid.in_(chunk)).\
+                       filter_by(deleted=False).\
+                       all()
 
+        for task_uuid, key, value in rows:
+            params[task_uuid][key] = value
 
-def _task_parameter_get_item(task_uuid, key, session=None):
+    return params
+
+
+def task_parameter_delete(task_uuid, key, session=None):
     if not session:
         session = get_session()
 
-    return session.query(models.TaskParameter).\
-            filter_by(task_uuid=task_uuid).\
-            filter_by(deleted=False).\
-            filter_by(key=key).\
-            first()
+    with session.begin(subtransactions=True):
+        session.query(models.TaskParameter).\
+                filter_by(task_uuid=task_uuid).\
+                filter_by(deleted=False).\
+                filter_by(key=key).\
+                update({'deleted': True,
+                        'deleted_at': datetime.datetime.utcnow(),
+                        'updated_at': literal_column('updated_at')})
+        _task_change_record([task_uuid], False, session)
 
 
 def task_parameter_update(task_uuid, params, delete=False, session=None):
+    """
+    Sets the given parameters of a task, and with `delete` removes the ones
+    not given, in a single transaction.
+    """
     if not session:
         session = get_session()
 
-    # Set existing parameters to deleted if delete argument is True
-    orig_params = task_parameter_get_all_by_task_uuid(task_uuid)
+    with session.begin(subtransactions=True):
+        _task_parameter_update_many({task_uuid: (params, delete)}, session)
+        _task_change_record([task_uuid], False, session)
+
+    return params
+
 
-    if delete:
-        for key in orig_params:
-            if key not in params:
-                task_parameter_delete(task_uuid, key, session=session)
+def _task_parameter_update_many(params, session):
+    """
+    Applies task_parameter_update to several tasks at once.
 
-    # Now update all existing items with new values, or create new param
-    # objects
-    for key, value in params.iteritems():
-        if key in orig_params:
-            param_ref = _task_parameter_get_item(
-                    task_uuid, key, session=session)
-            if param_ref is None:
-                continue
-        else:
-            param_ref = models.TaskParameter()
-            param_ref.key = key
-            param_ref.task_uuid = task_uuid
+    The current parameters of every task are read with one query and the
+    differences are worked out in memory. New parameters are then written
+    with one batched INSERT, changed values with one batched UPDATE and
+    removed keys with an UPDATE ... WHERE key IN (...) per task. Must be
+    called inside a transaction.
 
-        param_ref.value = value
-        param_ref.save(session=session)
+    :param params: dict of (params, delete) tuples keyed by task uuid
+    """
+    if not params:
+        return
+
+    params_table = models.TaskParameter.__table__
+    now = datetime.datetime.utcnow()
+    orig_params = task_parameter_get_all_by_task_uuids(params.keys(),
+                                                       session=session)
+
+    inserts = []
+    updates = []
+    deletes = {}
+    for task_uuid, (new_params, delete) in params.iteritems():
+        orig = orig_params[task_uuid]
+        if delete:
+            removed = [key for key in orig if key not in new_params]
+            if removed:
+                deletes[task_uuid] = removed
+
+        for key, value in new_params.iteritems():
+            if key not in orig:
+                inserts.append({'task_uuid': task_uuid, 'key': key,
+                                'value': value, 'created_at': now,
+                                'deleted': False})
+            elif orig[key] != value:
+                updates.append({'b_task_uuid': task_uuid, 'b_key': key,
+                                'b_value': value})
+
+    if inserts:
+        session.execute(params_table.insert(), inserts)
+
+    if updates:
+        stmt = params_table.update().\
+                where(and_(
+                    params_table.c.task_uuid == bindparam('b_task_uuid'),
+                    params_table.c.key == bindparam('b_key'),
+                    params_table.c.deleted == False)).\
+                values(value=bindparam('b_value'))
+        session.execute(stmt, updates)
+
+    for task_uuid, keys in deletes.iteritems():
+        for chunk in _chunks(keys, MAX_IN_ITEMS):
+            stmt = params_table.update().\
+                    where(and_(params_table.c.task_uuid == task_uuid,
+                               params_table.c.key.in_(chunk),
+                               params_table.c.deleted == False)).\
+                    values(deleted=True, deleted_at=now,
+                           updated_at=literal_column('updated_at'))
+            session.execute(stmt)
+
+
+def _task_change_record(task_uuids, deleted, session):
+    """
+    Logs writes to tasks for the change feed, in the caller's transaction.
 
-    return params
+    Ids are taken from the task_change_sequence row rather than assigned by
+    the database. Bumping it locks the row until the caller commits, so
+    writers take ids in the order they commit and a reader that has seen a
+    change never misses an earlier one committed after it.
+    """
+    if not task_uuids:
+        return
+    sequence = models.TaskChangeSequence.__table__
+    result = session.execute(
+            sequence.update().
+                     where(sequence.c.id == 1).
+                     values(last_id=sequence.c.last_id + len(task_uuids)))
+    if not result.rowcount:
+        # Databases created without migrations start without the row
+        session.execute(sequence.insert(),
+                        {'id': 1, 'last_id': len(task_uuids)})
+    last_id = session.execute(select([sequence.c.last_id]).
+                              where(sequence.c.id == 1)).scalar()
+
+    now = datetime.datetime.utcnow()
+    first_id = last_id - len(task_uuids) + 1
+    session.execute(models.TaskChange.__table__.insert(),
+                    [{'id': first_id + n, 'task_uuid': task_uuid,
+                      'deleted': deleted, 'created_at': now}
+                     for n, task_uuid in enumerate(task_uuids)])
+
+
+def task_change_get_since(since, limit=None, session=None):
+    """
+    Returns the changes logged after the change whose id is `since`,
+    oldest first and at most `limit` of them.
+    """
+    if not session:
+        session = get_session()
+
+    query = session.query(models.TaskChange).\
+                    filter(models.TaskChange.id > since).\
+                    order_by(models.TaskChange.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def task_change_get_last_id(session=None):
+    """
+    Returns the id of the last change ever logged, or 0 before the first.
+    Every write to a task raises it.
+    """
+    if not session:
+        session = get_session()
+
+    sequence = models.TaskChangeSequence.__table__
+    return session.execute(select([sequence.c.last_id]).
+                           where(sequence.c.id == 1)).scalar() or 0
+
+
+def task_change_get_bounds(session=None):
+    """
+    Returns the ids of the oldest change still logged and of the last change
+    ever logged. The log holds every change between the two; when it is
+    empty the oldest is one past the last.
+    """
+    if not session:
+        session = get_session()
+
+    last_id = task_change_get_last_id(session=session)
+    first_id = session.query(func.min(models.TaskChange.id)).scalar()
+    if first_id is None:
+        first_id = last_id + 1
+    return first_id, last_id
+
+
+def task_get_all_by_uuids(task_uuids, session=None):
+    """Returns the live tasks among `task_uuids`, keyed by uuid"""
+    if not session:
+        session = get_session()
+
+    tasks = {}
+    for chunk in _chunks(task_uuids, MAX_IN_ITEMS):
+        rows = session.query(models.Task).\
+                       filter(models.Task.uuid.in_(chunk)).\
+                       filter_by(deleted=False).\
+                       all()
+        tasks.update((task_ref.uuid, task_ref) for task_ref in rows)
+    return tasks
+
+
+def archive_deleted_rows(older_than=None, max_rows=None, session=None):
+    """
+    Moves rows soft-deleted more than `older_than` days ago from the live
+    tables into their shadow tables, so that the live tables only hold
+    tombstones for a while.
+
+    Rows are moved in batches of `archive_batch_size`, each in its own short
+    transaction that copies the batch and deletes it by id, so no table
+    stays locked for long. With `max_rows` at most that many rows are moved
+    per table. Logged task changes of the same age are deleted.
+
+    :returns: dict of the number of rows archived, keyed by table name
+    """
+    if not session:
+        session = get_session()
+
+    if older_than is None:
+        older_than = CFG.db.archive_older_than
+    cutoff = datetime.datetime.utcnow() - \
+             datetime.timedelta(days=older_than)
+    batch_size = max(CFG.db.archive_batch_size, 1)
+
+    archived = {}
+    for model, shadow in models.SHADOWED_MODELS:
+        table = model.__table__
+        count = 0
+        while max_rows is None or count < max_rows:
+            limit = batch_size
+            if max_rows is not None:
+                limit = min(limit, max_rows - count)
+
+            with session.begin():
+                rows = session.execute(
+                        table.select().
+                              where(and_(table.c.deleted == True,
+                                         table.c.deleted_at < cutoff)).
+                              order_by(table.c.id).
+                              limit(limit)).fetchall()
+                if rows:
+                    session.execute(shadow.insert(),
+                                    [dict(row) for row in rows])
+                for chunk in _chunks([row.id for row in rows], MAX_IN_ITEMS):
+                    session.execute(table.delete().
+                                          where(table.c.id.in_(chunk)))
+
+            count += len(rows)
+            if len(rows) < limit:
+                break
+        archived[table.name] = count
+
+    # The change log is trimmed to the same age
+    changes = models.TaskChange.__table__
+    count = 0
+    while max_rows is None or count < max_rows:
+        limit = batch_size
+        if max_rows is not None:
+            limit = min(limit, max_rows - count)
+
+        with session.begin():
+            ids = [row.id for row in session.execute(
+                    select([changes.c.id]).
+                    where(changes.c.created_at < cutoff).
+                    order_by(changes.c.id).
+                    limit(limit)).fetchall()]
+            for chunk in _chunks(ids, MAX_IN_ITEMS):
+                session.execute(changes.delete().
+                                        where(changes.c.id.in_(chunk)))
+
+        count += len(ids)
+        if len(ids) < limit:
+            break
+    archived[changes.name] = count
+
+    return archived
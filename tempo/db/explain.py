@@ -0,0 +1,116 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+Query plans of the hot queries in tempo.db.api, for `tempo-manage explain`.
+"""
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement
+from sqlalchemy.sql.expression import Executable
+from sqlalchemy.sql.expression import select
+
+from tempo.db import api as db_api
+from tempo.db import models
+
+SAMPLE_UUID = '00000000-0000-0000-0000-000000000000'
+SAMPLE_DATE = datetime.datetime(2012, 1, 1)
+
+_tasks = models.Task.__table__
+_params = models.TaskParameter.__table__
+
+# (name, statement) of the lookups the API, cron, scheduler and worker run
+# most often. They're built from the tables so identifiers are quoted for
+# the dialect, 'key' being reserved in MySQL.
+HOT_QUERIES = [
+    ('task_get',
+     select([_tasks]).
+           where(and_(_tasks.c.uuid == SAMPLE_UUID,
+                      _tasks.c.deleted == False))),
+    ('task_iter_batches',
+     select([_tasks.c.id, _tasks.c.uuid, _tasks.c.cron_schedule]).
+           where(and_(_tasks.c.deleted == False, _tasks.c.id > 0)).
+           order_by(_tasks.c.id).
+           limit(1000)),
+    ('task_iter_batches by instance_uuid',
+     select([_tasks.c.id, _tasks.c.uuid]).
+           where(and_(_tasks.c.instance_uuid == SAMPLE_UUID,
+                      _tasks.c.deleted == False, _tasks.c.id > 0)).
+           order_by(_tasks.c.id).
+           limit(1000)),
+    ('task_iter_batches by updated_since',
+     select([_tasks.c.id, _tasks.c.uuid]).
+           where(and_(_tasks.c.deleted == False, _tasks.c.id > 0,
+                      or_(_tasks.c.updated_at >= SAMPLE_DATE,
+                          _tasks.c.created_at >= SAMPLE_DATE))).
+           order_by(_tasks.c.id).
+           limit(1000)),
+    ('task_parameter_get_all_by_task_uuids',
+     select([_params.c.task_uuid, _params.c.key, _params.c.value]).
+           where(and_(_params.c.task_uuid.in_([SAMPLE_UUID, SAMPLE_UUID]),
+                      _params.c.deleted == False))),
+    ('task_parameter_update',
+     select([_params.c.id]).
+           where(and_(_params.c.task_uuid == SAMPLE_UUID,
+                      _params.c.key == 'rotation',
+                      _params.c.deleted == False))),
+]
+
+EXPLAIN_PREFIX = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class _Explain(Executable, ClauseElement):
+    """EXPLAIN of a statement, compiled for the engine's dialect"""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = EXPLAIN_PREFIX.get(compiler.dialect.name, 'EXPLAIN ')
+    return prefix + compiler.process(element.statement, **kw)
+
+
+def explain(engine=None):
+    """Returns a list of (name, SQL, plan rows) for every hot query"""
+    engine = engine or db_api.get_engine()
+
+    plans = []
+    for name, statement in HOT_QUERIES:
+        sql = str(statement.compile(dialect=engine.dialect))
+        rows = engine.execute(_Explain(statement)).fetchall()
+        plans.append((name, sql, [tuple(row) for row in rows]))
+    return plans
+
+
+def report(engine=None):
+    """Renders the plans of the hot queries as text"""
+    lines = []
+    for name, sql, rows in explain(engine):
+        lines.append('== %s' % name)
+        lines.append(sql)
+        for row in rows:
+            lines.append('    ' + ' | '.join(str(column) for column in row))
+        lines.append('')
+    return '\n'.join(lines)
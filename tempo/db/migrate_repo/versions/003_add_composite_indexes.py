@@ -0,0 +1,90 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+from sqlalchemy.schema import (Index, MetaData, Table)
+
+logger = logging.getLogger('tempo.db.migrate_repo.versions.003')
+
+meta = MetaData()
+
+# Live parameters are unique per task and key. Deleted rows are kept, so
+# only databases with partial indexes can enforce it.
+LIVE_PARAM_INDEX = 'uq_task_parameters_live_task_uuid_key'
+
+PARTIAL_UNIQUE_INDEX_DDL = {
+    'postgresql': 'CREATE UNIQUE INDEX %s ON task_parameters'
+                  ' (task_uuid, key) WHERE NOT deleted',
+    'sqlite': 'CREATE UNIQUE INDEX %s ON task_parameters'
+              ' (task_uuid, key) WHERE deleted = 0',
+}
+
+
+def _indexes(tasks, task_params):
+    """The composite indexes, matching how db.api looks rows up"""
+    return [
+        # Listing and keyset pagination: WHERE deleted = ? AND id > ?
+        # ORDER BY id
+        Index('ix_tasks_deleted_id', tasks.c.deleted, tasks.c.id),
+        # Parameter lookups: WHERE task_uuid IN (...) AND deleted = ?
+        # [AND key = ?]
+        Index('ix_task_parameters_task_uuid_deleted_key',
+              task_params.c.task_uuid, task_params.c.deleted,
+              task_params.c.key),
+    ]
+
+
+def _superseded_indexes(tasks, task_params):
+    """Single column indexes the composite ones make redundant"""
+    return [
+        Index('ix_tasks_deleted', tasks.c.deleted),
+        Index('ix_task_parameters_task_uuid', task_params.c.task_uuid),
+        Index('ix_task_parameters_deleted', task_params.c.deleted),
+    ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    tasks = Table('tasks', meta, autoload=True)
+    task_params = Table('task_parameters', meta, autoload=True)
+
+    for index in _indexes(tasks, task_params):
+        index.create(migrate_engine)
+    for index in _superseded_indexes(tasks, task_params):
+        index.drop(migrate_engine)
+
+    ddl = PARTIAL_UNIQUE_INDEX_DDL.get(migrate_engine.name)
+    if ddl is None:
+        logger.warn("%s has no partial indexes; live task parameters won't"
+                    " be checked for uniqueness" % migrate_engine.name)
+    else:
+        migrate_engine.execute(ddl % LIVE_PARAM_INDEX)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    tasks = Table('tasks', meta, autoload=True)
+    task_params = Table('task_parameters', meta, autoload=True)
+
+    if migrate_engine.name in PARTIAL_UNIQUE_INDEX_DDL:
+        migrate_engine.execute('DROP INDEX %s' % LIVE_PARAM_INDEX)
+
+    for index in _superseded_indexes(tasks, task_params):
+        index.create(migrate_engine)
+    for index in _indexes(tasks, task_params):
+        index.drop(migrate_engine)
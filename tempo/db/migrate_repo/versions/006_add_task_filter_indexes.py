@@ -0,0 +1,51 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy.schema import (Index, MetaData, Table)
+
+meta = MetaData()
+
+
+def _indexes(tasks):
+    """Indexes behind the filters of GET /periodic_tasks"""
+    return [
+        # WHERE instance_uuid = ? AND deleted = ? AND id > ? ORDER BY id
+        Index('ix_tasks_instance_uuid_deleted_id', tasks.c.instance_uuid,
+              tasks.c.deleted, tasks.c.id),
+        # WHERE action = ? AND deleted = ? AND id > ? ORDER BY id
+        Index('ix_tasks_action_deleted_id', tasks.c.action,
+              tasks.c.deleted, tasks.c.id),
+        # WHERE updated_at >= ? OR created_at >= ?
+        Index('ix_tasks_updated_at', tasks.c.updated_at),
+        Index('ix_tasks_created_at', tasks.c.created_at),
+    ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    tasks = Table('tasks', meta, autoload=True)
+
+    for index in _indexes(tasks):
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    tasks = Table('tasks', meta, autoload=True)
+
+    for index in _indexes(tasks):
+        index.drop(migrate_engine)
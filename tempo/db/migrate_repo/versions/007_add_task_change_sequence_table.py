@@ -0,0 +1,51 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import func
+from sqlalchemy.schema import (Column, MetaData, Table)
+from sqlalchemy.sql.expression import select
+
+from tempo.db.migrate_repo.schema import (Integer, create_tables,
+                                          drop_tables)
+
+
+meta = MetaData()
+
+# A single row holding the id of the last task change logged. Writers bump
+# it to take their ids, which holds a lock on it until they commit, so ids
+# become visible in order; and unlike the ids in task_changes it is never
+# purged.
+task_change_sequence = Table('task_change_sequence', meta,
+    Column('id', Integer(), primary_key=True, nullable=False),
+    Column('last_id', Integer(), nullable=False, default=0),
+    mysql_engine='InnoDB')
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    task_changes = Table('task_changes', meta, autoload=True)
+    create_tables([task_change_sequence])
+
+    last_id = migrate_engine.execute(
+            select([func.max(task_changes.c.id)])).scalar()
+    migrate_engine.execute(task_change_sequence.insert(),
+                           id=1, last_id=last_id or 0)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    drop_tables([task_change_sequence])
@@ -20,7 +20,7 @@ SQLAlchemy models for tempo data.
 
 import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Table
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, object_mapper
@@ -118,3 +118,41 @@ class TaskParameter(BASE, TempoBase):
                         primaryjoin='and_('
                                 'TaskParameter.task_uuid == Task.uuid,'
                                 'TaskParameter.deleted == False)')
+
+
+class TaskChange(BASE):
+    """Records a write to a task, for the change feed"""
+    __tablename__ = 'task_changes'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'sqlite_autoincrement': True}
+
+    id = Column(Integer, primary_key=True)
+    task_uuid = Column(String(36), nullable=False)
+    deleted = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow,
+                        nullable=False, index=True)
+
+
+class TaskChangeSequence(BASE):
+    """The id of the last task change logged, in a single row"""
+    __tablename__ = 'task_change_sequence'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    id = Column(Integer, primary_key=True)
+    last_id = Column(Integer, default=0, nullable=False)
+
+
+def _shadow_table(model):
+    """
+    Returns the table soft-deleted rows of `model` are archived into, which
+    has the same columns but doesn't key on id.
+    """
+    columns = [Column(column.name, column.type, index=(column.name == 'id'))
+               for column in model.__table__.columns]
+    return Table('shadow_%s' % model.__tablename__, BASE.metadata, *columns)
+
+
+# Archived in this order, along with their shadow tables
+SHADOWED_MODELS = [
+    (TaskParameter, _shadow_table(TaskParameter)),
+    (Task, _shadow_table(Task)),
+]
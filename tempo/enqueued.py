@@ -0,0 +1,213 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+Resident publisher for tasks fired by the system crontab.
+
+`tempo-enqueue` hands the task to this daemon as one datagram on a Unix
+socket, so firing a task costs a socket write instead of starting an
+interpreter and connecting to the broker. The daemon publishes over a
+connection it keeps open and answers REPLY_OK once the task is published,
+or REPLY_ERROR once it has given up, in which case tempo-enqueue publishes
+the task itself.
+"""
+import errno
+import logging
+import os
+import socket
+import time
+
+from tempo import config
+from tempo import queue
+from tempo import snapshot
+from tempo.openstack.common import cfg
+
+logger = logging.getLogger('tempo.enqueued')
+
+CFG = config.CFG
+
+# Where tempo-enqueue looks for the daemon unless TEMPO_ENQUEUE_SOCKET is set
+DEFAULT_SOCKET_PATH = '/var/run/tempo/tempo-enqueued.sock'
+
+enqueued_opts = [
+    cfg.StrOpt('socket_path',
+               default=DEFAULT_SOCKET_PATH,
+               help='Unix socket tempo-enqueue sends tasks to'),
+    cfg.IntOpt('batch_size',
+               default=100,
+               help='Most tasks published at once'),
+    cfg.IntOpt('publish_attempts',
+               default=3,
+               help='Times a batch is published before tempo-enqueue is told'
+                    ' to publish its task itself; the delay between attempts'
+                    ' starts at a second and doubles'),
+    cfg.BoolOpt('daemonized',
+                default=False,
+                help='Run tempo-enqueued as a daemon')
+]
+
+enqueued_group = cfg.OptGroup(name='enqueued', title='Enqueue daemon options')
+CFG.register_group(enqueued_group)
+CFG.register_opts(enqueued_opts, group=enqueued_group)
+
+TOPIC = 'tempo.tasks'
+
+# Largest datagram accepted; a task snapshot is a few hundred bytes
+MAX_DATAGRAM = 65536
+
+# Answers sent back to tempo-enqueue; keep in sync with bin/tempo-enqueue
+REPLY_OK = 'ok'
+REPLY_ERROR = 'error'
+
+# Seconds before the second attempt at publishing a batch
+RETRY_DELAY = 1
+
+
+def parse_request(data):
+    """
+    Builds the task message from a datagram, which holds the arguments
+    tempo-enqueue was run with: a task uuid and optionally an encoded task
+    snapshot.
+    """
+    words = data.split()
+    message = dict(task_uuid=words[0])
+    if len(words) > 1:
+        message['task'] = snapshot.decode(words[1])
+    return message
+
+
+class EnqueueServer(object):
+    """Publishes the tasks received on a Unix datagram socket"""
+
+    def __init__(self, path, publisher=None, batch_size=100,
+                 publish_attempts=3):
+        self.path = path
+        self.publisher = publisher or queue.get_publisher()
+        self.batch_size = max(batch_size, 1)
+        self.publish_attempts = max(publish_attempts, 1)
+        self.sock = None
+
+    def bind(self):
+        if os.path.exists(self.path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+
+    def _receive(self):
+        """
+        Waits for a datagram, then takes whatever else is already queued.
+        Returns (data, sender address) pairs.
+        """
+        batch = [self.sock.recvfrom(MAX_DATAGRAM)]
+        self.sock.setblocking(False)
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self.sock.recvfrom(MAX_DATAGRAM))
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        finally:
+            self.sock.setblocking(True)
+        return batch
+
+    def _reply(self, sender, reply):
+        if not sender:
+            # The sender didn't bind an address to be answered on
+            return
+        try:
+            self.sock.sendto(reply, sender)
+        except socket.error:
+            # The sender gave up waiting
+            pass
+
+    def _publish(self, messages):
+        """
+        Publishes a batch, trying `publish_attempts` times. Returns whether
+        it was published.
+        """
+        delay = RETRY_DELAY
+        for attempt in xrange(1, self.publish_attempts + 1):
+            try:
+                self.publisher.publish_batch(messages)
+                return True
+            except Exception as e:
+                logger.warn("Failed to publish tasks (attempt %(attempt)d):"
+                            " %(e)s" % locals())
+            if attempt < self.publish_attempts:
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def serve_once(self):
+        messages = []
+        senders = []
+        for data, sender in self._receive():
+            try:
+                messages.append((TOPIC, parse_request(data)))
+            except Exception as e:
+                logger.error("Invalid enqueue request %(data)r: %(e)s" %
+                             locals())
+                self._reply(sender, REPLY_ERROR)
+                continue
+            senders.append(sender)
+
+        if not messages:
+            return 0
+        published = self._publish(messages)
+        if not published:
+            task_uuids = [message['task_uuid'] for topic, message in messages]
+            logger.error("Failed to publish tasks %(task_uuids)s, leaving"
+                         " them to tempo-enqueue" % locals())
+
+        for sender in senders:
+            self._reply(sender, REPLY_OK if published else REPLY_ERROR)
+        return len(messages) if published else 0
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def _run():
+    server = EnqueueServer(CFG.enqueued.socket_path,
+                           batch_size=CFG.enqueued.batch_size,
+                           publish_attempts=CFG.enqueued.publish_attempts)
+    server.bind()
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+def start():
+    """Starts up the enqueue daemon"""
+    if CFG.enqueued.daemonized:
+        import daemon
+        with daemon.DaemonContext():
+            _run()
+    else:
+        _run()
@@ -1,5 +1,10 @@
+import atexit
 import datetime
 import logging
+import os
+import Queue
+import threading
+import time
 import uuid
 
 from tempo import config
@@ -17,13 +22,29 @@ notifier_opts = [
                help='Topic used for rabbit notifications'),
     cfg.StrOpt('level',
                default='INFO',
-               help='What priority should be used for notifications')
+               help='What priority should be used for notifications'),
+    cfg.BoolOpt('async_dispatch',
+                default=True,
+                help='Send notifications from a background thread'),
+    cfg.IntOpt('queue_size',
+               default=1000,
+               help='Notifications buffered for the background thread before'
+                    ' new ones are dropped'),
+    cfg.IntOpt('batch_size',
+               default=100,
+               help='Most notifications the background thread sends at once')
 ]
 
 notifier_group = cfg.OptGroup(name='notifier', title='Notifier options')
 CFG.register_group(notifier_group)
 CFG.register_opts(notifier_opts, group=notifier_group)
 
+logger = logging.getLogger('tempo.notifier')
+
+_LOCK = threading.Lock()
+_DRIVERS = {}
+_DISPATCHER = None
+
 WARN = 'WARN'
 INFO = 'INFO'
 ERROR = 'ERROR'
@@ -76,8 +97,20 @@ def notify(publisher_id, event_type, priority, payload):
                payload=payload,
                timestamp=str(datetime.datetime.utcnow()))
 
-    driver = _get_notifier_driver(CFG.notifier.driver)()
-    driver.notify(msg)
+    if CFG.notifier.async_dispatch:
+        _get_dispatcher().put(msg)
+    else:
+        _get_driver(CFG.notifier.driver).notify(msg)
+
+
+def flush(timeout=5):
+    """Waits for buffered notifications to be sent"""
+    dispatcher = _DISPATCHER
+    if dispatcher is not None and dispatcher.pid == os.getpid():
+        dispatcher.flush(timeout)
+
+
+atexit.register(flush)
 
 
 class Notifier(object):
@@ -87,6 +120,10 @@ class Notifier(object):
     def notify(self, msg):
         raise NotImplementedError()
 
+    def notify_batch(self, msgs):
+        for msg in msgs:
+            self.notify(msg)
+
 
 class NoopNotifier(Notifier):
     def notify(self, msg):
@@ -108,9 +145,10 @@ class LoggingNotifier(Notifier):
         logging_level = str2log_level[CFG.notifier.level]
         self.logger = logging.getLogger('tempo.notifier.logging_notifier')
         self.logger.setLevel(logging_level)
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging_level)
-        self.logger.addHandler(stream_handler)
+        if not self.logger.handlers:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging_level)
+            self.logger.addHandler(stream_handler)
 
     def notify(self, msg):
         self.logger.debug(msg)
@@ -119,14 +157,20 @@ class LoggingNotifier(Notifier):
 class RabbitNotifier(Notifier):
     def __init__(self, **kwargs):
         super(RabbitNotifier, self).__init__(**kwargs)
-        self.connection = queue.get_connection()
+        self.publisher = queue.get_publisher()
 
     def notify(self, message):
         priority = message.get('priority', CFG.notifier.level)
         topic = "%s.%s" % (CFG.notifier.rabbit_topic, priority)
-        queue = self.connection.SimpleQueue(topic)
-        queue.put(message, serializer="json")
-        queue.close()
+        self.publisher.publish(topic, message)
+
+    def notify_batch(self, messages):
+        batch = []
+        for message in messages:
+            priority = message.get('priority', CFG.notifier.level)
+            topic = "%s.%s" % (CFG.notifier.rabbit_topic, priority)
+            batch.append((topic, message))
+        self.publisher.publish_batch(batch)
 
 
 def _get_notifier_driver(driver):
@@ -136,3 +180,80 @@ def _get_notifier_driver(driver):
         return RabbitNotifier
     else:
         return NoopNotifier
+
+
+def _get_driver(name):
+    with _LOCK:
+        driver = _DRIVERS.get(name)
+        if driver is None:
+            driver = _DRIVERS[name] = _get_notifier_driver(name)()
+    return driver
+
+
+def _get_dispatcher():
+    global _DISPATCHER
+    with _LOCK:
+        # A forked child doesn't inherit its parent's dispatcher thread
+        if _DISPATCHER is None or _DISPATCHER.pid != os.getpid():
+            _DISPATCHER = _Dispatcher(CFG.notifier.queue_size,
+                                      CFG.notifier.batch_size)
+    return _DISPATCHER
+
+
+class _Dispatcher(object):
+    """
+    Buffers notifications in a bounded queue and sends them to the driver in
+    batches from a background thread, dropping them while the queue is full
+    rather than blocking the caller.
+    """
+
+    def __init__(self, queue_size, batch_size):
+        self.pid = os.getpid()
+        self.batch_size = max(batch_size, 1)
+        self.dropped = 0
+        self._queue = Queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                logger.warn('Notification queue is full, dropping'
+                            ' notifications')
+        else:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                logger.warn('Dropped %(dropped)d notifications' % locals())
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                _get_driver(CFG.notifier.driver).notify_batch(batch)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                for msg in batch:
+                    self._queue.task_done()
+
+    def flush(self, timeout):
+        """Waits up to `timeout` seconds for the queue to be sent"""
+        pending = self._queue
+        deadline = time.time() + timeout
+        with pending.all_tasks_done:
+            while pending.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                pending.all_tasks_done.wait(remaining)
+        return True
@@ -14,13 +14,17 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
-from kombu.connection import BrokerConnection
+import logging
+import os
+import threading
 
 from tempo import config
 from tempo.openstack.common import cfg
 
 CFG = config.CFG
 
+logger = logging.getLogger('tempo.queue')
+
 rabbit_opts = [
     cfg.StrOpt('host',
                default='localhost',
@@ -39,34 +43,256 @@ rabbit_opts = [
                help='Rabbit password'),
     cfg.StrOpt('virtual_host',
                default='/',
-               help='Rabbit virtual host')
+               help='Rabbit virtual host'),
+    cfg.BoolOpt('publisher_confirms',
+                default=False,
+                help='Wait for the broker to confirm published messages'),
+    cfg.IntOpt('channel_pool_size',
+               default=4,
+               help='Idle channels kept open for publishing')
 ]
 
 rabbit_group = cfg.OptGroup(name='rabbit', title='RabbitMQ options')
 CFG.register_group(rabbit_group)
 CFG.register_opts(rabbit_opts, group=rabbit_group)
 
+# Fanout exchange announcing changed tasks to every worker
+TASK_CHANGES_EXCHANGE = 'tempo.task_changes'
+
 _CONNECTION = None
 
 
+def new_connection():
+    """Returns a new connection to the broker, opened on first use"""
+    # kombu is only imported once a broker is actually needed
+    from kombu.connection import BrokerConnection
+    return BrokerConnection(hostname=CFG.rabbit.host,
+                            port=CFG.rabbit.port,
+                            userid=CFG.rabbit.userid,
+                            password=CFG.rabbit.password,
+                            virtual_host=CFG.rabbit.virtual_host,
+                            ssl=CFG.rabbit.use_ssl)
+
+
 def get_connection():
     global _CONNECTION
     if _CONNECTION is None:
-        _CONNECTION = BrokerConnection(
-                hostname=CFG.rabbit.host,
-                port=CFG.rabbit.port,
-                userid=CFG.rabbit.userid,
-                password=CFG.rabbit.password,
-                virtual_host=CFG.rabbit.virtual_host,
-                ssl=CFG.rabbit.use_ssl)
+        _CONNECTION = new_connection()
 
     return _CONNECTION
 
 
+def reset_connection(close=True):
+    """Drops the shared connection so the next user reconnects"""
+    global _CONNECTION
+    connection, _CONNECTION = _CONNECTION, None
+    if close and connection is not None:
+        try:
+            connection.release()
+        except Exception:
+            pass
+
+
+class PublishError(Exception):
+    pass
+
+
+class _PooledChannel(object):
+    """A channel kept open for publishing, with its confirm bookkeeping"""
+
+    def __init__(self, connection, confirm):
+        import kombu
+        self.channel = connection.channel()
+        self.producer = kombu.Producer(self.channel, auto_declare=False)
+        self.confirm = confirm
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        if confirm:
+            self.channel.events['basic_ack'].add(self._on_ack)
+            self.channel.events['basic_nack'].add(self._on_nack)
+            self.channel.confirm_select()
+
+    def _on_ack(self, delivery_tag, multiple):
+        # RabbitMQ confirms a channel's messages in the order they were
+        # published, so the latest tag accounts for everything before it
+        self.confirmed = delivery_tag
+
+    def _on_nack(self, delivery_tag, multiple, requeue):
+        if multiple:
+            self.nacked += delivery_tag - self.confirmed
+        else:
+            self.nacked += 1
+        self.confirmed = delivery_tag
+
+    def publish(self, exchange, routing_key, message):
+        self.producer.publish(message, exchange=exchange,
+                              routing_key=routing_key, serializer='json')
+        self.published += 1
+
+    def wait_for_confirms(self):
+        if not self.confirm:
+            return
+        while self.confirmed < self.published:
+            # Basic.Ack or Basic.Nack
+            self.channel.wait([(60, 80), (60, 120)])
+
+        nacked, self.nacked = self.nacked, 0
+        if nacked:
+            raise PublishError('%d messages were rejected by the broker' %
+                               nacked)
+
+    def close(self):
+        try:
+            self.channel.close()
+        except Exception:
+            pass
+
+
+class Publisher(object):
+    """
+    Publishes messages onto SimpleQueue style queues (an exchange, queue and
+    routing key all named after the topic).
+
+    The publisher has a connection of its own rather than the shared one a
+    worker consumes from, so publishing from other threads, and waiting for
+    confirms, never reads frames off a connection another thread drains.
+
+    Channels are kept open between publishes and every topic is only
+    declared once per connection. When the connection turns out to be dead
+    it is dropped and the publish is tried once more on a new one.
+
+    Connections aren't thread safe, so publishes are serialized.
+    """
+
+    def __init__(self, confirm=None, pool_size=None):
+        if confirm is None:
+            confirm = CFG.rabbit.publisher_confirms
+        if pool_size is None:
+            pool_size = CFG.rabbit.channel_pool_size
+        self.confirm = confirm
+        self.pool_size = pool_size
+        self._lock = threading.RLock()
+        self._pid = None
+        self._connection = None
+        self._channels = []
+        self._declared = set()
+
+    def publish(self, topic, message):
+        self.publish_batch([(topic, message)])
+
+    def publish_batch(self, messages):
+        """
+        Publishes a list of (topic, message) pairs, waiting for the broker
+        to confirm all of them at once when confirms are enabled.
+        """
+        self._send([(topic, topic, message) for topic, message in messages])
+
+    def broadcast(self, exchange, message):
+        """Publishes a message to every queue bound to a fanout exchange"""
+        self._send([(exchange, None, message)])
+
+    def _send(self, messages):
+        with self._lock:
+            connection = self._get_connection()
+            try:
+                self._publish_batch(connection, messages)
+            except connection.connection_errors as e:
+                logger.warn('Lost connection to the broker (%(e)s),'
+                            ' reconnecting' % locals())
+                self._reset()
+                connection = self._get_connection()
+                self._publish_batch(connection, messages)
+
+    def _publish_batch(self, connection, messages):
+        """
+        Publishes (exchange, routing key, message) tuples, a routing key of
+        None standing for a fanout exchange.
+        """
+        if self._channels:
+            pooled = self._channels.pop()
+        else:
+            pooled = _PooledChannel(connection, self.confirm)
+
+        try:
+            for exchange, routing_key, message in messages:
+                if (exchange, routing_key) not in self._declared:
+                    self._declare(pooled.channel, exchange, routing_key)
+                pooled.publish(exchange, routing_key or '', message)
+            pooled.wait_for_confirms()
+        except Exception:
+            # The channel may have been closed by the broker
+            pooled.close()
+            raise
+
+        if len(self._channels) < self.pool_size:
+            self._channels.append(pooled)
+        else:
+            pooled.close()
+
+    def _declare(self, channel, exchange, routing_key):
+        import kombu
+        if routing_key is None:
+            kombu.Exchange(exchange, 'fanout')(channel).declare()
+        else:
+            kombu_exchange = kombu.Exchange(exchange, 'direct', durable=True)
+            queue = kombu.Queue(exchange, kombu_exchange,
+                                routing_key=routing_key)
+            queue(channel).declare()
+        self._declared.add((exchange, routing_key))
+
+    def _get_connection(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Forked; the connection belongs to the parent process
+            self._channels = []
+            self._declared = set()
+            self._connection = None
+            self._pid = pid
+
+        if self._connection is None:
+            self._connection = new_connection()
+        return self._connection
+
+    def _reset(self):
+        self.close()
+        self._declared = set()
+
+    def close(self):
+        with self._lock:
+            for pooled in self._channels:
+                pooled.close()
+            self._channels = []
+            if self._connection is not None:
+                try:
+                    self._connection.release()
+                except Exception:
+                    pass
+                self._connection = None
+
+
+_PUBLISHER = None
+
+
+def get_publisher():
+    global _PUBLISHER
+    if _PUBLISHER is None:
+        _PUBLISHER = Publisher()
+
+    return _PUBLISHER
+
+
 def publish_message(topic, message):
-    connection = get_connection()
-    queue = connection.SimpleQueue(topic)
-    try:
-        queue.put(message, serializer="json")
-    finally:
-        queue.close()
+    get_publisher().publish(topic, message)
+
+
+def publish_task_changes(task_uuids, versions=None):
+    """
+    Tells workers to forget what they cached about the given tasks.
+
+    `versions` maps task uuids to the version of their new snapshot; tasks
+    without one were deleted.
+    """
+    get_publisher().broadcast(TASK_CHANGES_EXCHANGE,
+                              dict(task_uuids=list(task_uuids),
+                                   versions=versions or {}))
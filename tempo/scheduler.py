@@ -0,0 +1,204 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+In-process replacement for the crontab driver.
+
+The scheduler keeps the expanded cronspec of every task in memory along with
+a heap of next-fire times, and publishes due tasks over a single long-lived
+broker connection instead of forking `tempo-enqueue` once per task.
+
+Like cron, it evaluates schedules in the host's local time, so switching
+drivers doesn't shift when tasks fire.
+"""
+import datetime
+import heapq
+import logging
+import time
+
+from tempo import config
+from tempo import cron
+from tempo import cronspec
+from tempo import db
+from tempo import queue
+from tempo import snapshot
+from tempo.openstack.common import cfg
+
+logger = logging.getLogger('tempo.scheduler')
+
+CFG = config.CFG
+
+scheduler_opts = [
+    cfg.IntOpt('reload_interval',
+               default=60,
+               help='Seconds between reloads of the task table'),
+    cfg.BoolOpt('daemonized',
+                default=False,
+                help='Run the scheduler as a daemon')
+]
+
+scheduler_group = cfg.OptGroup(name='scheduler', title='Scheduler options')
+CFG.register_group(scheduler_group)
+CFG.register_opts(scheduler_opts, group=scheduler_group)
+
+TOPIC = 'tempo.tasks'
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _now():
+    """The host's local time, which cron fires tasks by"""
+    return datetime.datetime.now()
+
+
+def _task_schedule(task):
+    """Return the three-field recurrence the task should be fired on."""
+    if CFG.cron.schedule_override:
+        minute, hour, _dom, _month, day_of_week = \
+                CFG.cron.schedule_override.split(' ')
+        return ' '.join([minute, hour, day_of_week])
+    return task.cron_schedule
+
+
+class Scheduler(object):
+    """Fires tasks from a heap of (next fire time, task uuid) pairs."""
+
+    def __init__(self):
+        self._specs = {}
+        self._heap = []
+        self._snapshots = {}
+
+    def load(self, now):
+        """Rebuild the in-memory schedule from the tasks table."""
+        embed = CFG.cron.embed_task_snapshot
+        columns = ('uuid', 'cron_schedule')
+        if embed:
+            columns = None
+
+        task_uuids = []
+        specs = []
+        snapshots = {}
+        for tasks in db.task_iter_batches(columns=columns):
+            if embed:
+                params = db.task_parameter_get_all_by_task_uuids(
+                        [task.uuid for task in tasks])
+
+            for task in tasks:
+                task_uuid = task.uuid
+                schedule = _task_schedule(task)
+                try:
+                    spec = cronspec.parse(schedule)
+                except Exception as e:
+                    logger.error("Invalid recurrence '%(schedule)s' for task"
+                                 " '%(task_uuid)s': %(e)s" % locals())
+                    continue
+
+                task_uuids.append(task_uuid)
+                specs.append(spec)
+                if embed:
+                    snapshots[task_uuid] = snapshot.TaskSnapshot.from_task(
+                            task, params[task_uuid]).to_dict()
+
+        fires = cronspec.next_fires(specs, now)
+        heap = [(fire, task_uuid)
+                for fire, task_uuid in zip(fires, task_uuids)
+                if fire is not None]
+        heapq.heapify(heap)
+        self._specs = dict(zip(task_uuids, specs))
+        self._snapshots = snapshots
+        self._heap = heap
+        logger.debug("Loaded %d tasks" % len(heap))
+
+    def next_wakeup(self):
+        """Return the fire time at the top of the heap, or None."""
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def fire_due(self, now):
+        """Publish every task whose fire time is not later than `now`."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire, task_uuid = heapq.heappop(self._heap)
+            spec = self._specs.get(task_uuid)
+            if spec is None:
+                continue
+
+            due.append(task_uuid)
+
+            # Like cron, missed fire times are not caught up on, so the
+            # next fire is always computed from the current time.
+            next_fire = spec.next_fire(now)
+            if next_fire is not None:
+                heapq.heappush(self._heap, (next_fire, task_uuid))
+
+        if due:
+            self._publish(due)
+        return len(due)
+
+    def _publish(self, task_uuids):
+        messages = []
+        for task_uuid in task_uuids:
+            message = dict(task_uuid=task_uuid)
+            task = self._snapshots.get(task_uuid)
+            if task is not None:
+                message['task'] = task
+            messages.append((TOPIC, message))
+        try:
+            queue.get_publisher().publish_batch(messages)
+        except Exception as e:
+            logger.exception(e)
+
+    def run(self):
+        """Fire tasks until interrupted, reloading the schedule periodically"""
+        reload_interval = datetime.timedelta(
+                seconds=CFG.scheduler.reload_interval)
+        next_reload = None
+        while True:
+            now = _now()
+            self.fire_due(now)
+
+            if next_reload is None or now >= next_reload:
+                self.load(now)
+                next_reload = now + reload_interval
+
+            wakeup = self.next_wakeup()
+            if wakeup is None or wakeup > next_reload:
+                wakeup = next_reload
+
+            delay = _seconds(wakeup - _now())
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _run():
+    if CFG.cron.driver == 'crontab':
+        logger.warn("cron driver is 'crontab'; tasks will also be fired by"
+                    " the system crontab")
+
+    Scheduler().run()
+
+
+def start():
+    """Starts up the scheduler"""
+    if CFG.scheduler.daemonized:
+        import daemon
+        with daemon.DaemonContext():
+            _run()
+    else:
+        _run()
@@ -0,0 +1,99 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+JSON encoding of API responses.
+
+A Serializer picks its encoder once from BACKENDS, the C ones first, and
+calls it directly rather than going through flask.json, which looks up the
+app's settings and builds a new encoder on every call.
+
+Keys aren't sorted: sort_keys makes the stdlib and simplejson encoders fall
+back to their pure Python implementation. Dicts built the same way iterate
+in the same order in every worker, as long as hash randomization stays off,
+so a response still gets the same ETag from each of them.
+"""
+import datetime
+
+
+def format_datetime(value):
+    """
+    Formats a datetime as 'YYYY-MM-DD HH:MM:SS'. isoformat runs in C and,
+    unlike strftime, handles years before 1900.
+    """
+    if value is None:
+        return None
+    return value.isoformat(' ')[:19]
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return format_datetime(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def _ujson_encoder():
+    import ujson
+
+    # ujson has no hook for other types, so datetimes have to be formatted
+    # beforehand
+    def encode(obj):
+        return ujson.dumps(obj)
+    return encode
+
+
+def _simplejson_encoder():
+    import simplejson
+    if not simplejson._speedups:
+        raise ImportError("simplejson has no C speedups")
+    return simplejson.JSONEncoder(default=_default).encode
+
+
+def _json_encoder():
+    import json
+    return json.JSONEncoder(default=_default).encode
+
+
+# Tried in this order for the 'auto' backend
+BACKENDS = [
+    ('ujson', _ujson_encoder),
+    ('simplejson', _simplejson_encoder),
+    ('json', _json_encoder),
+]
+
+
+class Serializer(object):
+    """
+    Encodes objects to JSON with the named backend, or with the first one
+    installed for 'auto'.
+    """
+
+    def __init__(self, backend='auto'):
+        backends = BACKENDS
+        if backend != 'auto':
+            backends = [b for b in BACKENDS if b[0] == backend]
+            if not backends:
+                raise ValueError("Unknown JSON backend '%s'" % backend)
+
+        for name, make_encoder in backends:
+            try:
+                self.dumps = make_encoder()
+            except ImportError:
+                if backend != 'auto':
+                    raise
+                continue
+            self.backend = name
+            break
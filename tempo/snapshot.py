@@ -0,0 +1,76 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+Detached copies of tasks for the worker.
+"""
+import base64
+import hashlib
+import json
+
+# Task attributes a snapshot carries, in the order they're hashed
+FIELDS = ('uuid', 'instance_uuid', 'action', 'cron_schedule', 'params')
+
+
+class TaskSnapshot(object):
+    """
+    A task and its parameters as they were read from the database.
+
+    Unlike a model it holds no session, so it can be cached and shared
+    between threads, handed to another process or embedded in a message.
+    `version` is a hash of the contents, so two snapshots of the same task
+    have the same version exactly when nothing changed in between.
+    """
+
+    def __init__(self, uuid, instance_uuid, action, cron_schedule,
+                 params=None):
+        self.uuid = uuid
+        self.instance_uuid = instance_uuid
+        self.action = action
+        self.cron_schedule = cron_schedule
+        self.params = params or {}
+        self.version = hashlib.sha1(
+                json.dumps(self._values(), sort_keys=True)).hexdigest()
+
+    def _values(self):
+        return [getattr(self, field) for field in FIELDS]
+
+    @classmethod
+    def from_task(cls, task, params):
+        return cls(task.uuid, task.instance_uuid, task.action,
+                   task.cron_schedule, params=params)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(*[values.get(field) for field in FIELDS])
+
+    def to_dict(self):
+        values = dict(zip(FIELDS, self._values()))
+        values['version'] = self.version
+        return values
+
+    def __repr__(self):
+        return '<TaskSnapshot %s %s>' % (self.uuid, self.action)
+
+
+def encode(task):
+    """Packs a snapshot into one shell and crontab safe word"""
+    return base64.b64encode(json.dumps(task.to_dict()))
+
+
+def decode(text):
+    """Unpacks the dict of a snapshot packed by encode()"""
+    return json.loads(base64.b64decode(text))
@@ -15,15 +15,24 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import collections
 import logging
+import multiprocessing
+from multiprocessing import pool as mp_pool
+import Queue
+import socket
+import threading
+import time
+import uuid
 
 import kombu
 
 from tempo import actions
+from tempo import cache
 from tempo import config
-from tempo import db
 from tempo import notifier
 from tempo import queue as tempo_queue
+from tempo import snapshot
 from tempo.openstack.common import cfg
 from tempo.openstack.common import exception as common_exception
 
@@ -37,15 +46,154 @@ worker_opts = [
                 help='Run worker as a daemon'),
     cfg.StrOpt('publisher_id',
                default='host',
-               help='Where the notification came from')
+               help='Where the notification came from'),
+    cfg.IntOpt('concurrency',
+               default=1,
+               help='Number of tasks a worker runs at the same time'),
+    cfg.StrOpt('pool',
+               default='thread',
+               help="Run tasks on a pool of 'thread's or 'process'es"),
+    cfg.BoolOpt('ack_late',
+                default=False,
+                help='Acknowledge task messages only once the task has run'),
+    cfg.IntOpt('max_retries',
+               default=3,
+               help='Times a failed task is retried with ack_late before it'
+                    ' is moved to the dead letter queue'),
+    cfg.IntOpt('retry_delay',
+               default=30,
+               help='Seconds before the first retry of a failed task,'
+                    ' doubled on every further retry'),
+    cfg.IntOpt('task_cache_size',
+               default=10000,
+               help='Tasks cached by the worker, 0 disables the cache'),
+    cfg.IntOpt('task_cache_ttl',
+               default=300,
+               help='Seconds a cached task is used before it is read again')
 ]
 
 worker_group = cfg.OptGroup(name='worker', title='Worker options')
 CFG.register_group(worker_group)
 CFG.register_opts(worker_opts, group=worker_group)
 
+# Seconds to wait for a message before checking for finished tasks
+DRAIN_TIMEOUT = 1
+# The same while messages wait for their task to finish to be acked, as with
+# every prefetched message running no new one arrives to end the wait
+ACK_DRAIN_TIMEOUT = 0.05
+
+# Seconds between logging the task cache's statistics
+CACHE_STATS_INTERVAL = 300
+
+_TASK_CACHE = None
+
+# Latest snapshot version of recently changed tasks, None once deleted
+_LATEST_VERSIONS = None
+_UNKNOWN = object()
+
+# Counter shared with process pool members, bumped by TaskPool.invalidate.
+# A member clears its own caches when it sees the counter change.
+_POOL_GENERATION = None
+_SEEN_GENERATION = 0
+
+
+def _get_task_cache():
+    global _TASK_CACHE
+    if _TASK_CACHE is None:
+        _TASK_CACHE = cache.LRUCache(maxsize=CFG.worker.task_cache_size,
+                                     ttl=CFG.worker.task_cache_ttl)
+    return _TASK_CACHE
+
+
+def _init_pool_member(generation):
+    global _POOL_GENERATION
+    _POOL_GENERATION = generation
+
+
+def _expire_pool_member_caches():
+    """Clears a process pool member's caches once any task was changed"""
+    global _SEEN_GENERATION
+    if _POOL_GENERATION is None:
+        return
+    generation = _POOL_GENERATION.value
+    if generation != _SEEN_GENERATION:
+        _get_task_cache().clear()
+        _get_latest_versions().clear()
+        _SEEN_GENERATION = generation
+
+
+def task_cache_stats():
+    """Returns the hits, misses and size of the task cache"""
+    return _get_task_cache().stats()
+
+
+def _get_task(task_uuid):
+    """Returns a TaskSnapshot of the task, from the cache when possible"""
+    task_cache = _get_task_cache()
+    if task_cache.maxsize > 0:
+        task = task_cache.get(task_uuid)
+        if task is not None:
+            return task
+
+    # Deferred so workers running only embedded snapshots never load
+    # SQLAlchemy
+    from tempo import db
+    task_ref = db.task_get(task_uuid)
+    params = db.task_parameter_get_all_by_task_uuid(task_uuid)
+    task = snapshot.TaskSnapshot.from_task(task_ref, params)
+    if task_cache.maxsize > 0:
+        task_cache.set(task_uuid, task)
+    return task
+
+
+def _get_latest_versions():
+    global _LATEST_VERSIONS
+    if _LATEST_VERSIONS is None:
+        _LATEST_VERSIONS = cache.LRUCache(
+                maxsize=max(CFG.worker.task_cache_size, 1))
+    return _LATEST_VERSIONS
+
+
+def _invalidate_tasks(task_uuids, versions):
+    task_cache = _get_task_cache()
+    latest_versions = _get_latest_versions()
+    for task_uuid in task_uuids:
+        task_cache.pop(task_uuid)
+        latest_versions.set(task_uuid, versions.get(task_uuid))
+
+
+def _check_version(task_dict):
+    """
+    Returns the snapshot carried by a message if it is the latest version of
+    its task, otherwise None so the task is looked up.
+
+    Versions announced by the API are trusted. A worker that hasn't heard
+    of a task since it started may have missed announcements, so the
+    snapshot's version is checked against the database once and the latest
+    version remembered. Runs inside the pool, so those lookups don't hold up
+    the dispatch of other messages.
+    """
+    task_uuid = task_dict['uuid']
+    latest_versions = _get_latest_versions()
+    latest = latest_versions.get(task_uuid, _UNKNOWN)
+    if latest is _UNKNOWN:
+        try:
+            latest = _get_task(task_uuid).version
+        except common_exception.NotFound:
+            latest = None
+        except Exception as e:
+            logger.warn("Couldn't check the version of task '%(task_uuid)s',"
+                        " running its snapshot: %(e)s" % locals())
+            return task_dict
+        latest_versions.set(task_uuid, latest)
+
+    if latest != task_dict.get('version'):
+        return None
+    return task_dict
+
 
 def _perform_task(task):
+    """Runs a task's action, returning False if it should be retried"""
     def _notify(event_type, exception=None):
         payload = {'task_uuid': task_uuid}
         if exception is not None:
@@ -62,7 +210,7 @@ def _perform_task(task):
     except AttributeError:
         logger.error("unrecognized action '%(action)s' for task task"
                      " '%(task_uuid)s'" % locals())
-        return
+        return True
 
     logger.debug("task '%(task_uuid)s' started: '%(action)s'" % locals())
 
@@ -73,38 +221,257 @@ def _perform_task(task):
     except Exception as e:
         logger.error("task '%(task_uuid)s' errored: %(e)s" % locals())
         _notify('Errored Task', exception=e)
-    else:
-        logger.debug("task '%(task_uuid)s' finished: returned successfully" %
-                     locals())
-        _notify('Finished Task')
+        return False
+
+    logger.debug("task '%(task_uuid)s' finished: returned successfully" %
+                 locals())
+    _notify('Finished Task')
+    return True
+
+
+class TaskPool(object):
+    """Runs functions on a pool of threads or processes, `size` at a time."""
+
+    def __init__(self, kind, size):
+        self._generation = None
+        if kind == 'thread':
+            self._pool = mp_pool.ThreadPool(size)
+        elif kind == 'process':
+            self._generation = multiprocessing.Value('L', 0)
+            self._pool = multiprocessing.Pool(size, _init_pool_member,
+                                              (self._generation,))
+        else:
+            raise ValueError("Unknown worker pool '%s'" % kind)
+
+        self.size = size
+        self._slots = threading.Semaphore(size)
 
+    def apply_async(self, func, args, callback=None):
+        """
+        Runs func(*args) on the pool, blocking while every member is busy.
 
-def _process_message(body, message):
-    message.ack()
+        `func` must not raise, otherwise its slot in the pool is never
+        released.
+        """
+        def _done(result):
+            self._slots.release()
+            if callback is not None:
+                callback(result)
 
-    task_uuid = body['task_uuid']
+        self._slots.acquire()
+        self._pool.apply_async(func, args, callback=_done)
 
+    def invalidate(self):
+        """
+        Makes process pool members drop their task caches. Thread pools
+        share the consumer's cache, which it evicts from directly.
+        """
+        if self._generation is not None:
+            with self._generation.get_lock():
+                self._generation.value += 1
+
+    def close(self):
+        """Waits for the running tasks to finish and stops the pool."""
+        self._pool.close()
+        self._pool.join()
+
+
+def _run_task(task_uuid, task_dict=None):
+    """
+    Performs a task, returning False if it should be retried.
+
+    The task is run from `task_dict`, a snapshot carried by the message,
+    when there is one of the task's latest version and looked up otherwise.
+    Runs inside the pool and never raises.
+    """
+    _expire_pool_member_caches()
     try:
-        task = db.task_get(task_uuid)
+        if task_dict is not None and _check_version(task_dict) is None:
+            logger.debug("Task '%(task_uuid)s' changed since it was"
+                         " enqueued, looking it up" % locals())
+            task_dict = None
+
+        if task_dict is not None:
+            task = snapshot.TaskSnapshot.from_dict(task_dict)
+        else:
+            task = _get_task(task_uuid)
+        return _perform_task(task)
     except common_exception.NotFound:
         logger.error("Task '%(task_uuid)s' not found" % locals())
-        return
+        return True
+    except Exception as e:
+        logger.exception(e)
+        return False
 
-    _perform_task(task)
 
+class TaskConsumer(object):
+    """
+    Feeds task messages from the broker to a TaskPool.
 
-def _consume_messages(exchange, queue, key):
-    kombu_xchg = kombu.Exchange(exchange, 'direct', durable=True)
-    kombu_queue = kombu.Queue(queue, exchange=kombu_xchg, key=key)
+    With `ack_late` set a message is only acknowledged once its task has run,
+    so the tasks of a worker that dies are redelivered to another one.
+    Failed tasks are then republished to a retry queue whose messages expire
+    back onto the task queue after a delay that doubles with every attempt,
+    and are parked on a dead letter queue once `max_retries` is exceeded.
+    Otherwise a failed task waits for its next scheduled run.
 
-    connection = tempo_queue.get_connection()
+    Channels aren't thread safe, so the pool hands finished tasks back
+    through a queue and only the consuming thread talks to the broker.
+
+    Changes announced by the API evict tasks from the task cache. Process
+    pool members each have their own cache, which they clear entirely after
+    any change.
+    """
+
+    def __init__(self, connection, pool, exchange, queue, key):
+        self.connection = connection
+        self.pool = pool
+        self.exchange = kombu.Exchange(exchange, 'direct', durable=True)
+        self.queue = queue
+        self.key = key
+        self.ack_late = CFG.worker.ack_late
+        self.channel = connection.channel()
+        self._producer = None
+        self._done = Queue.Queue()
+        # Delivery tags not yet acknowledged, in the order they arrived
+        self._unacked = collections.deque()
+        self._finished = set()
+
+    def task_queue(self):
+        """
+        The task queue, bound with the routing key retries are dead-lettered
+        back with
+        """
+        return kombu.Queue(self.queue, exchange=self.exchange,
+                           routing_key=self.key)
+
+    def consume(self):
+        consumer = kombu.Consumer(self.channel, self.task_queue())
+        consumer.qos(prefetch_count=self.pool.size)
+        consumer.register_callback(self.on_message)
+        consumer.consume()
+
+        # An exclusive queue per worker receives every task change
+        changes_xchg = kombu.Exchange(tempo_queue.TASK_CHANGES_EXCHANGE,
+                                      'fanout')
+        changes_queue = kombu.Queue('%s.changes.%s' % (self.queue,
+                                                       uuid.uuid4().hex),
+                                    exchange=changes_xchg, exclusive=True,
+                                    auto_delete=True)
+        changes_consumer = kombu.Consumer(self.channel, changes_queue,
+                                          no_ack=True)
+        changes_consumer.register_callback(self.on_task_changes)
+        changes_consumer.consume()
+
+        next_stats = time.time() + CACHE_STATS_INTERVAL
+        while True:
+            try:
+                self.connection.drain_events(timeout=self._drain_timeout())
+            except socket.timeout:
+                pass
+            self.process_finished()
+
+            if time.time() >= next_stats:
+                logger.info('Task cache: %s' % task_cache_stats())
+                next_stats = time.time() + CACHE_STATS_INTERVAL
+
+    def _drain_timeout(self):
+        if self._unacked:
+            return ACK_DRAIN_TIMEOUT
+        return DRAIN_TIMEOUT
 
-    consumer = kombu.Consumer(connection.channel(), kombu_queue)
-    consumer.register_callback(_process_message)
-    consumer.consume()
+    def on_task_changes(self, body, message):
+        _invalidate_tasks(body['task_uuids'], body.get('versions', {}))
+        self.pool.invalidate()
 
-    while True:
-        connection.drain_events()
+    def on_message(self, body, message):
+        if self.ack_late:
+            self._unacked.append(message.delivery_tag)
+        else:
+            message.ack()
+
+        def _callback(succeeded):
+            self._done.put((body, message.delivery_tag, succeeded))
+
+        self.pool.apply_async(_run_task, (body['task_uuid'], body.get('task')),
+                              callback=_callback)
+
+    def process_finished(self):
+        """Retries failed tasks and acknowledges finished ones"""
+        while True:
+            try:
+                body, delivery_tag, succeeded = self._done.get_nowait()
+            except Queue.Empty:
+                break
+
+            if self.ack_late:
+                if not succeeded:
+                    self._retry(body)
+                self._finished.add(delivery_tag)
+
+        if self._finished:
+            self._ack_finished()
+
+    def _ack_finished(self):
+        # Tasks mostly finish in the order they arrived, so a single
+        # multiple ack usually covers everything that finished
+        last = None
+        while self._unacked and self._unacked[0] in self._finished:
+            last = self._unacked.popleft()
+            self._finished.remove(last)
+        if last is not None:
+            self.channel.basic_ack(last, multiple=True)
+
+        # Ack the stragglers behind a slow task one by one so they don't
+        # hold on to prefetch slots
+        for delivery_tag in self._finished:
+            self._unacked.remove(delivery_tag)
+            self.channel.basic_ack(delivery_tag)
+        self._finished.clear()
+
+    def _retry(self, body):
+        task_uuid = body['task_uuid']
+        retries = body.get('retries', 0) + 1
+        max_retries = CFG.worker.max_retries
+        if retries > max_retries:
+            logger.error("Task '%(task_uuid)s' failed %(retries)d times,"
+                         " moving it to the dead letter queue" % locals())
+            name = '%s.dead' % self.queue
+            arguments = {}
+        else:
+            delay = CFG.worker.retry_delay * 2 ** (retries - 1)
+            logger.warn("Task '%(task_uuid)s' failed, retrying in %(delay)d"
+                        " seconds" % locals())
+            name = '%s.retry.%d' % (self.queue, delay)
+            arguments = {'x-message-ttl': delay * 1000,
+                         'x-dead-letter-exchange': self.exchange.name,
+                         'x-dead-letter-routing-key': self.key}
+
+        self._publish(dict(body, retries=retries), name, arguments)
+
+    def _publish(self, body, name, arguments):
+        if self._producer is None:
+            self._producer = kombu.Producer(self.channel,
+                                            exchange=self.exchange)
+        kombu_queue = kombu.Queue(name, exchange=self.exchange,
+                                  routing_key=name, durable=True,
+                                  queue_arguments=arguments)
+        self._producer.publish(body, routing_key=name, serializer='json',
+                               declare=[kombu_queue])
+
+
+def _consume_messages(exchange, queue, key):
+    # Create the pool before connecting so process pools don't inherit the
+    # broker connection
+    concurrency = max(CFG.worker.concurrency, 1)
+    pool = TaskPool(CFG.worker.pool, concurrency)
+
+    connection = tempo_queue.get_connection()
+    consumer = TaskConsumer(connection, pool, exchange, queue, key)
+    try:
+        consumer.consume()
+    finally:
+        pool.close()
 
 
 def consume_messages(exchange, queue, key):
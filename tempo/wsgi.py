@@ -0,0 +1,273 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""
+Pre-forking eventlet WSGI server.
+
+The parent process binds the listen socket and forks worker processes that
+each serve it with a pool of green threads; the kernel spreads connections
+across them. The parent only supervises: it replaces workers that die, and
+on SIGHUP re-reads the config files and swaps in fresh workers while the old
+ones finish their requests. SIGTERM or SIGINT stops everything.
+
+Background jobs that must run once per server rather than once per worker
+are given to it as services, each run in a child process of its own. The
+parent itself runs no threads, so forking never copies a lock one holds.
+"""
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+from tempo import config
+
+logger = logging.getLogger('tempo.wsgi')
+
+CFG = config.CFG
+
+# Workers exiting sooner than this after being forked are restarted after a
+# pause, so a worker that can't start doesn't make the parent fork in a loop
+MIN_WORKER_LIFETIME = 1
+
+# Number of workers serving the app, inherited by each of them; a server
+# that keeps state per process checks it to know whether other workers
+# share the load
+SERVING_WORKERS = 1
+
+
+def worker_count():
+    """The number of workers to fork, one per CPU unless configured"""
+    return CFG.api.workers or _cpu_count()
+
+
+def _cpu_count():
+    # Deferred, as the API imports this module at startup
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def _reset_after_fork():
+    """
+    Drops the DB engine and broker connection a worker inherited, so it
+    opens its own instead of sharing its parent's sockets, and recreates the
+    locks made before eventlet patched threading.
+    """
+    from tempo import cron
+    from tempo import queue
+    from tempo.db import api as db_api
+
+    db_api.reset_engine()
+    queue.reset_connection(close=False)
+    cron.reset_locks()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit()
+
+
+class Server(object):
+    """Serves `app` on `port` from `workers` forked processes."""
+
+    def __init__(self, app, port, workers=None, greenlets=1000,
+                 services=()):
+        self.app = app
+        self.port = port
+        self.workers = workers or _cpu_count()
+        self.greenlets = greenlets
+        self.services = list(services)
+        self._sock = None
+        self._children = {}
+        # Service processes, mapped to when they were forked and what they run
+        self._services = {}
+        self._retiring = set()
+        self._running = False
+        self._reload = False
+
+    def start(self):
+        """Binds the socket and forks the workers"""
+        import eventlet
+
+        self._sock = eventlet.listen(('', self.port))
+        self._running = True
+        self._set_serving_workers()
+        for n in xrange(self.workers):
+            self._spawn()
+        for service in self.services:
+            self._spawn_service(service)
+
+    def _set_serving_workers(self):
+        global SERVING_WORKERS
+        SERVING_WORKERS = self.workers
+
+    def _fork(self, target, *args):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                target(*args)
+            except Exception as e:
+                logger.exception(e)
+                status = 1
+            finally:
+                os._exit(status)
+        return pid
+
+    def _spawn(self):
+        pid = self._fork(self._run_worker)
+        self._children[pid] = time.time()
+        return pid
+
+    def _spawn_service(self, service):
+        pid = self._fork(self._run_service, service)
+        self._services[pid] = (time.time(), service)
+        return pid
+
+    def _run_service(self, service):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Reloads only replace the workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, _raise_exit)
+
+        _reset_after_fork()
+        service()
+
+    def _run_worker(self):
+        import eventlet
+        from eventlet import wsgi
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Stop accepting and let the requests in flight finish
+        signal.signal(signal.SIGHUP, _raise_exit)
+        signal.signal(signal.SIGINT, _raise_exit)
+
+        eventlet.monkey_patch()
+        _reset_after_fork()
+
+        pool = eventlet.GreenPool(self.greenlets)
+        wsgi.server(self._sock, self.app, custom_pool=pool,
+                    log=logging.getLogger('tempo.wsgi.access'))
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._running = False
+
+    def wait(self):
+        """Supervises the workers until told to stop"""
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+
+        while self._running:
+            if self._reload:
+                self._reload = False
+                self.reload()
+
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._reap(pid, status)
+
+        self.stop()
+
+    def _reap(self, pid, status):
+        if pid in self._services:
+            started, service = self._services.pop(pid)
+            kind = 'Service'
+            respawn = lambda: self._spawn_service(service)
+        elif pid in self._children:
+            started = self._children.pop(pid)
+            kind = 'Worker'
+            respawn = self._spawn
+        else:
+            return
+        if pid in self._retiring:
+            self._retiring.discard(pid)
+            return
+
+        logger.error("%(kind)s %(pid)d exited with status %(status)d" %
+                     locals())
+        if time.time() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        if self._running:
+            respawn()
+
+    def reload(self):
+        """
+        Re-reads the config files and replaces every worker. The listen
+        socket and the services are kept, so a changed port or service
+        option only applies after a restart.
+        """
+        logger.info("Reloading")
+        try:
+            self._read_config()
+        except Exception as e:
+            logger.exception(e)
+        self.workers = worker_count()
+        self.greenlets = CFG.api.worker_greenlets
+        self._set_serving_workers()
+
+        old_pids = set(self._children) - self._retiring
+        for n in xrange(self.workers):
+            self._spawn()
+        self._signal(old_pids, signal.SIGHUP)
+        self._retiring.update(old_pids)
+
+    def _read_config(self):
+        CFG(sys.argv[1:])
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def stop(self):
+        """Terminates the workers and waits for them"""
+        self._running = False
+        self._signal(list(self._children) + list(self._services),
+                     signal.SIGTERM)
+        while self._children or self._services:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self._children.pop(pid, None)
+            self._services.pop(pid, None)
+        self._retiring.clear()
+
+
+def serve(app, port, workers=None, greenlets=1000, services=()):
+    """
+    Serves `app` from forked workers, and runs each of `services` in a
+    process of its own, until SIGTERM or SIGINT
+    """
+    server = Server(app, port, workers=workers, greenlets=greenlets,
+                    services=services)
+    server.start()
+    server.wait()
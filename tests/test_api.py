@@ -15,24 +15,64 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import datetime
 import json
+import tempfile
 import unittest
 
 import stubout
 
 from tempo import api
+from tempo import config
 from tempo import cron
 from tempo import db
+from tempo import snapshot
+from tempo import wsgi
 from tempo.openstack.common import utils as common_utils
 from tempo.openstack.common import exception as common_exception
 
+CFG = config.CFG
+
 TEST_UUID = '00010203-0405-0607-0809-0a0b0c0d0e0f'
 
 
+class FakeTask(object):
+    id = 1
+    created_at = None
+    updated_at = None
+    deleted_at = None
+    deleted = False
+    instance_uuid = 'abcdef'
+    cron_schedule = '0 0 *'
+    action = 'snapshot'
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class FakeChange(object):
+    def __init__(self, id, task_uuid, deleted=False):
+        self.id = id
+        self.task_uuid = task_uuid
+        self.deleted = deleted
+
+
 class APITest(unittest.TestCase):
     def setUp(self):
         self.app = api.app.test_client()
         self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(api, '_TASK_RESPONSES', None)
+        self.stubs.Set(api, '_INDEX_RESPONSES', None)
+        self.stubs.Set(api, '_SERIALIZER', None)
+        self.stubs.Set(api, '_TASK_FRAGMENTS', None)
+        self.task_changes = []
+        self.stubs.Set(api, '_publish_task_changes',
+                       lambda tasks=(), deleted_uuids=(), task_params=None:
+                       self.task_changes.append((list(tasks),
+                                                 list(deleted_uuids))))
+        self.last_change_id = 0
+        self.stubs.Set(db, 'task_change_get_last_id',
+                       lambda: self.last_change_id)
 
     def tearDown(self):
         self.stubs.UnsetAll()
@@ -41,27 +81,200 @@ class APITest(unittest.TestCase):
         res = self.app.get('/foo')
         self.assertEqual(res.status_code, 404)
 
-    def test_index_no_items(self):
-        def stubbed_index():
-            return []
+    def test_status_reports_pool_stats(self):
+        self.stubs.Set(db, 'pool_stats', lambda: {'checkout': 3})
+        res = self.app.get('/status')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data),
+                         {'db_pool': {'checkout': 3}})
+
+    def test_archiver_runs_unless_disabled(self):
+        started = []
+        self.stubs.Set(api, '_archive_deleted_rows', started.append)
+        api._start_archiver().join()
+        CFG.set_override('archive_interval', 0, group='db')
+        try:
+            self.assertEqual(api._start_archiver(), None)
+        finally:
+            CFG.set_override('archive_interval', None, group='db')
+        self.assertEqual(started, [3600])
+
+    def test_requests_share_a_session_scope(self):
+        scopes = []
+        self.stubs.Set(db, 'begin_session_scope',
+                       lambda: scopes.append('begin'))
+        self.stubs.Set(db, 'end_session_scope',
+                       lambda: scopes.append('end'))
+        self.stubs.Set(db, 'task_get', lambda id: 'foo')
+        self.stubs.Set(api, '_make_task_dict', lambda t: t)
+        self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.assertEqual(scopes, ['begin', 'end'])
+
+    def test_streamed_index_keeps_the_session_scope(self):
+        events = []
+        self.stubs.Set(db, 'begin_session_scope',
+                       lambda: events.append('begin'))
+        self.stubs.Set(db, 'end_session_scope',
+                       lambda: events.append('end'))
+
+        def stubbed_batches(batch_size=1000, columns=None, marker=None,
+                            filters=None):
+            for uuid in ['a', 'b']:
+                events.append(uuid)
+                yield [FakeTask(uuid)]
+
+        self.stubs.Set(db, 'task_iter_batches', stubbed_batches)
+        self._stub_params_and_dicts()
+        res = self.app.get('/periodic_tasks')
+        self.assertEqual(json.loads(res.data)['periodic_tasks'], ['a', 'b'])
+        self.assertEqual(events, ['begin', 'a', 'b', 'end'])
 
-        self.stubs.Set(db, 'task_get_all', stubbed_index)
+    def test_index_no_items(self):
+        self._stub_index_pages([])
         res = self.app.get('/periodic_tasks')
         body = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(body['periodic_tasks']), 0)
 
     def test_index_with_items(self):
-        def stubbed_index():
-            elements = [1, 2, 3, 4, 5]
-            return elements
-
-        self.stubs.Set(db, 'task_get_all', stubbed_index)
-        self.stubs.Set(api, '_make_task_dict', lambda t: t)
+        self._stub_index_pages(['1', '2', '3', '4', '5'])
         res = self.app.get('/periodic_tasks')
         self.assertEqual(res.status_code, 200)
         body = json.loads(res.data)
         self.assertEqual(len(body['periodic_tasks']), 5)
+        self.assertEqual(self.param_lookups, 1)
+
+    def _stub_index_pages(self, uuids):
+        tasks = [FakeTask(uuid) for uuid in uuids]
+
+        def stubbed_index(marker=None, limit=None):
+            start = 0
+            if marker is not None:
+                if marker not in uuids:
+                    raise common_exception.NotFound(marker)
+                start = uuids.index(marker) + 1
+            return tasks[start:start + limit]
+
+        def stubbed_batches(batch_size=1000, columns=None, marker=None,
+                            filters=None):
+            self.index_queries.append((columns, filters))
+            while True:
+                page = stubbed_index(marker=marker, limit=batch_size)
+                if page:
+                    yield page
+                if len(page) < batch_size:
+                    return
+                marker = page[-1].uuid
+
+        self.index_queries = []
+        self.stubs.Set(db, 'task_iter_batches', stubbed_batches)
+        self._stub_params_and_dicts()
+
+    def _stub_params_and_dicts(self):
+        self.param_lookups = 0
+
+        def stubbed_params(task_uuids):
+            self.param_lookups += 1
+            return dict((task_uuid, {}) for task_uuid in task_uuids)
+
+        self.stubs.Set(db, 'task_parameter_get_all_by_task_uuids',
+                       stubbed_params)
+        self.stubs.Set(api, '_make_task_dict',
+                       lambda t, params=None, fields=None: t.uuid)
+
+    def test_index_streams_every_page(self):
+        CFG.set_override('max_limit', 2, group='api')
+        try:
+            self._stub_index_pages(['a', 'b', 'c', 'd', 'e'])
+            res = self.app.get('/periodic_tasks')
+        finally:
+            CFG.set_override('max_limit', None, group='api')
+
+        self.assertEqual(res.status_code, 200)
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['a', 'b', 'c', 'd', 'e'])
+        self.assertTrue('periodic_tasks_links' not in body)
+        self.assertEqual(self.param_lookups, 3)
+
+    def test_index_with_limit_links_next_page(self):
+        self._stub_index_pages(['a', 'b', 'c', 'd', 'e'])
+        res = self.app.get('/periodic_tasks?limit=2&marker=a')
+        self.assertEqual(res.status_code, 200)
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['b', 'c'])
+        links = body['periodic_tasks_links']
+        self.assertEqual(links[0]['rel'], 'next')
+        self.assertTrue('marker=c' in links[0]['href'])
+
+    def test_index_last_page_has_no_next_link(self):
+        self._stub_index_pages(['a', 'b', 'c'])
+        res = self.app.get('/periodic_tasks?limit=2&marker=a')
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['b', 'c'])
+        self.assertTrue('periodic_tasks_links' in body)
+
+        res = self.app.get('/periodic_tasks?limit=2&marker=b')
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['c'])
+        self.assertTrue('periodic_tasks_links' not in body)
+
+    def test_index_filters_and_projects(self):
+        self._stub_index_pages(['a', 'b', 'c'])
+        res = self.app.get('/periodic_tasks?instance_uuid=abcdef'
+                           '&action=weekly_backup'
+                           '&updated_since=2012-04-01T10:30:00'
+                           '&fields=uuid,action&limit=2')
+        self.assertEqual(res.status_code, 200)
+
+        columns, filters = self.index_queries[0]
+        self.assertEqual(columns, ['action', 'uuid'])
+        self.assertEqual(filters, {
+            'instance_uuid': 'abcdef', 'action': 'weekly_backup',
+            'updated_since': datetime.datetime(2012, 4, 1, 10, 30)})
+        self.assertEqual(self.param_lookups, 0)
+
+        href = json.loads(res.data)['periodic_tasks_links'][0]['href']
+        self.assertTrue('action=weekly_backup' in href)
+        self.assertTrue('fields=uuid%2Caction' in href)
+
+    def test_instance_index(self):
+        self._stub_index_pages(['a', 'b'])
+        res = self.app.get('/instances/abcdef/periodic_tasks')
+        self.assertEqual(json.loads(res.data)['periodic_tasks'], ['a', 'b'])
+        columns, filters = self.index_queries[0]
+        self.assertEqual(filters, {'instance_uuid': 'abcdef'})
+
+        # Not served from the cached listing of every task
+        self.app.get('/periodic_tasks').data
+        self.assertEqual(len(self.index_queries), 2)
+
+    def test_instance_delete(self):
+        cron_calls = []
+        self.stubs.Set(db, 'task_delete_by_instance',
+                       lambda instance_uuid: ['a', 'b'])
+        self.stubs.Set(cron, 'update_tasks', lambda: cron_calls.append(1))
+        res = self.app.delete('/instances/abcdef/periodic_tasks')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), {'deleted': ['a', 'b']})
+        self.assertEqual(cron_calls, [1])
+        self.assertEqual(self.task_changes, [([], ['a', 'b'])])
+
+    def test_index_invalid_filters_fail(self):
+        self._stub_index_pages(['a'])
+        for query in ['fields=uuid,foo', 'updated_since=yesterday']:
+            res = self.app.get('/periodic_tasks?%s' % query)
+            self.assertEqual(res.status_code, 400)
+
+    def test_index_invalid_limit_fails(self):
+        self._stub_index_pages(['a'])
+        for limit in ['foo', '0', '-1']:
+            res = self.app.get('/periodic_tasks?limit=%s' % limit)
+            self.assertEqual(res.status_code, 400)
+
+    def test_index_unknown_marker_fails(self):
+        self._stub_index_pages(['a'])
+        res = self.app.get('/periodic_tasks?marker=z')
+        self.assertEqual(res.status_code, 400)
 
     def test_show_item(self):
         def stubbed_show(id):
@@ -74,6 +287,185 @@ class APITest(unittest.TestCase):
         body = json.loads(res.data)
         self.assertEqual(body['periodic_task'], 'foo')
 
+    def _stub_show(self):
+        self.lookups = []
+
+        def stubbed_show(id):
+            self.lookups.append(id)
+            return id
+
+        self.stubs.Set(db, 'task_get', stubbed_show)
+        self.stubs.Set(api, '_make_task_dict', lambda t: {'uuid': t})
+
+    def test_show_is_cached_with_etag(self):
+        self._stub_show()
+        res = self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        etag = res.headers['ETag']
+        self.assertEqual(json.loads(res.data)['periodic_task'],
+                         {'uuid': TEST_UUID})
+
+        res = self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(self.lookups, [TEST_UUID])
+
+        res = self.app.get('/periodic_tasks/%s' % TEST_UUID,
+                           headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, '')
+
+    def test_show_cache_is_invalidated_by_writes(self):
+        self._stub_show()
+        self.stubs.Set(db, 'task_delete', lambda id: None)
+        self.stubs.Set(cron, 'update_tasks', lambda: None)
+        self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.app.delete('/periodic_tasks/%s' % TEST_UUID)
+        self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.assertEqual(self.lookups, [TEST_UUID, TEST_UUID])
+
+    def test_show_cache_can_be_disabled(self):
+        self._stub_show()
+        CFG.set_override('response_cache_size', 0, group='api')
+        try:
+            self.app.get('/periodic_tasks/%s' % TEST_UUID)
+            res = self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        finally:
+            CFG.set_override('response_cache_size', None, group='api')
+        self.assertEqual(self.lookups, [TEST_UUID, TEST_UUID])
+        self.assertTrue(res.headers['ETag'])
+
+    def test_show_is_not_cached_with_several_workers(self):
+        self._stub_show()
+        self.stubs.Set(wsgi, 'SERVING_WORKERS', 2)
+        self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.app.get('/periodic_tasks/%s' % TEST_UUID)
+        self.assertEqual(self.lookups, [TEST_UUID, TEST_UUID])
+
+    def test_index_etag_follows_the_change_cursor(self):
+        self._stub_index_pages(['a', 'b'])
+        self.stubs.Set(wsgi, 'SERVING_WORKERS', 2)
+        etag = self.app.get('/periodic_tasks').headers['ETag']
+        res = self.app.get('/periodic_tasks',
+                           headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(len(self.index_queries), 1)
+
+        self.assertNotEqual(
+                self.app.get('/periodic_tasks?limit=1').headers['ETag'], etag)
+
+        self.last_change_id = 1
+        res = self.app.get('/periodic_tasks',
+                           headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(json.loads(res.data)['periodic_tasks'], ['a', 'b'])
+
+    def test_index_is_not_cached_with_several_workers(self):
+        self._stub_index_pages(['a', 'b'])
+        self.stubs.Set(wsgi, 'SERVING_WORKERS', 2)
+        self.app.get('/periodic_tasks').data
+        self.app.get('/periodic_tasks').data
+        self.assertEqual(self.param_lookups, 2)
+
+    def test_index_is_cached_once_streamed(self):
+        self._stub_index_pages(['a', 'b'])
+        res = self.app.get('/periodic_tasks')
+        body, etag = res.data, res.headers['ETag']
+        res = self.app.get('/periodic_tasks')
+        self.assertEqual(res.data, body)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(self.param_lookups, 1)
+
+        res = self.app.get('/periodic_tasks',
+                           headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+        # Other pages are cached separately
+        res = self.app.get('/periodic_tasks?limit=1')
+        self.assertEqual(json.loads(res.data)['periodic_tasks'], ['a'])
+
+    def test_index_reuses_unchanged_task_fragments(self):
+        self._stub_index_pages(['a', 'b'])
+        serialized = []
+        self.stubs.Set(api, '_make_task_dict',
+                       lambda t, params=None, fields=None:
+                       serialized.append(t.uuid) or t.uuid)
+
+        self.app.get('/periodic_tasks').data
+        self.app.get('/periodic_tasks?limit=2').data
+        self.assertEqual(serialized, ['a', 'b'])
+
+        tasks = list(db.task_iter_batches())[0]
+        tasks[1].action = 'weekly_backup'
+        res = self.app.get('/periodic_tasks?limit=3')
+        self.assertEqual(json.loads(res.data)['periodic_tasks'], ['a', 'b'])
+        self.assertEqual(serialized, ['a', 'b', 'b'])
+
+    def _stub_changes(self, changes, first=1, last=None):
+        self.polls = 0
+        if last is None:
+            last = changes[-1].id if changes else 0
+
+        def stubbed_since(since, limit=None):
+            self.polls += 1
+            return [c for c in changes if c.id > since][:limit]
+
+        self.stubs.Set(db, 'task_change_get_since', stubbed_since)
+        self.stubs.Set(db, 'task_change_get_bounds',
+                       lambda: (first, last))
+        self.stubs.Set(db, 'task_get_all_by_uuids',
+                       lambda uuids: dict((uuid, FakeTask(uuid))
+                                          for uuid in uuids))
+        self._stub_params_and_dicts()
+
+    def test_changes_without_since_returns_cursor(self):
+        self._stub_changes([FakeChange(1, 'a'), FakeChange(2, 'b')])
+        body = json.loads(self.app.get('/periodic_tasks/changes').data)
+        self.assertEqual(body['cursor'], 2)
+        self.assertEqual(body['periodic_tasks'], [])
+
+    def test_changes_since_cursor(self):
+        self._stub_changes([FakeChange(1, 'a'), FakeChange(2, 'b'),
+                            FakeChange(3, 'a', deleted=True),
+                            FakeChange(4, 'c'), FakeChange(5, 'd')])
+        res = self.app.get('/periodic_tasks/changes?since=1&limit=3')
+        self.assertEqual(res.status_code, 200)
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['b', 'c'])
+        self.assertEqual(body['deleted'], ['a'])
+        self.assertEqual(body['cursor'], 4)
+
+    def test_changes_waits_for_a_change(self):
+        self._stub_changes([FakeChange(1, 'a')])
+        CFG.set_override('changes_poll_interval', 0.01, group='api')
+        try:
+            res = self.app.get('/periodic_tasks/changes?since=1&wait=1')
+        finally:
+            CFG.set_override('changes_poll_interval', None, group='api')
+        body = json.loads(res.data)
+        self.assertEqual(body['cursor'], 1)
+        self.assertEqual(body['periodic_tasks'], [])
+        self.assertTrue(self.polls > 1)
+
+    def test_changes_purged_since_cursor_fails(self):
+        self._stub_changes([FakeChange(5, 'a')], first=5)
+        res = self.app.get('/periodic_tasks/changes?since=3')
+        self.assertEqual(res.status_code, 410)
+        res = self.app.get('/periodic_tasks/changes?since=foo')
+        self.assertEqual(res.status_code, 400)
+
+    def test_changes_purged_log_fails_lagging_cursor(self):
+        # Every change up to 7 has been purged
+        self._stub_changes([], first=8, last=7)
+        res = self.app.get('/periodic_tasks/changes?since=3')
+        self.assertEqual(res.status_code, 410)
+        res = self.app.get('/periodic_tasks/changes?since=7')
+        self.assertEqual(res.status_code, 200)
+
+    def test_changes_cursor_past_the_log_fails(self):
+        self._stub_changes([FakeChange(1, 'a')])
+        res = self.app.get('/periodic_tasks/changes?since=2')
+        self.assertEqual(res.status_code, 410)
+
     def test_create_item(self):
         self.called = False
 
@@ -83,7 +475,7 @@ class APITest(unittest.TestCase):
 
         self.stubs.Set(db, 'task_create_or_update', stubbed_create)
         self.stubs.Set(api, '_make_task_dict', lambda t: t)
-        self.stubs.Set(cron, 'update', lambda: None)
+        self.stubs.Set(cron, 'update_tasks', lambda: None)
         body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
                 'recurrence': '0 0 0', 'rotation': 3}
         res = self.app.post('/periodic_tasks/%s' % TEST_UUID,
@@ -101,7 +493,7 @@ class APITest(unittest.TestCase):
 
         self.stubs.Set(db, 'task_create_or_update', stubbed_create)
         self.stubs.Set(api, '_make_task_dict', lambda t: t)
-        self.stubs.Set(cron, 'update', lambda: None)
+        self.stubs.Set(cron, 'update_tasks', lambda: None)
         body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
                 'recurrence': '0 0 0'}
         res = self.app.put('/periodic_tasks/%s' % TEST_UUID,
@@ -155,6 +547,85 @@ class APITest(unittest.TestCase):
         self.assertEqual(self.called, False)
         self.assertEqual(res.status_code, 412)
 
+    def _stub_bulk(self):
+        self.bulk_calls = []
+        self.cron_calls = []
+
+        def stubbed_bulk(tasks, params=None, delete_uuids=None):
+            self.bulk_calls.append((tasks, params, delete_uuids))
+            task_refs = [FakeTask(values['uuid']) for values in tasks]
+            return task_refs, [uuid for uuid in delete_uuids if uuid != 'q']
+
+        self.stubs.Set(db, 'task_bulk_update', stubbed_bulk)
+        self.stubs.Set(cron, 'update_tasks', lambda: self.cron_calls.append(1))
+        self._stub_params_and_dicts()
+
+    def _post_bulk(self, body):
+        return self.app.post('/periodic_tasks/bulk',
+                             content_type='application/json',
+                             data=json.dumps(body))
+
+    def test_bulk(self):
+        self._stub_bulk()
+        task = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        body = {'upsert': [dict(task, uuid='a', params={'rotation': 3}),
+                           dict(task, uuid='b')],
+                'delete': ['c', 'q']}
+        res = self._post_bulk(body)
+        self.assertEqual(res.status_code, 200)
+
+        body = json.loads(res.data)
+        self.assertEqual(body['periodic_tasks'], ['a', 'b'])
+        self.assertEqual(body['deleted'], ['c'])
+        self.assertEqual(body['not_found'], ['q'])
+
+        self.assertEqual(len(self.bulk_calls), 1)
+        tasks, params, delete_uuids = self.bulk_calls[0]
+        self.assertEqual([t['uuid'] for t in tasks], ['a', 'b'])
+        self.assertEqual(params, {'a': ({'rotation': 3}, False)})
+        self.assertEqual(delete_uuids, ['c', 'q'])
+        self.assertEqual(self.cron_calls, [1])
+        self.assertEqual(self.param_lookups, 1)
+
+    def test_bulk_invalid_entries_fail_together(self):
+        self._stub_bulk()
+        task = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        body = {'upsert': [dict(task, uuid='a'),
+                           dict(task, uuid='b', recurrence='99 0 0'),
+                           task,
+                           dict(task, uuid='c')],
+                'delete': ['c']}
+        res = self._post_bulk(body)
+        self.assertEqual(res.status_code, 412)
+        errors = json.loads(res.data)['errors']
+        self.assertEqual([e['index'] for e in errors], [1, 2, 3])
+        self.assertEqual(self.bulk_calls, [])
+        self.assertEqual(self.cron_calls, [])
+
+    def test_bulk_malformed_body_fails(self):
+        self._stub_bulk()
+        task = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        for body in [{'upsert': 'a'}, {'delete': {'a': 1}},
+                     {'upsert': ['a', dict(task, uuid='b', params=[1])]},
+                     {'delete': [['a']]}]:
+            res = self._post_bulk(body)
+            self.assertEqual(res.status_code, 412)
+            self.assertTrue(json.loads(res.data)['errors'])
+        self.assertEqual(self.bulk_calls, [])
+
+    def test_bulk_too_many_tasks_fails(self):
+        self._stub_bulk()
+        CFG.set_override('max_bulk_tasks', 1, group='api')
+        try:
+            res = self._post_bulk({'delete': ['a', 'b']})
+        finally:
+            CFG.set_override('max_bulk_tasks', None, group='api')
+        self.assertEqual(res.status_code, 413)
+        self.assertEqual(self.bulk_calls, [])
+
     def test_delete_item(self):
         self.called = False
 
@@ -162,10 +633,11 @@ class APITest(unittest.TestCase):
             self.called = True
 
         self.stubs.Set(db, 'task_delete', stubbed_delete)
-        self.stubs.Set(cron, 'update', lambda: None)
+        self.stubs.Set(cron, 'update_tasks', lambda: None)
         res = self.app.delete('/periodic_tasks/%s' % TEST_UUID)
         self.assertEqual(self.called, True)
         self.assertEqual(res.status_code, 204)
+        self.assertEqual(self.task_changes, [([], [TEST_UUID])])
 
     def test_delete_item_not_exist_fails(self):
         def stubbed_delete(id):
@@ -184,6 +656,19 @@ class APITest(unittest.TestCase):
         self.assertEqual(res.status_code, 500)
 
 
+class TaskDictTest(unittest.TestCase):
+    def test_only_given_fields(self):
+        task = FakeTask('a')
+        task.action = 'snapshot'
+        task.created_at = datetime.datetime(2012, 4, 1, 10, 30)
+        self.assertEqual(api._make_task_dict(task, params={'rotation': '1'},
+                                             fields=['action', 'created_at',
+                                                     'params']),
+                         {'action': 'snapshot',
+                          'created_at': '2012-04-01 10:30:00',
+                          'params': {'rotation': '1'}})
+
+
 class TestCronOutput(APITest):
     """
     Recurrence is specified as an abbreviated crontab line w/ 3 parts:
@@ -205,21 +690,33 @@ class TestCronOutput(APITest):
 
         def stubbed_create(id, values):
             self.stub_rvs['create'] = FakeModel(values)
-            return values
+            return self.stub_rvs['create']
 
-        def stubbed_get_all():
-            task = self.stub_rvs['create']
-            return [task]
+        def stubbed_iter_batches(columns=None):
+            yield [self.stub_rvs['create']]
 
         def stubbed_execute(*cmd, **kwargs):
+            self.stub_rvs['installs'] = self.stub_rvs.get('installs', 0) + 1
             self.stub_rvs['cmd'] = list(cmd)
             self.stub_rvs['stdin'] = kwargs.get('process_input')
             return 0, '', ''
 
         self.stubs.Set(db, 'task_create_or_update', stubbed_create)
-        self.stubs.Set(db, 'task_get_all', stubbed_get_all)
-        self.stubs.Set(api, '_make_task_dict', lambda t: t)
+        self.stubs.Set(db, 'task_iter_batches', stubbed_iter_batches)
+        self.stubs.Set(api, '_make_task_dict', lambda t: t.__dict__)
         self.stubs.Set(common_utils, 'execute', stubbed_execute)
+        self.lock_file = tempfile.NamedTemporaryFile()
+        CFG.set_override('install_lock_path', self.lock_file.name,
+                         group='cron')
+        CFG.set_override('install_delay', 0, group='cron')
+        CFG.set_override('tempo_enqueue_path', '', group='cron')
+
+    def tearDown(self):
+        CFG.set_override('install_delay', None, group='cron')
+        CFG.set_override('tempo_enqueue_path', None, group='cron')
+        CFG.set_override('install_lock_path', None, group='cron')
+        self.lock_file.close()
+        super(TestCronOutput, self).tearDown()
 
     def assertProperlyGeneratedCron(self, recurrence, expected):
         body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
@@ -241,3 +738,67 @@ class TestCronOutput(APITest):
 
     def test_create_weekly_start_on_sunday_at_midnight(self):
         self.assertProperlyGeneratedCron('0 0 0', '0 0 * * 0')
+
+    def test_burst_of_writes_installs_once(self):
+        CFG.set_override('install_delay', 60, group='cron')
+        body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        for i in range(3):
+            res = self.app.put('/periodic_tasks/%s' % TEST_UUID,
+                                content_type='application/json',
+                                data=json.dumps(body))
+            self.assertEqual(res.status_code, 202)
+        self.assertEqual(self.stub_rvs.get('installs'), None)
+
+        cron.flush()
+        self.assertEqual(self.stub_rvs['installs'], 1)
+        expected_stdin = '0 0 * * 0 tempo-enqueue %s\n' % TEST_UUID
+        self.assertEqual(self.stub_rvs['stdin'], expected_stdin)
+
+    def test_install_renders_every_task_in_the_db(self):
+        class FakeModel(object):
+            uuid = 'other'
+            cron_schedule = '30 1 *'
+
+        # As if written by another API worker
+        self.stubs.Set(db, 'task_iter_batches',
+                       lambda columns=None: iter([[self.stub_rvs['create'],
+                                                   FakeModel()]]))
+        body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        self.app.put('/periodic_tasks/%s' % TEST_UUID,
+                     content_type='application/json', data=json.dumps(body))
+        self.assertEqual(self.stub_rvs['stdin'],
+                         '0 0 * * 0 tempo-enqueue %s\n'
+                         '30 1 * * * tempo-enqueue other\n' % TEST_UUID)
+
+    def test_embeds_task_snapshot(self):
+        CFG.set_override('embed_task_snapshot', True, group='cron')
+        self.stubs.Set(db, 'task_parameter_get_all_by_task_uuids',
+                       lambda task_uuids: {TEST_UUID: {'rotation': '2'}})
+        body = {'action': 'snapshot', 'instance_uuid': 'abcdef',
+                'recurrence': '0 0 0'}
+        try:
+            res = self.app.put('/periodic_tasks/%s' % TEST_UUID,
+                                content_type='application/json',
+                                data=json.dumps(body))
+        finally:
+            CFG.set_override('embed_task_snapshot', None, group='cron')
+        self.assertEqual(res.status_code, 202)
+
+        line, word = self.stub_rvs['stdin'].rstrip('\n').rsplit(' ', 1)
+        self.assertEqual(line, '0 0 * * 0 tempo-enqueue %s' % TEST_UUID)
+        task_dict = snapshot.decode(word)
+        self.assertEqual(task_dict['params'], {'rotation': '2'})
+        self.assertEqual(task_dict['action'], 'snapshot')
+
+    def test_large_task_snapshot_is_left_out(self):
+        CFG.set_override('embed_task_snapshot', True, group='cron')
+        self.stubs.Set(db, 'task_parameter_get_all_by_task_uuids',
+                       lambda task_uuids: {TEST_UUID: {'notes': 'x' * 255,
+                                                       'more': 'y' * 255,
+                                                       'rest': 'z' * 255}})
+        try:
+            self.assertProperlyGeneratedCron('0 0 0', '0 0 * * 0')
+        finally:
+            CFG.set_override('embed_task_snapshot', None, group='cron')
@@ -0,0 +1,49 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import unittest
+
+from tempo import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(len(lru), 2)
+
+    def test_counts_hits_and_misses(self):
+        lru = cache.LRUCache()
+        lru.set('a', 1)
+        lru.get('a')
+        lru.get('b')
+        self.assertEqual((lru.hits, lru.misses), (1, 1))
+
+    def test_expires_entries(self):
+        lru = cache.LRUCache(ttl=60)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+
+        lru._map['a'][cache._EXPIRES] -= 61
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(len(lru), 0)
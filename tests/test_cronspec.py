@@ -0,0 +1,136 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import random
+import unittest
+
+from tempo import cronspec
+
+
+class CronspecParseTest(unittest.TestCase):
+    def test_masks(self):
+        spec = cronspec.parse('*/15 0,12 mon-fri')
+        self.assertEqual(spec.minute_mask,
+                         1 << 0 | 1 << 15 | 1 << 30 | 1 << 45)
+        self.assertEqual(spec.hour_mask, 1 << 0 | 1 << 12)
+        self.assertEqual(spec.day_of_week_mask, 0x3e)
+
+    def test_star_sets_every_bit(self):
+        spec = cronspec.parse('* * *')
+        self.assertEqual(spec.minute_mask, (1 << 60) - 1)
+        self.assertEqual(spec.hour_mask, (1 << 24) - 1)
+        self.assertEqual(spec.day_of_week_mask, (1 << 7) - 1)
+
+    def test_fields_expand_to_sets(self):
+        spec = cronspec.parse('1-3 */8 7')
+        self.assertEqual(spec.minute, set([1, 2, 3]))
+        self.assertEqual(spec.hour, set([0, 8, 16]))
+        # Sunday may be written as 7
+        self.assertEqual(spec.day_of_week, set([0]))
+
+    def test_parse_is_cached(self):
+        self.assertTrue(cronspec.parse('5 4 3') is cronspec.parse('5 4 3'))
+
+    def test_out_of_range_fails(self):
+        self.assertRaises(ValueError, cronspec.parse, '60 * *')
+        self.assertRaises(ValueError, cronspec.parse, '* 24 *')
+
+    def test_invalid_weekday_fails(self):
+        self.assertRaises(Exception, cronspec.parse, '* * foo')
+
+
+# A Sunday
+NOW = datetime.datetime(2012, 4, 1, 10, 30, 15)
+
+
+def _brute_force_next_fire(spec, after):
+    fire = after.replace(second=0, microsecond=0)
+    while True:
+        fire += datetime.timedelta(minutes=1)
+        if (fire.minute in spec.minute and fire.hour in spec.hour and
+                fire.isoweekday() % 7 in spec.day_of_week):
+            return fire
+
+
+class CronspecFireTest(unittest.TestCase):
+    def test_next_fire_every_minute(self):
+        spec = cronspec.parse('* * *')
+        self.assertEqual(spec.next_fire(NOW),
+                         datetime.datetime(2012, 4, 1, 10, 31))
+
+    def test_next_fire_is_strictly_after(self):
+        spec = cronspec.parse('30 10 *')
+        fire = datetime.datetime(2012, 4, 1, 10, 30)
+        self.assertEqual(spec.next_fire(fire),
+                         datetime.datetime(2012, 4, 2, 10, 30))
+
+    def test_next_fire_next_week(self):
+        spec = cronspec.parse('0 0 0')
+        self.assertEqual(spec.next_fire(NOW),
+                         datetime.datetime(2012, 4, 8, 0, 0))
+
+    def test_next_fire_crosses_month(self):
+        spec = cronspec.parse('15 3 wed')
+        self.assertEqual(spec.next_fire(datetime.datetime(2012, 3, 29)),
+                         datetime.datetime(2012, 4, 4, 3, 15))
+
+    def test_next_fire_matches_brute_force(self):
+        rand = random.Random(42)
+        exprs = ['*', '*/7', '1-5', '%d', '%d,%d']
+        for i in range(50):
+            fields = []
+            for max_ in (60, 24, 7):
+                expr = rand.choice(exprs)
+                numbers = tuple(rand.randrange(max_)
+                                for n in range(expr.count('%')))
+                fields.append(expr % numbers)
+            spec = cronspec.cronspec(*fields)
+            after = NOW + datetime.timedelta(minutes=rand.randrange(20000))
+            self.assertEqual(spec.next_fire(after),
+                             _brute_force_next_fire(spec, after))
+
+    def test_prev_fire(self):
+        spec = cronspec.parse('0 0 0')
+        self.assertEqual(spec.prev_fire(NOW),
+                         datetime.datetime(2012, 4, 1, 0, 0))
+        self.assertEqual(spec.prev_fire(datetime.datetime(2012, 4, 1)),
+                         datetime.datetime(2012, 3, 25, 0, 0))
+
+    def test_prev_fire_inverts_next_fire(self):
+        spec = cronspec.parse('*/20 1-3 mon,thu')
+        fire = spec.next_fire(NOW)
+        self.assertEqual(spec.prev_fire(spec.next_fire(fire)), fire)
+
+    def test_iter_fires(self):
+        spec = cronspec.parse('0 */6 *')
+        start = datetime.datetime(2012, 4, 1, 6, 0)
+        end = datetime.datetime(2012, 4, 2, 6, 0)
+        self.assertEqual(list(spec.iter_fires(start, end)),
+                         [datetime.datetime(2012, 4, 1, 6, 0),
+                          datetime.datetime(2012, 4, 1, 12, 0),
+                          datetime.datetime(2012, 4, 1, 18, 0),
+                          datetime.datetime(2012, 4, 2, 0, 0)])
+
+    def test_next_fires(self):
+        specs = [cronspec.parse('0 * *'), cronspec.parse('0 0-23 *'),
+                 cronspec.parse('0 0 0')]
+        self.assertEqual(cronspec.next_fires(specs, NOW),
+                         [datetime.datetime(2012, 4, 1, 11, 0),
+                          datetime.datetime(2012, 4, 1, 11, 0),
+                          datetime.datetime(2012, 4, 8, 0, 0)])
+
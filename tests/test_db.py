@@ -0,0 +1,355 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+import stubout
+
+from tempo import config
+from tempo import db
+from tempo.db import api as db_api
+from tempo.db import explain
+from tempo.db import models
+from tempo.db.migrate_repo import schema
+from tempo.openstack.common import exception as common_exception
+
+CFG = config.CFG
+
+
+def _task_values(task_uuid, action='snapshot'):
+    return {'uuid': task_uuid, 'instance_uuid': 'abcdef',
+            'cron_schedule': '0 0 0', 'action': action, 'deleted': False}
+
+
+class DBTest(unittest.TestCase):
+    """Runs the DB API against an in-memory SQLite database."""
+
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(db_api, '_ENGINE', None)
+        self.stubs.Set(db_api, '_MAKER', None)
+        CFG.set_override('sql_connection', 'sqlite://', group='db')
+        models.BASE.metadata.create_all(db.get_engine())
+
+    def tearDown(self):
+        CFG.set_override('sql_connection', None, group='db')
+        CFG.set_override('archive_batch_size', None, group='db')
+        self.stubs.UnsetAll()
+
+    def _create(self, task_uuid, params=None):
+        task = db.task_create_or_update(task_uuid, _task_values(task_uuid))
+        if params:
+            db.task_parameter_update(task_uuid, params)
+        return task
+
+    def test_task_get_all_pages_by_marker(self):
+        for task_uuid in ['a', 'b', 'c', 'd']:
+            self._create(task_uuid)
+
+        tasks = db.task_get_all(marker='a', limit=2)
+        self.assertEqual([t.uuid for t in tasks], ['b', 'c'])
+
+    def test_deleted_marker_still_pages(self):
+        for task_uuid in ['a', 'b', 'c', 'd']:
+            self._create(task_uuid)
+        db.task_delete('b')
+
+        self.assertEqual([t.uuid for t in db.task_get_all(marker='b')],
+                         ['c', 'd'])
+        batches = db.task_iter_batches(columns=('uuid',), marker='b')
+        self.assertEqual([t.uuid for t in next(batches)], ['c', 'd'])
+        self.assertRaises(common_exception.NotFound, db.task_get_all,
+                          marker='missing')
+
+    def test_task_parameter_get_all_by_task_uuids(self):
+        self._create('a', {'rotation': '1'})
+        self._create('b', {'rotation': '2', 'foo': 'bar'})
+
+        params = db.task_parameter_get_all_by_task_uuids(['a', 'b', 'c'])
+        self.assertEqual(params, {'a': {'rotation': '1'},
+                                  'b': {'rotation': '2', 'foo': 'bar'},
+                                  'c': {}})
+
+    def test_task_bulk_update(self):
+        self._create('a', {'rotation': '1', 'stale': 'x'})
+        self._create('b')
+
+        task_refs, deleted = db.task_bulk_update(
+                [_task_values('a', action='daily_backup'),
+                 _task_values('c')],
+                params={'a': ({'rotation': '2'}, True),
+                        'c': ({'rotation': '3'}, False)},
+                delete_uuids=['b', 'missing'])
+
+        self.assertEqual([t.uuid for t in task_refs], ['a', 'c'])
+        self.assertEqual(task_refs[0].action, 'daily_backup')
+        self.assertEqual(deleted, ['b'])
+        self.assertEqual([t.uuid for t in db.task_get_all()], ['a', 'c'])
+        self.assertEqual(db.task_parameter_get_all_by_task_uuids(['a', 'c']),
+                         {'a': {'rotation': '2'}, 'c': {'rotation': '3'}})
+
+    def test_task_iter_batches_projects_columns(self):
+        for task_uuid in ['a', 'b', 'c', 'd', 'e']:
+            self._create(task_uuid)
+        db.task_delete('c')
+
+        batches = list(db.task_iter_batches(batch_size=2,
+                                            columns=('uuid',
+                                                     'cron_schedule'),
+                                            marker='a'))
+        self.assertEqual([[t.uuid for t in batch] for batch in batches],
+                         [['b', 'd'], ['e']])
+        self.assertEqual(batches[0][0].cron_schedule, '0 0 0')
+        self.assertFalse(hasattr(batches[0][0], 'action'))
+
+    def test_task_listings_filter(self):
+        self._create('a')
+        db.task_create_or_update('b', dict(_task_values('b'),
+                                           instance_uuid='fedcba'))
+        db.task_create_or_update('c', _task_values('c', action='backup'))
+
+        tasks = db.task_get_all(filters={'instance_uuid': 'abcdef',
+                                         'action': 'snapshot'})
+        self.assertEqual([t.uuid for t in tasks], ['a'])
+
+        since = db.task_get('b').created_at
+        db.task_create_or_update('a', _task_values('a', action='backup'))
+        batches = db.task_iter_batches(columns=('uuid',),
+                                       filters={'updated_since': since})
+        self.assertEqual([t.uuid for t in next(batches)], ['a', 'b', 'c'])
+
+        since = db.task_get('a').updated_at
+        self.assertEqual([t.uuid for t in db.task_get_all(
+                              filters={'updated_since': since})], ['a'])
+
+    def test_task_delete_by_instance(self):
+        self._create('a', {'rotation': '1'})
+        self._create('b', {'rotation': '2'})
+        db.task_create_or_update('c', dict(_task_values('c'),
+                                           instance_uuid='fedcba'))
+
+        self.assertEqual(sorted(db.task_delete_by_instance('abcdef')),
+                         ['a', 'b'])
+        self.assertEqual([t.uuid for t in db.task_get_all()], ['c'])
+        self.assertEqual(db.task_parameter_get_all_by_task_uuids(['a', 'b']),
+                         {'a': {}, 'b': {}})
+        self.assertEqual(db.task_delete_by_instance('abcdef'), [])
+
+    def test_task_delete_by_instance_spares_new_tasks(self):
+        self._create('a')
+        chunks = db_api._chunks
+
+        def stubbed_chunks(items, size):
+            # Committed by another writer after the tasks were read
+            db.get_engine().execute(models.Task.__table__.insert(),
+                                    _task_values('b'))
+            return chunks(items, size)
+
+        self.stubs.Set(db_api, '_chunks', stubbed_chunks)
+        self.assertEqual(db.task_delete_by_instance('abcdef'), ['a'])
+        self.assertEqual([t.uuid for t in db.task_get_all()], ['b'])
+
+    def test_task_iter_all(self):
+        for task_uuid in ['a', 'b', 'c']:
+            self._create(task_uuid)
+
+        tasks = list(db.task_iter_all(batch_size=2))
+        self.assertEqual([t.uuid for t in tasks], ['a', 'b', 'c'])
+        self.assertEqual(tasks[0].action, 'snapshot')
+
+    def test_task_parameter_update_is_set_based(self):
+        old = dict(('key%d' % n, str(n)) for n in range(50))
+        self._create('a', old)
+
+        new = dict(('key%d' % n, str(n * 2)) for n in range(25))
+        new['extra'] = 'x'
+
+        # Every test gets its own engine, so the listener goes with it
+        statements = []
+        sqlalchemy.event.listen(
+                db.get_engine(), 'before_cursor_execute',
+                lambda conn, cursor, statement, *args:
+                statements.append(statement))
+        db.task_parameter_update('a', new, delete=True)
+
+        # One SELECT, INSERT, batched UPDATE and soft-delete each, and the
+        # change log entry with its id
+        self.assertEqual(len(statements), 7)
+        self.assertEqual(db.task_parameter_get_all_by_task_uuid('a'), new)
+
+    def test_task_delete_deletes_params(self):
+        self._create('a', {'rotation': '1', 'foo': 'bar'})
+        db.task_delete('a')
+        self.assertEqual(db.task_parameter_get_all_by_task_uuids(['a']),
+                         {'a': {}})
+
+    def _shadow_uuids(self, model, column):
+        shadow = dict(models.SHADOWED_MODELS)[model]
+        rows = db.get_engine().execute(shadow.select()).fetchall()
+        return sorted(row[column] for row in rows)
+
+    def test_archive_deleted_rows(self):
+        CFG.set_override('archive_batch_size', 1, group='db')
+        self._create('a', {'rotation': '1', 'foo': 'bar'})
+        self._create('b', {'rotation': '2'})
+        db.task_delete('a')
+        db.task_parameter_delete('b', 'rotation')
+
+        self.assertEqual(db.archive_deleted_rows(older_than=1),
+                         {'tasks': 0, 'task_parameters': 0,
+                          'task_changes': 0})
+        self.assertEqual(db.archive_deleted_rows(older_than=0),
+                         {'tasks': 1, 'task_parameters': 3,
+                          'task_changes': 6})
+
+        self.assertEqual(self._shadow_uuids(models.Task, 'uuid'), ['a'])
+        self.assertEqual(
+                self._shadow_uuids(models.TaskParameter, 'task_uuid'),
+                ['a', 'a', 'b'])
+        self.assertEqual([t.uuid for t in db.task_get_all()], ['b'])
+        # The uuid of an archived task is free again
+        self._create('a')
+
+    def test_archive_deleted_rows_max_rows(self):
+        for task_uuid in ['a', 'b', 'c']:
+            self._create(task_uuid)
+            db.task_delete(task_uuid)
+
+        self.assertEqual(db.archive_deleted_rows(older_than=0, max_rows=2),
+                         {'tasks': 2, 'task_parameters': 0,
+                          'task_changes': 2})
+        self.assertEqual(db.archive_deleted_rows(older_than=0),
+                         {'tasks': 1, 'task_parameters': 0,
+                          'task_changes': 4})
+
+    def test_writes_are_logged_as_changes(self):
+        self._create('a', {'rotation': '1'})
+        self._create('b')
+        first, last = db.task_change_get_bounds()
+        db.task_delete('a')
+        db.task_bulk_update([_task_values('c')], delete_uuids=['b'])
+
+        changes = db.task_change_get_since(last)
+        self.assertEqual([(c.task_uuid, c.deleted) for c in changes],
+                         [('a', True), ('c', False), ('b', True)])
+        self.assertEqual([c.id for c in db.task_change_get_since(last,
+                                                                 limit=1)],
+                         [changes[0].id])
+        self.assertEqual(db.task_change_get_bounds(), (first, changes[-1].id))
+        self.assertEqual(db.task_change_get_last_id(), changes[-1].id)
+
+    def test_change_ids_outlive_purged_changes(self):
+        self._create('a')
+        self._create('b')
+        first, last = db.task_change_get_bounds()
+        db.archive_deleted_rows(older_than=-1)
+        self.assertEqual(db.task_change_get_bounds(), (last + 1, last))
+
+        self._create('c')
+        self.assertEqual([c.id for c in db.task_change_get_since(last)],
+                         [last + 1])
+
+    def test_session_scope_shares_one_session(self):
+        db.begin_session_scope()
+        try:
+            session = db.get_session()
+            self.assertTrue(db.get_session() is session)
+            self._create('a')
+            self.assertTrue(db.task_get('a') is db.task_get('a'))
+        finally:
+            db.end_session_scope()
+        self.assertFalse(db.get_session() is session)
+
+    def test_pool_stats_counts_checkouts(self):
+        before = db.pool_stats()['checkout']
+        self._create('a')
+        db.task_get('a')
+        self.assertTrue(db.pool_stats()['checkout'] > before)
+
+    def test_explain_reports_every_hot_query(self):
+        plans = explain.explain()
+        self.assertEqual([name for name, sql, rows in plans],
+                         [name for name, statement in explain.HOT_QUERIES])
+        self.assertTrue(all(rows for name, sql, rows in plans))
+
+    def test_explain_quotes_reserved_words_for_mysql(self):
+        from sqlalchemy.dialects import mysql
+
+        name, statement = explain.HOT_QUERIES[-1]
+        sql = str(statement.compile(dialect=mysql.dialect()))
+        self.assertTrue('task_parameters.`key`' in sql)
+
+
+class SQLiteEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(db_api, '_ENGINE', None)
+        self.tmpdir = tempfile.mkdtemp()
+        CFG.set_override('sql_connection', 'sqlite:///%s' %
+                         os.path.join(self.tmpdir, 'tempo.sqlite'),
+                         group='db')
+
+    def tearDown(self):
+        CFG.set_override('sql_connection', None, group='db')
+        CFG.set_override('sqlite_wal', None, group='db')
+        self.stubs.UnsetAll()
+        shutil.rmtree(self.tmpdir)
+
+    def _journal_mode(self):
+        return db.get_engine().execute('PRAGMA journal_mode').scalar()
+
+    def test_uses_write_ahead_log(self):
+        self.assertEqual(self._journal_mode(), 'wal')
+
+    def test_write_ahead_log_can_be_disabled(self):
+        CFG.set_override('sqlite_wal', False, group='db')
+        self.assertEqual(self._journal_mode(), 'delete')
+
+
+class MigrationTest(unittest.TestCase):
+    def _index_names(self, engine):
+        return set(row[0] for row in engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+    def test_composite_indexes(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        for name in ['001_add_tasks_table', '002_add_task_parameters_table']:
+            upgrade, = schema.from_migration_import(name, ['upgrade'])
+            upgrade(engine)
+        before = self._index_names(engine)
+
+        upgrade, downgrade = schema.from_migration_import(
+                '003_add_composite_indexes', ['upgrade', 'downgrade'])
+        upgrade(engine)
+        self.assertTrue('ix_task_parameters_task_uuid_deleted_key' in
+                        self._index_names(engine))
+
+        insert = ("INSERT INTO task_parameters"
+                  " (task_uuid, key, created_at, deleted)"
+                  " VALUES ('a', 'rotation', '2012-01-01', %d)")
+        engine.execute(insert % 1)
+        engine.execute(insert % 1)
+        engine.execute(insert % 0)
+        self.assertRaises(sqlalchemy.exc.IntegrityError,
+                          engine.execute, insert % 0)
+
+        downgrade(engine)
+        self.assertEqual(self._index_names(engine), before)
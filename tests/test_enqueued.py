@@ -0,0 +1,126 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import stubout
+
+from tempo import enqueued
+from tempo import snapshot
+
+
+class FakePublisher(object):
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    def publish_batch(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('broker went away')
+        self.batches.append(messages)
+
+
+class EnqueueServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'enqueued.sock')
+        self.publisher = FakePublisher()
+        self.server = enqueued.EnqueueServer(self.path, self.publisher)
+        self.server.bind()
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(enqueued, 'RETRY_DELAY', 0)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _send(self, data):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(data, self.path)
+        finally:
+            sock.close()
+
+    def test_publishes_queued_requests_as_one_batch(self):
+        self._send('a')
+        self._send('b')
+        self.assertEqual(self.server.serve_once(), 2)
+        self.assertEqual(self.publisher.batches,
+                         [[('tempo.tasks', {'task_uuid': 'a'}),
+                           ('tempo.tasks', {'task_uuid': 'b'})]])
+
+    def test_request_with_snapshot(self):
+        task = snapshot.TaskSnapshot('a', 'b', 'snapshot', '0 0 0')
+        self._send('a %s' % snapshot.encode(task))
+        self.server.serve_once()
+
+        topic, message = self.publisher.batches[0][0]
+        self.assertEqual(message['task']['version'], task.version)
+
+    def test_invalid_request_is_skipped(self):
+        self._send('')
+        self.assertEqual(self.server.serve_once(), 0)
+        self.assertEqual(self.publisher.batches, [])
+
+    def _send_and_bind(self, data):
+        """Sends like tempo-enqueue, from an address it can be answered on"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind('')
+        sock.settimeout(1)
+        sock.sendto(data, self.path)
+        return sock
+
+    def test_answers_once_published(self):
+        sock = self._send_and_bind('a')
+        try:
+            self.server.serve_once()
+            self.assertEqual(sock.recv(16), enqueued.REPLY_OK)
+        finally:
+            sock.close()
+
+    def test_failed_publish_is_retried(self):
+        self.publisher.failures = 2
+        sock = self._send_and_bind('a')
+        try:
+            self.assertEqual(self.server.serve_once(), 1)
+            self.assertEqual(sock.recv(16), enqueued.REPLY_OK)
+        finally:
+            sock.close()
+        self.assertEqual(self.publisher.batches,
+                         [[('tempo.tasks', {'task_uuid': 'a'})]])
+
+    def test_gives_task_back_when_publish_keeps_failing(self):
+        self.publisher.failures = 3
+        sock = self._send_and_bind('a')
+        try:
+            self.assertEqual(self.server.serve_once(), 0)
+            self.assertEqual(sock.recv(16), enqueued.REPLY_ERROR)
+        finally:
+            sock.close()
+
+    def test_rebinds_over_stale_socket(self):
+        self.server.close()
+        open(self.path, 'w').close()
+        self.server.bind()
+        self._send('a')
+        self.assertEqual(self.server.serve_once(), 1)
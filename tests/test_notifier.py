@@ -0,0 +1,95 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import unittest
+
+import stubout
+
+from tempo import config
+from tempo import notifier
+
+CFG = config.CFG
+
+
+class RecordingNotifier(notifier.Notifier):
+    def __init__(self, **kwargs):
+        super(RecordingNotifier, self).__init__(**kwargs)
+        self.batches = []
+
+    def notify_batch(self, msgs):
+        self.batches.append(msgs)
+
+
+class NotifierTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(notifier, '_DRIVERS', {})
+        self.stubs.Set(notifier, '_DISPATCHER', None)
+
+    def tearDown(self):
+        CFG.set_override('driver', None, group='notifier')
+        CFG.set_override('async_dispatch', None, group='notifier')
+        self.stubs.UnsetAll()
+
+    def test_drivers_are_singletons(self):
+        CFG.set_override('driver', 'logging', group='notifier')
+        CFG.set_override('async_dispatch', False, group='notifier')
+        for n in range(3):
+            notifier.notify('test', 'Started Task', notifier.DEBUG, {})
+
+        self.assertEqual(len(notifier._DRIVERS), 1)
+        driver = notifier._DRIVERS['logging']
+        self.assertEqual(len(driver.logger.handlers), 1)
+
+    def test_async_dispatch_sends_batches(self):
+        driver = RecordingNotifier()
+        self.stubs.Set(notifier, '_DRIVERS', {'noop': driver})
+        CFG.set_override('driver', 'noop', group='notifier')
+
+        for n in range(5):
+            notifier.notify('test', 'Started Task', notifier.DEBUG, {'n': n})
+        self.assertTrue(notifier._DISPATCHER.flush(5))
+
+        sent = [msg['payload']['n'] for batch in driver.batches
+                for msg in batch]
+        self.assertEqual(sent, range(5))
+
+    def test_full_queue_drops_notifications(self):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def stubbed_notify_batch(msgs):
+            sending.set()
+            release.wait()
+
+        driver = RecordingNotifier()
+        self.stubs.Set(driver, 'notify_batch', stubbed_notify_batch)
+        self.stubs.Set(notifier, '_DRIVERS', {'noop': driver})
+        CFG.set_override('driver', 'noop', group='notifier')
+
+        # The first notification keeps the thread busy and the second one
+        # fills the queue
+        dispatcher = notifier._Dispatcher(1, 10)
+        dispatcher.put({'n': 0})
+        sending.wait(5)
+        for n in range(1, 5):
+            dispatcher.put({'n': n})
+        self.assertEqual(dispatcher.dropped, 3)
+
+        release.set()
+        self.assertTrue(dispatcher.flush(5))
@@ -0,0 +1,92 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import unittest
+
+import kombu
+import stubout
+
+from tempo import queue
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.connection = kombu.Connection('memory://')
+        self.stubs.Set(queue, 'new_connection', lambda: self.connection)
+        self.publisher = queue.Publisher(confirm=False, pool_size=1)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def _get(self, topic):
+        simple_queue = self.connection.SimpleQueue(topic)
+        try:
+            return simple_queue.get(block=False).payload
+        finally:
+            simple_queue.close()
+
+    def test_publish_batch(self):
+        self.publisher.publish_batch([('tasks', {'task_uuid': 'a'}),
+                                      ('tasks', {'task_uuid': 'b'}),
+                                      ('other', {'task_uuid': 'c'})])
+
+        self.assertEqual(self._get('tasks'), {'task_uuid': 'a'})
+        self.assertEqual(self._get('tasks'), {'task_uuid': 'b'})
+        self.assertEqual(self._get('other'), {'task_uuid': 'c'})
+
+    def test_reuses_channel_and_declarations(self):
+        declared = []
+        real_declare = self.publisher._declare
+        self.stubs.Set(self.publisher, '_declare',
+                       lambda channel, exchange, routing_key:
+                       (declared.append(exchange),
+                        real_declare(channel, exchange, routing_key)))
+
+        self.publisher.publish('tasks', {'task_uuid': 'a'})
+        pooled = self.publisher._channels[0]
+        self.publisher.publish('tasks', {'task_uuid': 'b'})
+
+        self.assertEqual(self.publisher._channels, [pooled])
+        self.assertEqual(declared, ['tasks'])
+
+    def test_reconnects_when_connection_is_stale(self):
+        stale = self.connection
+        real_publish_batch = self.publisher._publish_batch
+
+        def stubbed_publish_batch(connection, messages):
+            if connection is stale:
+                raise stale.connection_errors[0]('connection reset')
+            real_publish_batch(connection, messages)
+
+        self.stubs.Set(self.publisher, '_publish_batch',
+                       stubbed_publish_batch)
+        self.publisher._get_connection()
+        self.connection = kombu.Connection('memory://')
+
+        self.publisher.publish('tasks', {'task_uuid': 'a'})
+
+        self.assertTrue(self.publisher._connection is self.connection)
+        self.assertEqual(self._get('tasks'), {'task_uuid': 'a'})
+
+    def test_does_not_share_the_consumer_connection(self):
+        consumer_connection = kombu.Connection('memory://')
+        self.stubs.Set(queue, '_CONNECTION', consumer_connection)
+        self.publisher.publish('tasks', {'task_uuid': 'a'})
+        self.assertTrue(self.publisher._connection is self.connection)
+        self.assertTrue(queue.get_connection() is consumer_connection)
+        self.assertEqual(self._get('tasks'), {'task_uuid': 'a'})
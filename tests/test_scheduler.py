@@ -0,0 +1,91 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import os
+import time
+import unittest
+
+import stubout
+
+from tempo import db
+from tempo import scheduler
+
+# A Sunday
+NOW = datetime.datetime(2012, 4, 1, 10, 30, 15)
+
+
+class FakeTask(object):
+    def __init__(self, uuid, cron_schedule):
+        self.uuid = uuid
+        self.cron_schedule = cron_schedule
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.tasks = []
+        self.published = []
+
+        self.stubs.Set(db, 'task_iter_batches',
+                       lambda columns=None: iter([self.tasks]))
+        self.stubs.Set(scheduler.Scheduler, '_publish',
+                       lambda s, task_uuids: self.published.extend(task_uuids))
+        self.scheduler = scheduler.Scheduler()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_load_skips_invalid_schedules(self):
+        self.tasks = [FakeTask('a', '0 * *'), FakeTask('b', '99 * *')]
+        self.scheduler.load(NOW)
+        self.assertEqual(self.scheduler.next_wakeup(),
+                         datetime.datetime(2012, 4, 1, 11, 0))
+        self.assertEqual(len(self.scheduler._heap), 1)
+
+    def test_fire_due_publishes_and_reschedules(self):
+        self.tasks = [FakeTask('a', '* * *'), FakeTask('b', '0 * *')]
+        self.scheduler.load(NOW)
+
+        fired = self.scheduler.fire_due(datetime.datetime(2012, 4, 1, 10, 31))
+        self.assertEqual(fired, 1)
+        self.assertEqual(self.published, ['a'])
+        self.assertEqual(self.scheduler.next_wakeup(),
+                         datetime.datetime(2012, 4, 1, 10, 32))
+
+    def test_now_is_local_time_like_cron(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'XXX+05'
+        time.tzset()
+        try:
+            offset = datetime.datetime.utcnow() - scheduler._now()
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+        self.assertEqual(int(round(scheduler._seconds(offset) / 60)), 300)
+
+    def test_fire_due_does_not_catch_up(self):
+        self.tasks = [FakeTask('a', '* * *')]
+        self.scheduler.load(NOW)
+
+        later = datetime.datetime(2012, 4, 1, 12, 0, 30)
+        self.assertEqual(self.scheduler.fire_due(later), 1)
+        self.assertEqual(self.scheduler.next_wakeup(),
+                         datetime.datetime(2012, 4, 1, 12, 1))
@@ -0,0 +1,73 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import datetime
+import json
+import unittest
+
+import stubout
+
+from tempo import serializer
+
+
+class SerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_format_datetime(self):
+        self.assertEqual(serializer.format_datetime(
+                             datetime.datetime(2012, 4, 1, 10, 30, 15, 123)),
+                         '2012-04-01 10:30:15')
+        self.assertEqual(serializer.format_datetime(
+                             datetime.datetime(1850, 1, 2)),
+                         '1850-01-02 00:00:00')
+        self.assertEqual(serializer.format_datetime(None), None)
+
+    def test_dumps_formats_dates(self):
+        body = serializer.Serializer('json').dumps(
+                {'b': datetime.datetime(2012, 4, 1, 10, 30), 'a': [1, None]})
+        self.assertEqual(json.loads(body),
+                         {'a': [1, None], 'b': '2012-04-01 10:30:00'})
+
+    def test_json_backend_uses_the_c_encoder(self):
+        encoder = serializer.Serializer('json').dumps.__self__
+        self.assertTrue(json.encoder.c_make_encoder is not None)
+        self.assertFalse(encoder.sort_keys)
+
+    def test_auto_skips_missing_backends(self):
+        def missing():
+            raise ImportError()
+
+        self.stubs.Set(serializer, 'BACKENDS',
+                       [('ujson', missing),
+                        ('json', serializer._json_encoder)])
+        s = serializer.Serializer()
+        self.assertEqual(s.backend, 'json')
+        self.assertEqual(json.loads(s.dumps({'a': 1})), {'a': 1})
+
+    def test_missing_named_backend_fails(self):
+        def missing():
+            raise ImportError()
+
+        self.stubs.Set(serializer, 'BACKENDS', [('ujson', missing)])
+        self.assertRaises(ImportError, serializer.Serializer, 'ujson')
+
+    def test_unknown_backend_fails(self):
+        self.assertRaises(ValueError, serializer.Serializer, 'yaml')
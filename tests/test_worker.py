@@ -0,0 +1,377 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+import unittest
+
+import stubout
+
+from tempo import db
+from tempo import snapshot
+from tempo import worker
+
+
+class TaskPoolTest(unittest.TestCase):
+    def test_runs_tasks_concurrently(self):
+        pool = worker.TaskPool('thread', 3)
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        results = []
+
+        def task(n):
+            started.release()
+            release.wait()
+            return n
+
+        for n in range(3):
+            pool.apply_async(task, (n,), callback=results.append)
+
+        # All three tasks are running before any of them is allowed to end
+        for n in range(3):
+            started.acquire()
+        release.set()
+        pool.close()
+
+        self.assertEqual(sorted(results), [0, 1, 2])
+
+    def test_unknown_pool_fails(self):
+        self.assertRaises(ValueError, worker.TaskPool, 'fork', 1)
+
+
+class RunTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(worker, '_TASK_CACHE', None)
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_missing_task_is_not_an_error(self):
+        def stubbed_get(task_uuid):
+            raise worker.common_exception.NotFound()
+
+        self.stubs.Set(db, 'task_get', stubbed_get)
+        self.assertTrue(worker._run_task('abcdef'))
+
+    def test_failing_lookup_is_retried(self):
+        def stubbed_get(task_uuid):
+            raise IOError('database went away')
+
+        self.stubs.Set(db, 'task_get', stubbed_get)
+        self.assertFalse(worker._run_task('abcdef'))
+
+
+class FakeTask(object):
+    uuid = 'abcdef'
+    instance_uuid = 'fedcba'
+    action = 'daily_backup'
+    cron_schedule = '0 0 *'
+
+
+def _count_task_cache_misses(task_uuid):
+    worker._run_task(task_uuid)
+    return worker.task_cache_stats()['misses']
+
+
+class TaskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(worker, '_TASK_CACHE', None)
+        self.lookups = []
+
+        def stubbed_get(task_uuid):
+            self.lookups.append(task_uuid)
+            return FakeTask()
+
+        self.stubs.Set(db, 'task_get', stubbed_get)
+        self.stubs.Set(db, 'task_parameter_get_all_by_task_uuid',
+                       lambda task_uuid: {'rotation': '7'})
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_reads_through_cache(self):
+        task = worker._get_task('abcdef')
+        self.assertEqual(task.params, {'rotation': '7'})
+        self.assertEqual(task.action, 'daily_backup')
+        self.assertTrue(worker._get_task('abcdef') is task)
+
+        self.assertEqual(self.lookups, ['abcdef'])
+        stats = worker.task_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_task_changes_evict(self):
+        worker._get_task('abcdef')
+        consumer = worker.TaskConsumer(FakeConnection(), DeferredPool(),
+                                       'tempo', 'tempo_tasks', 'tasks')
+        consumer.on_task_changes({'task_uuids': ['abcdef']}, None)
+        worker._get_task('abcdef')
+        self.assertEqual(self.lookups, ['abcdef', 'abcdef'])
+        self.assertEqual(consumer.pool.invalidations, 1)
+
+    def test_task_changes_reach_process_pool_members(self):
+        self.stubs.Set(worker, '_perform_task', lambda task: True)
+        pool = worker.TaskPool('process', 1)
+        misses = []
+        finished = threading.Semaphore(0)
+
+        def _callback(result):
+            misses.append(result)
+            finished.release()
+
+        for invalidate in (False, False, True):
+            if invalidate:
+                pool.invalidate()
+            pool.apply_async(_count_task_cache_misses, ('abcdef',),
+                             callback=_callback)
+            finished.acquire()
+        pool.close()
+        self.assertEqual(misses, [1, 1, 2])
+
+
+class TaskSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(worker, '_LATEST_VERSIONS', None)
+        self.performed = []
+        self.stubs.Set(worker, '_perform_task', self.performed.append)
+        self.task = snapshot.TaskSnapshot.from_task(FakeTask(),
+                                                    {'rotation': '7'})
+        self.pool = DeferredPool()
+        self.consumer = worker.TaskConsumer(FakeConnection(), self.pool,
+                                            'tempo', 'tempo_tasks', 'tasks')
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_encode_round_trips(self):
+        task_dict = snapshot.decode(snapshot.encode(self.task))
+        task = snapshot.TaskSnapshot.from_dict(task_dict)
+        self.assertEqual(task.params, {'rotation': '7'})
+        self.assertEqual(task.version, self.task.version)
+
+    def test_version_follows_params(self):
+        task = snapshot.TaskSnapshot.from_task(FakeTask(), {'rotation': '8'})
+        self.assertNotEqual(task.version, self.task.version)
+
+    def _stub_lookups(self, task):
+        lookups = []
+
+        def stubbed_get_task(task_uuid):
+            lookups.append(task_uuid)
+            return task
+
+        self.stubs.Set(worker, '_get_task', stubbed_get_task)
+        return lookups
+
+    def test_runs_from_message_snapshot(self):
+        lookups = self._stub_lookups(self.task)
+
+        task_dict = self.task.to_dict()
+        for n in range(2):
+            self.consumer.on_message({'task_uuid': 'abcdef',
+                                      'task': task_dict}, FakeMessage(n))
+        self.assertEqual(self.pool.args, [('abcdef', task_dict)] * 2)
+        # Dispatching doesn't touch the DB
+        self.assertEqual(lookups, [])
+
+        for args in self.pool.args:
+            worker._run_task(*args)
+        self.assertEqual([task.params for task in self.performed],
+                         [{'rotation': '7'}] * 2)
+        # The version is checked against the DB once
+        self.assertEqual(lookups, ['abcdef'])
+
+    def test_unverified_stale_snapshot_is_dropped(self):
+        # The worker missed the announcement of the change
+        lookups = self._stub_lookups(snapshot.TaskSnapshot.from_task(
+                FakeTask(), {'rotation': '8'}))
+        worker._run_task('abcdef', self.task.to_dict())
+        self.assertEqual(self.performed[0].params, {'rotation': '8'})
+        self.assertEqual(lookups, ['abcdef', 'abcdef'])
+
+    def test_stale_message_snapshot_is_dropped(self):
+        newer = snapshot.TaskSnapshot.from_task(FakeTask(), {'rotation': '8'})
+        lookups = self._stub_lookups(newer)
+        self.consumer.on_task_changes(
+                {'task_uuids': ['abcdef'],
+                 'versions': {'abcdef': newer.version}}, None)
+
+        worker._run_task('abcdef', self.task.to_dict())
+        self.assertEqual(self.performed[0].params, {'rotation': '8'})
+        self.assertEqual(lookups, ['abcdef'])
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.fake_channel = FakeChannel()
+
+    def channel(self):
+        return self.fake_channel
+
+
+class FakeMessage(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class DeferredPool(object):
+    """Holds on to tasks until the test runs them"""
+
+    size = 4
+
+    def __init__(self):
+        self.tasks = []
+        self.args = []
+        self.invalidations = 0
+
+    def apply_async(self, func, args, callback=None):
+        self.tasks.append((args[0], callback))
+        self.args.append(args)
+
+    def invalidate(self):
+        self.invalidations += 1
+
+    def finish(self, task_uuid, succeeded=True):
+        for task in self.tasks:
+            if task[0] == task_uuid:
+                self.tasks.remove(task)
+                task[1](succeeded)
+                return
+
+
+class TaskConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.published = []
+        self.stubs.Set(worker.TaskConsumer, '_publish',
+                       lambda s, body, name, arguments:
+                       self.published.append((body, name, arguments)))
+        worker.CFG.set_override('ack_late', True, group='worker')
+        self.pool = DeferredPool()
+        self.connection = FakeConnection()
+        self.consumer = worker.TaskConsumer(self.connection, self.pool,
+                                            'tempo', 'tempo_tasks', 'tasks')
+
+    def tearDown(self):
+        worker.CFG.set_override('ack_late', None, group='worker')
+        self.stubs.UnsetAll()
+
+    def _deliver(self, *task_uuids):
+        messages = []
+        for n, task_uuid in enumerate(task_uuids):
+            message = FakeMessage(n + 1)
+            self.consumer.on_message({'task_uuid': task_uuid}, message)
+            messages.append(message)
+        return messages
+
+    def test_acks_early_by_default(self):
+        worker.CFG.set_override('ack_late', False, group='worker')
+        consumer = worker.TaskConsumer(self.connection, self.pool,
+                                       'tempo', 'tempo_tasks', 'tasks')
+        message = FakeMessage(1)
+        consumer.on_message({'task_uuid': 'a'}, message)
+        self.assertTrue(message.acked)
+
+    def test_failed_task_is_not_retried_without_ack_late(self):
+        worker.CFG.set_override('ack_late', False, group='worker')
+        consumer = worker.TaskConsumer(self.connection, self.pool,
+                                       'tempo', 'tempo_tasks', 'tasks')
+        consumer.on_message({'task_uuid': 'a'}, FakeMessage(1))
+        self.pool.finish('a', succeeded=False)
+        consumer.process_finished()
+        self.assertEqual(self.published, [])
+
+    def test_acks_late_with_one_multiple_ack(self):
+        messages = self._deliver('a', 'b', 'c')
+        self.consumer.process_finished()
+        self.assertEqual(self.connection.fake_channel.acks, [])
+
+        for task_uuid in ('b', 'a', 'c'):
+            self.pool.finish(task_uuid)
+        self.consumer.process_finished()
+
+        self.assertEqual(self.connection.fake_channel.acks, [(3, True)])
+        self.assertFalse(any(m.acked for m in messages))
+
+    def test_drains_briefly_while_acks_are_pending(self):
+        self.assertEqual(self.consumer._drain_timeout(), worker.DRAIN_TIMEOUT)
+        self._deliver('a')
+        self.assertEqual(self.consumer._drain_timeout(),
+                         worker.ACK_DRAIN_TIMEOUT)
+        self.pool.finish('a')
+        self.consumer.process_finished()
+        self.assertEqual(self.consumer._drain_timeout(), worker.DRAIN_TIMEOUT)
+
+    def test_acks_stragglers_individually(self):
+        self._deliver('a', 'b', 'c')
+        self.pool.finish('b')
+        self.pool.finish('c')
+        self.consumer.process_finished()
+        self.assertEqual(sorted(self.connection.fake_channel.acks),
+                         [(2, False), (3, False)])
+
+        self.pool.finish('a')
+        self.consumer.process_finished()
+        self.assertEqual(self.connection.fake_channel.acks[-1], (1, True))
+
+    def test_failed_task_is_retried_with_backoff(self):
+        self.consumer.on_message({'task_uuid': 'a', 'retries': 1},
+                                 FakeMessage(1))
+        self.pool.finish('a', succeeded=False)
+        self.consumer.process_finished()
+
+        body, name, arguments = self.published[0]
+        self.assertEqual(body, {'task_uuid': 'a', 'retries': 2})
+        self.assertEqual(name, 'tempo_tasks.retry.60')
+        self.assertEqual(arguments['x-message-ttl'], 60000)
+        self.assertEqual(arguments['x-dead-letter-routing-key'], 'tasks')
+        self.assertEqual(self.connection.fake_channel.acks, [(1, True)])
+
+    def test_retries_expire_onto_the_task_queue(self):
+        self.consumer.on_message({'task_uuid': 'a'}, FakeMessage(1))
+        self.pool.finish('a', succeeded=False)
+        self.consumer.process_finished()
+
+        body, name, arguments = self.published[0]
+        task_queue = self.consumer.task_queue()
+        self.assertEqual(arguments['x-dead-letter-exchange'],
+                         task_queue.exchange.name)
+        self.assertEqual(arguments['x-dead-letter-routing-key'],
+                         task_queue.routing_key)
+
+    def test_exhausted_task_is_dead_lettered(self):
+        self.consumer.on_message({'task_uuid': 'a', 'retries': 3},
+                                 FakeMessage(1))
+        self.pool.finish('a', succeeded=False)
+        self.consumer.process_finished()
+
+        body, name, arguments = self.published[0]
+        self.assertEqual(name, 'tempo_tasks.dead')
+        self.assertEqual(body['retries'], 4)
@@ -0,0 +1,122 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import signal
+import unittest
+
+import stubout
+
+from tempo import cron
+from tempo import queue
+from tempo import wsgi
+from tempo.db import api as db_api
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.stubs = stubout.StubOutForTesting()
+        self.server = wsgi.Server(None, 8080, workers=2)
+        self.server._running = True
+        self.spawned = []
+        self.signalled = []
+
+        def stubbed_spawn(s):
+            pid = 100 + len(self.spawned)
+            self.spawned.append(pid)
+            s._children[pid] = 0
+            return pid
+
+        def stubbed_spawn_service(s, service):
+            pid = 100 + len(self.spawned)
+            self.spawned.append(pid)
+            s._services[pid] = (0, service)
+            return pid
+
+        self.stubs.Set(wsgi.Server, '_spawn', stubbed_spawn)
+        self.stubs.Set(wsgi.Server, '_spawn_service', stubbed_spawn_service)
+        self.stubs.Set(wsgi.Server, '_signal',
+                       lambda s, pids, signum:
+                       self.signalled.append((sorted(pids), signum)))
+        self.stubs.Set(wsgi, 'MIN_WORKER_LIFETIME', 0)
+        self.stubs.Set(wsgi, 'SERVING_WORKERS', 1)
+        self.stubs.Set(wsgi.Server, '_read_config', lambda s: None)
+        for n in range(2):
+            self.server._spawn()
+
+    def tearDown(self):
+        self.stubs.UnsetAll()
+
+    def test_dead_worker_is_replaced(self):
+        self.server._reap(100, 9)
+        self.assertEqual(sorted(self.server._children), [101, 102])
+
+    def test_dead_service_is_replaced(self):
+        service = object()
+        pid = self.server._spawn_service(service)
+        self.server._reap(pid, 1)
+        self.assertEqual(self.server._services, {103: (0, service)})
+        self.assertEqual(sorted(self.server._children), [100, 101])
+
+    def test_reload_keeps_services(self):
+        self.server._spawn_service(object())
+        self.server.reload()
+        self.assertEqual(list(self.server._services), [102])
+        self.assertEqual(self.signalled[0][0], [100, 101])
+
+    def test_reload_replaces_every_worker(self):
+        wsgi.CFG.set_override('workers', 3, group='api')
+        try:
+            self.server.reload()
+        finally:
+            wsgi.CFG.set_override('workers', None, group='api')
+        self.assertEqual(sorted(self.server._children),
+                         [100, 101, 102, 103, 104])
+        self.assertEqual(wsgi.SERVING_WORKERS, 3)
+        self.assertEqual(self.signalled, [([100, 101], signal.SIGHUP)])
+
+        # Retired workers exit without being replaced
+        self.server._reap(100, 0)
+        self.server._reap(101, 0)
+        self.assertEqual(sorted(self.server._children), [102, 103, 104])
+        self.assertEqual(self.server._retiring, set())
+
+    def test_worker_count_defaults_to_cpus(self):
+        self.stubs.Set(wsgi, '_cpu_count', lambda: 8)
+        self.assertEqual(wsgi.worker_count(), 8)
+        wsgi.CFG.set_override('workers', 3, group='api')
+        try:
+            self.assertEqual(wsgi.worker_count(), 3)
+        finally:
+            wsgi.CFG.set_override('workers', None, group='api')
+
+    def test_reset_after_fork_recreates_install_locks(self):
+        self.stubs.Set(db_api, 'reset_engine', lambda: None)
+        self.stubs.Set(queue, 'reset_connection', lambda close=True: None)
+        install_lock = cron._INSTALL_LOCK
+        timer_lock = cron._TIMER_LOCK
+        # Restored by UnsetAll
+        self.stubs.Set(cron, '_INSTALL_LOCK', install_lock)
+        self.stubs.Set(cron, '_TIMER_LOCK', timer_lock)
+
+        wsgi._reset_after_fork()
+        self.assertFalse(cron._INSTALL_LOCK is install_lock)
+        self.assertFalse(cron._TIMER_LOCK is timer_lock)
+
+    def test_stopped_server_does_not_respawn(self):
+        self.server._running = False
+        self.server._reap(100, 9)
+        self.assertEqual(sorted(self.server._children), [101])
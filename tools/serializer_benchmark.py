@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Measures how long serializing a listing of tasks takes.
+
+The old path (strftime dates and flask.json.dumps) is compared with every
+installed serializer backend, both serializing each task anew and reusing
+the fragments of unchanged tasks.
+
+    tools/serializer_benchmark.py [-n RUNS] [-t TASKS]
+"""
+
+import datetime
+import optparse
+import os
+import sys
+import time
+
+TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                       os.pardir,
+                                       os.pardir))
+sys.path.insert(0, TOPDIR)
+
+from tempo import api
+from tempo import serializer
+
+
+class FakeTask(object):
+    def __init__(self, n):
+        now = datetime.datetime(2012, 4, 1, 10, 30, n % 60)
+        self.id = n
+        self.created_at = now
+        self.updated_at = now
+        self.deleted_at = None
+        self.deleted = False
+        self.uuid = '00010203-0405-0607-0809-%012d' % n
+        self.instance_uuid = '0f0e0d0c-0b0a-0908-0706-%012d' % (n // 4)
+        self.cron_schedule = '%d %d *' % (n % 60, n % 24)
+        self.action = 'daily_backup'
+
+
+def _old_dumps(tasks, params):
+    def make_task_dict(task):
+        task_dict = {}
+        for field in api.TASK_FIELDS:
+            if field == 'params':
+                task_dict[field] = params[task.uuid]
+            elif field in api._DATE_FIELDS:
+                date = getattr(task, field)
+                task_dict[field] = date.strftime(api.DATE_FORMAT) if date \
+                        else date
+            else:
+                task_dict[field] = getattr(task, api._FIELD_COLUMNS[field])
+        return task_dict
+
+    with api.app.app_context():
+        return ', '.join(api.flask.json.dumps(make_task_dict(task))
+                         for task in tasks)
+
+
+def _new_dumps(tasks, params):
+    return ', '.join(api._task_fragment(task, params[task.uuid],
+                                        api.TASK_FIELDS)
+                     for task in tasks)
+
+
+def _time_runs(func, runs, *args):
+    timings = []
+    for i in xrange(runs):
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def _report(name, timings):
+    best, median = timings
+    print '%-28s %8.1f ms %8.1f ms' % (name, best * 1000, median * 1000)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n RUNS] [-t TASKS]')
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='Times each listing is serialized')
+    parser.add_option('-t', '--tasks', type='int', default=1000,
+                      help='Tasks in the listing')
+    options, args = parser.parse_args()
+
+    api.CFG([])
+    tasks = [FakeTask(n) for n in xrange(options.tasks)]
+    params = dict((task.uuid, {'rotation': '7'}) for task in tasks)
+
+    print '%-28s %11s %11s' % ('serializer', 'best', 'median')
+    _report('flask.json', _time_runs(_old_dumps, options.runs, tasks, params))
+
+    for name, make_encoder in serializer.BACKENDS:
+        try:
+            api._SERIALIZER = serializer.Serializer(name)
+        except ImportError:
+            continue
+
+        api.CFG.set_override('fragment_cache_size', 0, group='api')
+        _report(name, _time_runs(_new_dumps, options.runs, tasks, params))
+
+        api.CFG.set_override('fragment_cache_size', options.tasks,
+                             group='api')
+        api._TASK_FRAGMENTS = None
+        _new_dumps(tasks, params)
+        _report('%s (reused fragments)' % name,
+                _time_runs(_new_dumps, options.runs, tasks, params))
+
+
+if __name__ == '__main__':
+    main()
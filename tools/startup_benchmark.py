@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2012 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Measures how long the bin/ entry points take to start.
+
+Every binary is run with --help, which exits right after its imports and
+option parsing. tempo-enqueue is also timed handing a task to a stand-in
+for tempo-enqueued.
+
+    tools/startup_benchmark.py [-n RUNS] [binary ...]
+"""
+
+import optparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                       os.pardir,
+                                       os.pardir))
+
+BINARIES = ['tempo-api', 'tempo-enqueue', 'tempo-enqueued', 'tempo-manage',
+            'tempo-scheduler', 'tempo-worker']
+
+
+def _time_runs(cmd, runs, env=None):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in xrange(runs):
+            start = time.time()
+            subprocess.call(cmd, stdout=devnull, stderr=devnull, env=env)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def _report(name, timings):
+    best, median = timings
+    print '%-28s %8.1f ms %8.1f ms' % (name, best * 1000, median * 1000)
+
+
+def _time_enqueue_shim(runs):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'tempo-enqueued.sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+
+    def _answer():
+        # Tells tempo-enqueue its task was published, as tempo-enqueued does
+        while True:
+            data, sender = sock.recvfrom(65536)
+            sock.sendto('ok', sender)
+
+    answerer = threading.Thread(target=_answer)
+    answerer.daemon = True
+    answerer.start()
+    env = dict(os.environ, TEMPO_ENQUEUE_SOCKET=path)
+    cmd = [sys.executable, os.path.join(TOPDIR, 'bin', 'tempo-enqueue'),
+           '00010203-0405-0607-0809-0a0b0c0d0e0f']
+    try:
+        return _time_runs(cmd, runs, env=env)
+    finally:
+        sock.close()
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n RUNS] [binary ...]')
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='Times each binary is started')
+    options, binaries = parser.parse_args()
+
+    print '%-28s %11s %11s' % ('binary', 'best', 'median')
+    for binary in binaries or BINARIES:
+        cmd = [sys.executable, os.path.join(TOPDIR, 'bin', binary), '--help']
+        _report(binary, _time_runs(cmd, options.runs))
+
+    if not binaries or 'tempo-enqueue' in binaries:
+        _report('tempo-enqueue (to daemon)', _time_enqueue_shim(options.runs))
+
+
+if __name__ == '__main__':
+    main()